@@ -0,0 +1,406 @@
+#!/usr/bin/env python
+# coding: utf-8
+"""Benchmarks luddite against a local stand-in package index.
+
+A fake PyPI (or devpi) server is started on localhost, serving generated projects
+with tunable latency, payload size and error rate. Each combination of requirements
+file size, engine and thread count is then checked by a fresh ``luddite`` process, so
+that peak memory use is comparable between runs. For example::
+
+    python bench_luddite.py --lines 10 1000 10000 --n-threads 4 16 --engine threads asyncio
+"""
+from __future__ import division
+from __future__ import print_function
+from __future__ import unicode_literals
+
+import argparse
+import gzip
+import io
+import json
+import os
+import random
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import timeit
+from functools import partial
+
+try:
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+    from SocketServer import ThreadingMixIn
+except ImportError:
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+    from socketserver import ThreadingMixIn
+
+try:
+    import resource
+except ImportError:
+    # Windows
+    resource = None
+
+import luddite
+
+
+def version_list(n):
+    return ["{}.{}.{}".format(i // 100, i // 10 % 10, i % 10) for i in range(1, n + 1)]
+
+
+def project_name(i):
+    return "project-{:05d}".format(i)
+
+
+class FakeIndex(ThreadingMixIn, HTTPServer):
+    """A package index on localhost, with ``projects`` projects of ``versions`` releases each.
+
+    ``flavor`` is "pypi" (PEP 691 simple API and the JSON API) or "devpi". Every response
+    is delayed by ``latency`` +/- ``jitter`` seconds, and a fraction ``error_rate`` of them
+    are a 503 instead. ``payload_kb`` pads the documents, like long project descriptions.
+    """
+
+    daemon_threads = True
+    allow_reuse_address = True
+    # a burst of new connections shouldn't be met with SYN retries
+    request_queue_size = 1024
+
+    def __init__(
+        self,
+        projects=1000,
+        versions=30,
+        payload_kb=0,
+        latency=0.0,
+        jitter=0.0,
+        error_rate=0.0,
+        retry_after=None,
+        flavor="pypi",
+        seed=0,
+    ):
+        HTTPServer.__init__(self, ("127.0.0.1", 0), _FakeIndexHandler)
+        self.projects = projects
+        self.versions = version_list(versions)
+        self.payload_kb = payload_kb
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.retry_after = retry_after
+        self.flavor = flavor
+        self.random = random.Random(seed)
+        self._documents = {}
+        self._lock = threading.Lock()
+        self.reset()
+
+    @property
+    def index_url(self):
+        host, port = self.server_address[:2]
+        path = "/pypi/" if self.flavor == "pypi" else "/root/pypi/+simple/"
+        return "http://{}:{}{}".format(host, port, path)
+
+    def start(self):
+        thread = threading.Thread(target=self.serve_forever, name="fake-index")
+        thread.daemon = True
+        thread.start()
+        return self
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+    def reset(self):
+        with self._lock:
+            self.stats = {"requests": 0, "errors": 0, "bytes": 0}
+
+    def count(self, key, n=1):
+        with self._lock:
+            self.stats[key] += n
+
+    def delay(self):
+        with self._lock:
+            jitter = self.random.uniform(-self.jitter, self.jitter) if self.jitter else 0
+            error = self.random.random() < self.error_rate
+        wait = self.latency + jitter
+        if wait > 0:
+            time.sleep(wait)
+        return error
+
+    def document(self, kind, name):
+        """The (plain, gzipped) JSON body of a document, made on first use"""
+        key = kind, name
+        if key not in self._documents:
+            files = {}
+            for v in self.versions:
+                files[v] = [{"filename": "{}-{}.tar.gz".format(name, v), "yanked": False}]
+            padding = "x" * (self.payload_kb * 1024)
+            if kind == "simple":
+                doc = {
+                    "meta": {"api-version": "1.1"},
+                    "name": name,
+                    "versions": self.versions,
+                    "files": [f for v in self.versions for f in files[v]],
+                    "padding": padding,
+                }
+            elif kind == "json":
+                info = {"name": name, "version": self.versions[-1], "description": padding}
+                doc = {"info": info, "releases": files}
+            else:
+                doc = {"result": dict((v, {"+links": files[v]}) for v in self.versions)}
+                doc["padding"] = padding
+            body = json.dumps(doc).encode("utf-8")
+            buf = io.BytesIO()
+            with gzip.GzipFile(fileobj=buf, mode="wb") as f:
+                f.write(body)
+            self._documents[key] = body, buf.getvalue()
+        return self._documents[key]
+
+    def route(self, path):
+        """Returns (kind, project name) for a document path, or (kind, None) for an index root"""
+        parts = [p for p in path.split("?")[0].split("/") if p]
+        if self.flavor == "pypi":
+            if parts == ["pypi"]:
+                return "root", None
+            if len(parts) == 3 and parts[0] == "pypi" and parts[2] == "json":
+                return "json", parts[1]
+            if len(parts) == 2 and parts[0] == "simple":
+                return "simple", parts[1]
+        else:
+            if parts == ["root", "pypi"]:
+                return "root", None
+            if len(parts) == 3 and parts[:2] == ["root", "pypi"]:
+                return "devpi", parts[2]
+        return None, None
+
+    def exists(self, name):
+        prefix = "project-"
+        if not name.startswith(prefix) or not name[len(prefix):].isdigit():
+            return False
+        return int(name[len(prefix):]) < self.projects
+
+
+class _FakeIndexHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    # headers and body go out in separate writes, Nagle + delayed ACK would add 40ms to each
+    disable_nagle_algorithm = True
+
+    def log_message(self, *args):
+        pass
+
+    def send(self, code, body=b"", headers=()):
+        self.send_response(code)
+        for header in headers:
+            self.send_header(*header)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        if self.command != "HEAD":
+            self.wfile.write(body)
+        self.server.count("bytes", len(body))
+
+    def do_HEAD(self):
+        self.do_GET()
+
+    def do_GET(self):
+        server = self.server
+        server.count("requests")
+        if server.delay():
+            server.count("errors")
+            headers = [] if server.retry_after is None else [("Retry-After", server.retry_after)]
+            self.send(503, b"busy", headers)
+            return
+        kind, name = server.route(self.path)
+        if kind == "root":
+            headers = [("X-Devpi-Server-Version", "6.0.0")] if server.flavor == "devpi" else []
+            self.send(200, b"", headers)
+            return
+        if kind is None or not server.exists(name):
+            self.send(404, b"not found")
+            return
+        body, gzipped = server.document(kind, name)
+        headers = [("Content-Type", "application/json; charset=utf-8")]
+        if kind == "simple":
+            headers = [("Content-Type", "application/vnd.pypi.simple.v1+json")]
+        if "gzip" in self.headers.get("Accept-Encoding", ""):
+            body = gzipped
+            headers.append(("Content-Encoding", "gzip"))
+        self.send(200, body, headers)
+
+
+def write_requirements(path, lines, projects):
+    """A requirements file of ``lines`` pins, cycling through ``projects`` projects"""
+    with open(path, "w") as f:
+        for i in range(lines):
+            version = "0.0.1" if i % 3 else "0.0.2"
+            f.write("{}=={}\n".format(project_name(i % projects), version))
+
+
+def percentile(values, q):
+    """Nearest-rank percentile, ``q`` in 0..100"""
+    if not values:
+        return None
+    values = sorted(values)
+    rank = max(int(round(q / 100 * len(values) + 0.5)) - 1, 0)
+    return values[min(rank, len(values) - 1)]
+
+
+def peak_rss_mb():
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # bytes on macOS, kilobytes elsewhere
+    return peak / (1024 * 1024 if sys.platform == "darwin" else 1024)
+
+
+def run_once(index_url, fname, engine="threads", n_threads=4, stream=False, adaptive=False):
+    """Checks ``fname`` against the index, with luddite's output thrown away.
+
+    Returns a dict with the wall time and the latencies of the individual lookups.
+    """
+    profile = luddite.Profile()
+    throttle = None
+    if adaptive:
+        throttle = luddite.Throttle(initial=min(4, n_threads), maximum=n_threads)
+    stdout = sys.stdout
+    start = timeit.default_timer()
+    with luddite.HTTPPool(maxsize=n_threads) as pool, open(os.devnull, "w") as devnull:
+        sys.stdout = devnull
+        try:
+            lud = luddite.Luddite(
+                fname, index=index_url, pool=pool, stream=stream, throttle=throttle, profile=profile
+            )
+            if engine == "asyncio":
+                lud.run_async(concurrency=n_threads)
+            else:
+                lud.run(n_threads=n_threads)
+        finally:
+            sys.stdout = stdout
+    latencies = [lookup.seconds for lookup in profile.lookups]
+    return {
+        "wall": timeit.default_timer() - start,
+        "lookups": len(latencies),
+        "p50": percentile(latencies, 50),
+        "p99": percentile(latencies, 99),
+        "peak_rss_mb": peak_rss_mb(),
+    }
+
+
+def _child_main(argv):
+    parser = argparse.ArgumentParser()
+    parser.add_argument("index_url")
+    parser.add_argument("fname")
+    parser.add_argument("--engine", default="threads")
+    parser.add_argument("-n", "--n-threads", type=int, default=4)
+    parser.add_argument("--stream", action="store_true")
+    parser.add_argument("--adaptive", action="store_true")
+    args = parser.parse_args(argv)
+    result = run_once(
+        args.index_url,
+        args.fname,
+        engine=args.engine,
+        n_threads=args.n_threads,
+        stream=args.stream,
+        adaptive=args.adaptive,
+    )
+    print(json.dumps(result))
+
+
+def _format_ms(seconds):
+    return "-" if seconds is None else "{:.1f}".format(seconds * 1000)
+
+
+COLUMNS = (
+    # header, width, format
+    ("lines", 6, lambda r: str(r["lines"])),
+    ("engine", 8, lambda r: r["engine"]),
+    ("n", 4, lambda r: str(r["n_threads"])),
+    ("wall s", 8, lambda r: "{:.3f}".format(r["wall"])),
+    ("req/s", 8, lambda r: "{:.0f}".format(r["requests"] / r["wall"]) if r["wall"] else "-"),
+    ("p50 ms", 8, lambda r: _format_ms(r["p50"])),
+    ("p99 ms", 8, lambda r: _format_ms(r["p99"])),
+    ("MB", 8, lambda r: "{:.2f}".format(r["bytes"] / 1024 / 1024)),
+    ("RSS MB", 8, lambda r: "-" if r["peak_rss_mb"] is None else "{:.1f}".format(r["peak_rss_mb"])),
+    ("503s", 6, lambda r: str(r["errors"])),
+)
+
+
+def format_row(result=None):
+    if result is None:
+        return " ".join("{:>{}}".format(header, width) for header, width, _ in COLUMNS)
+    return " ".join("{:>{}}".format(fmt(result), width) for _, width, fmt in COLUMNS)
+
+
+def main(argv=None):
+    argv = sys.argv[1:] if argv is None else argv
+    if argv[:1] == ["--child"]:
+        return _child_main(argv[1:])
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--lines", type=int, nargs="+", default=[10, 100, 1000], metavar="<N>")
+    parser.add_argument(
+        "--projects", type=int, metavar="<N>", help="distinct projects (default: one per line)"
+    )
+    parser.add_argument("--engine", nargs="+", default=["threads"], choices=["threads", "asyncio"])
+    parser.add_argument("-n", "--n-threads", type=int, nargs="+", default=[4], metavar="<N>")
+    parser.add_argument("--stream", action="store_true")
+    parser.add_argument("--adaptive", action="store_true")
+    parser.add_argument("--flavor", choices=["pypi", "devpi"], default="pypi")
+    parser.add_argument("--versions", type=int, default=30, help="releases per project")
+    parser.add_argument("--payload-kb", type=int, default=0, help="padding per document")
+    parser.add_argument("--latency", type=float, default=0.005, metavar="<seconds>")
+    parser.add_argument("--jitter", type=float, default=0.0, metavar="<seconds>")
+    parser.add_argument("--error-rate", type=float, default=0.0, metavar="<fraction>")
+    parser.add_argument("--retry-after", metavar="<seconds>", help="sent with the 503s")
+    parser.add_argument("--repeat", type=int, default=1, help="runs per combination, best kept")
+    parser.add_argument("--json", action="store_true", help="print results as JSON lines")
+    parser.add_argument("-o", "--output", metavar="<file>", help="also write the results here")
+    args = parser.parse_args(argv)
+
+    server = FakeIndex(
+        projects=args.projects or max(args.lines),
+        versions=args.versions,
+        payload_kb=args.payload_kb,
+        latency=args.latency,
+        jitter=args.jitter,
+        error_rate=args.error_rate,
+        retry_after=args.retry_after,
+        flavor=args.flavor,
+    ).start()
+    tmpdir = tempfile.mkdtemp(prefix="luddite-bench-")
+    out = [sys.stdout]
+    if args.output:
+        out.append(io.open(args.output, "w", encoding="utf-8"))
+    emit = partial(_emit, out)
+    try:
+        if not args.json:
+            emit(format_row())
+        for lines in args.lines:
+            fname = os.path.join(tmpdir, "requirements-{}.txt".format(lines))
+            write_requirements(fname, lines, args.projects or lines)
+            for engine in args.engine:
+                for n_threads in args.n_threads:
+                    results = []
+                    for _ in range(args.repeat):
+                        server.reset()
+                        cmd = [sys.executable, os.path.abspath(__file__), "--child"]
+                        cmd += [server.index_url, fname, "--engine", engine, "-n", str(n_threads)]
+                        cmd += ["--stream"] * args.stream + ["--adaptive"] * args.adaptive
+                        output = subprocess.check_output(cmd)
+                        result = json.loads(output.decode("utf-8").splitlines()[-1])
+                        result.update(server.stats)
+                        results.append(result)
+                    result = min(results, key=lambda r: r["wall"])
+                    result.update(lines=lines, engine=engine, n_threads=n_threads)
+                    emit(json.dumps(result, sort_keys=True) if args.json else format_row(result))
+    finally:
+        server.stop()
+        for f in out[1:]:
+            f.close()
+        for name in os.listdir(tmpdir):
+            os.remove(os.path.join(tmpdir, name))
+        os.rmdir(tmpdir)
+
+
+def _emit(out, text):
+    for f in out:
+        print(text, file=f)
+        f.flush()
+
+
+if __name__ == "__main__":
+    main()
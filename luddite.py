@@ -4,24 +4,62 @@ from __future__ import print_function
 from __future__ import unicode_literals
 
 import argparse
+import codecs
+import glob
+import hashlib
+import io
 import json
 import os
-import subprocess
+import random
+import re
+import socket
+import sqlite3
+import ssl
 import sys
-from concurrent.futures import ThreadPoolExecutor
+import threading
+import time
+import zlib
+from bisect import bisect_left, bisect_right
+from collections import OrderedDict, deque
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, ThreadPoolExecutor
+from concurrent.futures import wait as wait_futures
+from contextlib import contextmanager
+from email.utils import mktime_tz, parsedate_tz
+from functools import partial
+from timeit import default_timer as timer
+
+try:
+    import asyncio
+except ImportError:
+    # Python 2
+    asyncio = None
 
 from packaging.requirements import InvalidRequirement
 from packaging.requirements import Requirement
+from packaging.utils import canonicalize_name
 from packaging.version import InvalidVersion
 from packaging.version import Version
 
 try:
-    from urllib2 import Request, urlopen
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+    from SocketServer import ThreadingMixIn, UnixStreamServer
+    from urllib2 import HTTPError, Request, urlopen
+    from urllib import getproxies, pathname2url, proxy_bypass
+    from urlparse import urljoin, urlsplit
+    from httplib import HTTPConnection, HTTPException, HTTPResponse, HTTPSConnection
+    from ConfigParser import Error as ConfigParserError, RawConfigParser
+    from xmlrpclib import dumps as xmlrpc_dumps, loads as xmlrpc_loads
 except ImportError:
-    from urllib.request import Request, urlopen
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+    from socketserver import ThreadingMixIn, UnixStreamServer
+    from urllib.error import HTTPError
+    from urllib.parse import urljoin, urlsplit
+    from urllib.request import Request, getproxies, pathname2url, proxy_bypass, urlopen
+    from http.client import HTTPConnection, HTTPException, HTTPResponse, HTTPSConnection
+    from configparser import Error as ConfigParserError, RawConfigParser
+    from xmlrpc.client import dumps as xmlrpc_dumps, loads as xmlrpc_loads
 else:
     import cgi
-    import codecs
 
     sys.stdout = codecs.getwriter("utf8")(sys.stdout)
 
@@ -32,6 +70,11 @@ __version__ = "1.0.4"
 DEFAULT_FNAME = "requirements.txt"
 DEFAULT_PIP_INDEX = os.environ.get("PIP_INDEX_URL", "https://pypi.org/pypi/")
 DEFAULT_INDEX = os.environ.get("LUDDITE_DEFAULT_INDEX", DEFAULT_PIP_INDEX)
+DEFAULT_SERVER = "127.0.0.1:7467"
+DEFAULT_CACHE_DIR = os.environ.get("LUDDITE_CACHE_DIR") or os.path.join(
+    os.environ.get("XDG_CACHE_HOME") or os.path.join(os.path.expanduser("~"), ".cache"),
+    "luddite",
+)
 
 ANSI_COLORS = {
     None: "\x1b[0m",  # actually black but whatevs
@@ -53,6 +96,14 @@ class MultipleIndicesError(LudditeError):
     """could not parse index url from the requirements.txt"""
 
 
+class DeadlineExceeded(LudditeError):
+    """the run's deadline passed before a lookup finished"""
+
+
+class LookupCancelled(LudditeError):
+    """the request was called off, e.g. a hedged request which lost the race"""
+
+
 def cprint(value, **kwargs):
     color = ANSI_COLORS[kwargs.pop("color", None)]
     reset = ANSI_COLORS[None]
@@ -76,24 +127,1010 @@ def get_charset(headers, default="utf-8"):
     return charset
 
 
-def json_get(url, headers=(("Accept", "application/json"),)):
-    request = Request(url=url, headers=dict(headers))
-    response = urlopen(request)
-    code = response.code
+class ResponseCache(object):
+    """Persistent, size-bounded store of index responses.
+
+    Entries are kept fresh for ``max_age`` seconds, after which they are revalidated
+    with the server using the ETag/Last-Modified validators. Least recently used
+    entries are evicted once the cache grows beyond ``max_size`` bytes.
+    """
+
+    def __init__(
+        self, path=os.path.join(DEFAULT_CACHE_DIR, "http"), max_age=300, max_size=64 * 1024 * 1024
+    ):
+        self.path = str(path)
+        self.max_age = max_age
+        self.max_size = max_size
+        self._size = None
+        self._lock = threading.Lock()
+
+    def _fname(self, url):
+        key = hashlib.sha1(url.encode("utf-8")).hexdigest()
+        return os.path.join(self.path, key)
+
+    def get(self, url):
+        fname = self._fname(url)
+        try:
+            with open(fname, "rb") as f:
+                entry = json.loads(f.readline().decode("utf-8"))
+                entry["body"] = f.read()
+        except (IOError, OSError, ValueError):
+            return None
+        if entry.get("url") != url:
+            return None
+        try:
+            # the file mtime doubles as the LRU clock
+            os.utime(fname, None)
+        except OSError:
+            pass
+        return entry
+
+    def is_fresh(self, entry):
+        return 0 <= time.time() - entry["stored"] < self.max_age
+
+    def validators(self, entry):
+        headers = {}
+        if entry.get("etag"):
+            headers["If-None-Match"] = entry["etag"]
+        if entry.get("last_modified"):
+            headers["If-Modified-Since"] = entry["last_modified"]
+        return headers
+
+    def set(self, url, body, charset="utf-8", etag=None, last_modified=None):
+        entry = {
+            "url": url,
+            "stored": time.time(),
+            "charset": charset,
+            "etag": etag,
+            "last_modified": last_modified,
+        }
+        header = json.dumps(entry).encode("utf-8")
+        fname = self._fname(url)
+        tmp = "{}.{}.{}".format(fname, os.getpid(), threading.current_thread().ident)
+        try:
+            if not os.path.isdir(self.path):
+                os.makedirs(self.path)
+        except OSError:
+            # lost a race with another thread/process, or unwritable
+            if not os.path.isdir(self.path):
+                return
+        try:
+            old_size = os.path.getsize(fname)
+        except OSError:
+            old_size = 0
+        try:
+            with open(tmp, "wb") as f:
+                f.write(header + b"\n")
+                f.write(body)
+            getattr(os, "replace", os.rename)(tmp, fname)
+        except (IOError, OSError):
+            # it's only a cache
+            try:
+                os.remove(tmp)
+            except OSError:
+                pass
+            return
+        with self._lock:
+            if self._size is not None:
+                self._size += len(header) + 1 + len(body) - old_size
+            if self._size is None or self._size > self.max_size:
+                self.evict()
+
+    def refresh(self, url, entry):
+        """Marks an entry fresh again after the server confirmed it's unchanged"""
+        self.set(
+            url,
+            entry["body"],
+            charset=entry["charset"],
+            etag=entry["etag"],
+            last_modified=entry["last_modified"],
+        )
+
+    def evict(self):
+        entries = []
+        for name in os.listdir(self.path):
+            fname = os.path.join(self.path, name)
+            try:
+                stat = os.stat(fname)
+            except OSError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, fname))
+        size = sum(e[1] for e in entries)
+        entries.sort()
+        for _mtime, file_size, fname in entries:
+            if size <= self.max_size:
+                break
+            try:
+                os.remove(fname)
+            except OSError:
+                continue
+            size -= file_size
+        self._size = size
+
+
+class PooledResponse(object):
+    """A response from one of the pools, quacking enough like the one from ``urlopen``.
+
+    The body was either read already, or is streamed from ``fp``, in which case the
+    connection goes back to its pool once the body has been read to the end - or is
+    closed, if the rest of the body isn't wanted.
+    """
+
+    def __init__(self, url, code, headers, body=b"", fp=None, release=None, close=None):
+        self.url = url
+        self.code = code
+        self.headers = headers
+        self._fp = io.BytesIO(body) if fp is None else fp
+        self._release = release
+        self._close = close
+
+    def read(self, amt=None):
+        data = self._fp.read() if amt is None else self._fp.read(amt)
+        if self._release is not None and self._fp.isclosed():
+            release, self._release = self._release, None
+            release()
+        return data
+
+    def close(self):
+        """Gives up on the rest of the body, closing the connection it was coming on"""
+        if self._release is not None:
+            self._release = None
+            if self._close is not None:
+                self._close()
+
+
+class _Attempt(object):
+    """One try at a lookup, which can be called off from another thread.
+
+    An attempt made on behalf of a ``parent`` (say, the run it's part of) is called
+    off along with it.
+    """
+
+    def __init__(self, parent=None):
+        self.parent = parent
+        self._cancelled = False
+
+    @property
+    def cancelled(self):
+        return self._cancelled or (self.parent is not None and self.parent.cancelled)
+
+    @cancelled.setter
+    def cancelled(self, value):
+        self._cancelled = value
+
+
+# the attempt each thread is working on, for the pool to tag its connections with
+_attempts = threading.local()
+
+
+def _cancelled():
+    attempt = getattr(_attempts, "current", None)
+    return attempt is not None and attempt.cancelled
+
+
+def _as_attempt(attempt, func, *args, **kwargs):
+    """Calls ``func`` as part of ``attempt``, so that calling that off breaks off its requests"""
+    previous = getattr(_attempts, "current", None)
+    _attempts.current = attempt
+    try:
+        return func(*args, **kwargs)
+    finally:
+        _attempts.current = previous
+
+
+class HTTPPool(object):
+    """Keep-alive HTTP(S) connections, pooled per index host.
+
+    Instances are thread-safe and may be shared by several ``Luddite`` instances.
+    At most ``maxsize`` idle connections are kept for each host, so this should be
+    sized to match the number of worker threads. ``timeout`` limits the seconds spent
+    connecting, and waiting for each read unless ``read_timeout`` is given too.
+    """
+
+    max_redirects = 5
+
+    def __init__(self, maxsize=4, timeout=None, read_timeout=None):
+        self.maxsize = maxsize
+        self.timeout = timeout
+        self.read_timeout = timeout if read_timeout is None else read_timeout
+        self._idle = {}
+        self._busy = {}  # connection: the attempt using it
+        self._lock = threading.Lock()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def close(self):
+        with self._lock:
+            idle, self._idle = self._idle, {}
+        for conns in idle.values():
+            for conn in conns:
+                conn.close()
+
+    def _new_conn(self, scheme, netloc):
+        cls = HTTPSConnection if scheme == "https" else HTTPConnection
+        if self.timeout is None:
+            return cls(netloc)
+        return cls(netloc, timeout=self.timeout)
+
+    def abort(self, attempt=None):
+        """Breaks off the requests in flight - for when nobody is waiting for them anymore.
+
+        With an ``attempt``, only that attempt's requests are broken off.
+        """
+        with self._lock:
+            busy = [conn for conn, a in self._busy.items() if attempt is None or a is attempt]
+        for conn in busy:
+            sock = conn.sock
+            if sock is not None:
+                try:
+                    sock.shutdown(socket.SHUT_RDWR)
+                except (socket.error, OSError):
+                    pass
+
+    def _get_conn(self, key):
+        with self._lock:
+            idle = self._idle.get(key)
+            conn, reused = (idle.pop(), True) if idle else (None, False)
+        if conn is None:
+            conn = self._new_conn(*key)
+        with self._lock:
+            self._busy[conn] = getattr(_attempts, "current", None)
+        return conn, reused
+
+    def _put_conn(self, key, conn):
+        with self._lock:
+            self._busy.pop(conn, None)
+            idle = self._idle.setdefault(key, [])
+            if len(idle) < self.maxsize:
+                idle.append(conn)
+                return
+        conn.close()
+
+    def _close_conn(self, conn):
+        with self._lock:
+            self._busy.pop(conn, None)
+        conn.close()
+
+    def _release(self, key, conn, response):
+        if response.will_close:
+            self._close_conn(conn)
+        else:
+            self._put_conn(key, conn)
+
+    def _request(self, method, url, headers, stream=False, profile=None):
+        parts = urlsplit(url)
+        key = parts.scheme, parts.netloc
+        path = parts.path or "/"
+        if parts.query:
+            path += "?" + parts.query
+        while True:
+            conn, reused = self._get_conn(key)
+            try:
+                if not reused:
+                    # DNS, TCP and TLS handshakes
+                    with _timed(profile, "connect"):
+                        conn.connect()
+                    if self.read_timeout != self.timeout:
+                        conn.sock.settimeout(self.read_timeout)
+                conn.request(method, path, headers=headers)
+                response = conn.getresponse()
+                body = b"" if stream else response.read()
+            except (socket.error, HTTPException) as err:
+                self._close_conn(conn)
+                if reused and not isinstance(err, socket.timeout) and not _cancelled():
+                    # the server dropped an idle keep-alive connection, try a fresh one
+                    continue
+                raise
+            break
+        if stream:
+            release = partial(self._release, key, conn, response)
+            close = partial(self._close_conn, conn)
+            return PooledResponse(
+                url, response.status, response.msg, fp=response, release=release, close=close
+            )
+        self._release(key, conn, response)
+        return PooledResponse(url, response.status, response.msg, body)
+
+    def urlopen(self, request, stream=False, profile=None):
+        """Drop-in for ``urlopen``, except that non-2xx responses are returned, not raised.
+
+        With ``stream=True`` the body is left unread, for the caller to ``read`` in chunks.
+        Time spent opening new connections is added to the ``profile``, if given.
+        """
+        url = request.get_full_url()
+        host = urlsplit(url).hostname
+        if urlsplit(url).scheme in getproxies() and not proxy_bypass(host):
+            if self.read_timeout is None:
+                return urlopen(request)
+            return urlopen(request, timeout=self.read_timeout)
+        method = request.get_method()
+        headers = dict(request.header_items())
+        for _ in range(self.max_redirects + 1):
+            response = self._request(method, url, headers, stream=stream, profile=profile)
+            location = response.headers.get("Location")
+            if response.code not in (301, 302, 303, 307, 308) or not location:
+                return response
+            response.read()
+            url = urljoin(url, location)
+            if response.code == 303 and method != "HEAD":
+                method = "GET"
+        raise LudditeError("Too many redirects fetching {}".format(request.get_full_url()))
+
+
+def _decompress(data, content_encoding):
+    if content_encoding in ("gzip", "x-gzip"):
+        return zlib.decompress(data, 16 + zlib.MAX_WBITS)
+    if content_encoding == "deflate":
+        try:
+            return zlib.decompress(data)
+        except zlib.error:
+            # some servers send a raw deflate stream without the zlib wrapper
+            return zlib.decompress(data, -zlib.MAX_WBITS)
+    return data
+
+
+_WHITESPACE = re.compile(r"[ \t\n\r]*")
+_SCALAR = re.compile(r"-?\d+(?:\.\d+)?(?:[eE][-+]?\d+)?|true|false|null")
+_SCALAR_CHARS = re.compile(r"[\d.eE+\-a-z]*")
+_STRING_BODY = re.compile(r'[^"\\]*(?:\\.[^"\\]*)*')
+# runs of anything but brackets, including whole strings
+_SKIP_RUN = re.compile(r'(?:[^"{}\[\]]+|"[^"\\]*(?:\\.[^"\\]*)*")*')
+_SKIPPED = object()
+
+
+class _JSONStream(object):
+    """Recursive descent JSON parser pulling text from an iterable of chunks.
+
+    Only the parts of the document matching the patterns are materialised, the rest
+    is scanned over and thrown away, so memory use doesn't grow with the document size.
+    """
+
+    def __init__(self, chunks):
+        self._chunks = iter(chunks)
+        self._buf = ""
+        self._pos = 0
+        self._captured = None
+
+    def _fill(self):
+        for chunk in self._chunks:
+            if chunk:
+                if self._captured is not None:
+                    self._captured.append(self._buf[self._capture_start : self._pos])
+                    self._capture_start = 0
+                self._buf = self._buf[self._pos :] + chunk
+                self._pos = 0
+                return True
+        return False
+
+    def _error(self, msg="Unexpected end of JSON data"):
+        return ValueError("{} at: {!r}".format(msg, self._buf[self._pos : self._pos + 20]))
+
+    def _peek(self):
+        buf, pos = self._buf, self._pos
+        if pos < len(buf) and buf[pos] not in " \t\n\r":
+            return buf[pos]
+        while True:
+            self._pos = _WHITESPACE.match(self._buf, self._pos).end()
+            if self._pos < len(self._buf):
+                return self._buf[self._pos]
+            if not self._fill():
+                return ""
+
+    def _expect(self, chars):
+        char = self._peek()
+        if not char or char not in chars:
+            raise self._error("Expected one of {!r}".format(chars))
+        self._pos += 1
+        return char
+
+    @staticmethod
+    def _descend(patterns, key):
+        """the remainders of the patterns which match the key"""
+        return tuple(p[1:] for p in patterns if p[0] == "*" or p[0] == key)
+
+    @staticmethod
+    def _prune(value, patterns):
+        if isinstance(value, dict):
+            items = value.items()
+        elif isinstance(value, list):
+            items = enumerate(value)
+        else:
+            return value
+        kept = dict((k, v) for k, v in items if () in _JSONStream._descend(patterns, k))
+        if isinstance(value, dict):
+            return kept
+        return [kept.get(i) for i in range(len(value))]
+
+    def _string(self):
+        self._peek()
+        while True:
+            try:
+                value, end = json.decoder.scanstring(self._buf, self._pos + 1)
+            except ValueError:
+                # unterminated, or an escape sequence cut in half by the chunking
+                if not self._fill():
+                    raise
+            else:
+                self._pos = end
+                return value
+
+    def _skip_string(self):
+        self._pos += 1
+        while True:
+            end = _STRING_BODY.match(self._buf, self._pos).end()
+            if end < len(self._buf) and self._buf[end] == '"':
+                self._pos = end + 1
+                return
+            # ran out of buffer, maybe right after a backslash which must be kept
+            self._pos = end
+            if not self._fill():
+                raise self._error()
+
+    def _scalar(self):
+        while True:
+            match = _SCALAR.match(self._buf, self._pos)
+            end = self._pos if match is None else match.end()
+            if _SCALAR_CHARS.match(self._buf, end).end() == len(self._buf):
+                # might be a number or literal which continues in the next chunk
+                if self._fill():
+                    continue
+            if match is None:
+                raise self._error("Invalid JSON value")
+            self._pos = match.end()
+            return json.loads(match.group())
+
+    def _skip_value(self):
+        char = self._peek()
+        if char == '"':
+            self._skip_string()
+            return
+        if char not in "{[":
+            self._scalar()
+            return
+        depth = 0
+        while True:
+            self._pos = _SKIP_RUN.match(self._buf, self._pos).end()
+            if self._pos == len(self._buf):
+                if not self._fill():
+                    raise self._error()
+                continue
+            char = self._buf[self._pos]
+            if char == '"':
+                # a string continuing into the next chunk
+                self._skip_string()
+                continue
+            self._pos += 1
+            depth += 1 if char in "{[" else -1
+            if depth == 0:
+                return
+
+    def _capture_value(self):
+        """Skips over a value, returning its text"""
+        self._peek()
+        self._captured = []
+        self._capture_start = self._pos
+        try:
+            self._skip_value()
+            self._captured.append(self._buf[self._capture_start : self._pos])
+            return "".join(self._captured)
+        finally:
+            self._captured = None
+
+    def value(self, patterns, top=False):
+        """Parses the next value, keeping the parts matched by the (remaining) patterns"""
+        if not patterns:
+            self._skip_value()
+            return _SKIPPED
+        if not top and () not in patterns and all(len(p) == 1 for p in patterns):
+            # small containers holding the wanted values are quicker to load whole
+            return self._prune(json.loads(self._capture_value()), patterns)
+        keep_all = () in patterns
+        char = self._peek()
+        if char == "{":
+            self._pos += 1
+            obj = {}
+            if self._peek() == "}":
+                self._pos += 1
+                return obj
+            while True:
+                if self._peek() != '"':
+                    raise self._error("Expected object key")
+                key = self._string()
+                self._expect(":")
+                item = self.value(patterns if keep_all else self._descend(patterns, key))
+                if item is not _SKIPPED:
+                    obj[key] = item
+                if self._expect(",}") == "}":
+                    return obj
+        if char == "[":
+            self._pos += 1
+            arr = []
+            if self._peek() == "]":
+                self._pos += 1
+                return arr
+            while True:
+                item = self.value(patterns if keep_all else self._descend(patterns, len(arr)))
+                arr.append(None if item is _SKIPPED else item)
+                if self._expect(",]") == "]":
+                    return arr
+        if char == '"':
+            return self._string()
+        if not char:
+            raise self._error()
+        return self._scalar()
+
+
+def extract_json(chunks, paths):
+    """Parses JSON text arriving in chunks, keeping only the values at ``paths``.
+
+    Each path is a tuple of object keys, where "*" matches any key or array index.
+    Objects and arrays leading to a wanted path are kept (with just the wanted
+    parts inside), everything else is dropped while parsing.
+    """
+    stream = _JSONStream(chunks)
+    data = stream.value(tuple(tuple(p) for p in paths), top=True)
+    if stream._peek():
+        raise stream._error("Extra data after JSON document")
+    return data
+
+
+def _iter_text(response, charset, content_encoding, chunk_size=64 * 1024, stats=None):
+    """Yields the decoded text of a response body, a chunk at a time"""
+    decompressor = None
+    if content_encoding in ("gzip", "x-gzip"):
+        decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+    elif content_encoding == "deflate":
+        decompressor = zlib.decompressobj()
+    decoder = codecs.getincrementaldecoder(charset)()
+    while True:
+        chunk = response.read(chunk_size)
+        if not chunk:
+            break
+        if stats is not None:
+            stats["bytes"] = stats.get("bytes", 0) + len(chunk)
+        if decompressor is not None:
+            chunk = decompressor.decompress(chunk)
+        yield decoder.decode(chunk)
+    tail = b"" if decompressor is None else decompressor.flush()
+    yield decoder.decode(tail, True)
+
+
+def _cache_key(url, extract):
+    if extract is None:
+        return url
+    # an extract is cached separately from the full document, with the same validators
+    return "{}#{}".format(url, ",".join(".".join(p) for p in extract))
+
+
+def _loads(body, charset):
+    return json.loads(body.decode(charset))
+
+
+def _cached_json(key, headers, cache, fresh=None, loads=_loads):
+    """Returns (request headers, cache entry, data) - data is only set for a fresh hit.
+
+    ``fresh`` overrides the cache's own (age based) idea of whether an entry is fresh.
+    """
+    headers = dict(headers)
+    headers.setdefault("Accept-Encoding", "gzip, deflate")
+    entry = None
+    if cache is not None:
+        entry = cache.get(key)
+        if entry is not None:
+            if fresh or fresh is None and cache.is_fresh(entry):
+                return headers, entry, loads(entry["body"], entry["charset"])
+            headers.update(cache.validators(entry))
+    return headers, entry, None
+
+
+def _json_from_response(
+    key, response, cache=None, entry=None, extract=None, stats=None, loads=_loads
+):
+    """Decodes the JSON of a response, noting status, bytes and timings in ``stats``.
+
+    The body is decoded by ``loads(body, charset)``, unless it's parsed as it arrives.
+    """
+    stats = {} if stats is None else stats
+    code = stats["status"] = response.code
+    if code == 304 and entry is not None:
+        stats["cache"] = "revalidated"
+        cache.refresh(key, entry)
+        start = timer()
+        data = loads(entry["body"], entry["charset"])
+        stats["decode"] = timer() - start
+        return data
     if code != 200:
         err = LudditeError("Unexpected response code {}".format(code))
+        err.code = code
         err.response_data = response.read()
         raise err
-    raw_data = response.read()
+    content_encoding = response.headers.get("Content-Encoding")
     response_encoding = get_charset(response.headers)
-    decoded_data = raw_data.decode(response_encoding)
-    data = json.loads(decoded_data)
+    start = timer()
+    if extract is not None:
+        # reading and decoding are interleaved, it all counts as decoding
+        text = _iter_text(response, response_encoding, content_encoding, stats=stats)
+        try:
+            data = extract_json(text, extract)
+        except Exception:
+            # the rest of the body isn't wanted, and the connection can't be reused
+            response.close()
+            raise
+        raw_data = json.dumps(data).encode("utf-8")
+        response_encoding = "utf-8"
+    else:
+        body = response.read()
+        stats["bytes"] = len(body)
+        stats["read"] = timer() - start
+        start = timer()
+        raw_data = _decompress(body, content_encoding)
+        data = None
+    decode_time = timer() - start
+    if cache is not None:
+        cache.set(
+            key,
+            raw_data,
+            charset=response_encoding,
+            etag=response.headers.get("ETag"),
+            last_modified=response.headers.get("Last-Modified"),
+        )
+    if data is None:
+        start = timer()
+        data = loads(raw_data, response_encoding)
+        decode_time += timer() - start
+    stats["decode"] = decode_time
     return data
 
 
-def get_data_pypi(name, index=DEFAULT_INDEX):
-    uri = "{}/{}/json".format(index.rstrip("/"), name.split("[")[0])
-    data = json_get(uri)
+# responses which mean "not right now" - the request is retried after a backoff
+RETRY_STATUSES = (429, 502, 503, 504)
+MAX_RETRIES = 3
+
+
+def retry_after(headers, now=None, limit=60):
+    """Seconds to wait according to a Retry-After header (delay-seconds or HTTP-date)"""
+    value = (headers or {}).get("Retry-After")
+    if not value:
+        return None
+    value = value.strip()
+    if value.isdigit():
+        return min(int(value), limit)
+    date = parsedate_tz(value)
+    if date is None:
+        return None
+    now = time.time() if now is None else now
+    return min(max(mktime_tz(date) - now, 0), limit)
+
+
+def backoff_delay(attempt, wait=None, base=0.25, cap=10):
+    """How long to wait before retry number ``attempt`` (counting from 0).
+
+    A Retry-After ``wait`` from the index wins, otherwise it's exponential backoff with
+    "full jitter", so that lookups throttled together don't all come back together.
+    """
+    if wait is not None:
+        return wait
+    return random.uniform(0, min(cap, base * 2 ** attempt))
+
+
+class Throttle(object):
+    """Adapts the number of requests in flight to what the index can take (AIMD).
+
+    The limit grows by about one per round trip while responses come back quick, holds
+    while they're slow compared to the best seen so far, and is halved when the index
+    pushes back with a 429/503 or the connection fails. A Retry-After holds off all new
+    requests until then. ``acquire``/``release`` are for threads, an event loop can read
+    ``limit`` and ``wait_time`` and just ``record`` the outcomes.
+    """
+
+    def __init__(self, initial=4, minimum=1, maximum=64, latency_tolerance=4.0):
+        self.minimum = minimum
+        self.maximum = maximum
+        self.limit = float(max(minimum, min(initial, maximum)))
+        self.latency_tolerance = latency_tolerance
+        self.active = 0
+        self.best_latency = None
+        self._resume_at = 0
+        self._last_decrease = 0
+        self._cond = threading.Condition()
+
+    def wait_time(self):
+        """Seconds until new requests may start, as requested with a Retry-After"""
+        return max(self._resume_at - time.time(), 0)
+
+    def record(self, latency, ok=True, wait=None):
+        with self._cond:
+            now = time.time()
+            if wait:
+                self._resume_at = max(self._resume_at, now + wait)
+            if not ok:
+                # only back off once per round trip, not for every request which was in flight
+                if now - self._last_decrease > (self.best_latency or latency):
+                    self.limit = max(self.minimum, self.limit / 2)
+                    self._last_decrease = now
+            else:
+                if self.best_latency is None or latency < self.best_latency:
+                    self.best_latency = latency
+                if latency <= self.best_latency * self.latency_tolerance:
+                    self.limit = min(self.maximum, self.limit + 1 / self.limit)
+            self._cond.notify_all()
+
+    def acquire(self):
+        """Blocks until another request may start, and returns its start time"""
+        with self._cond:
+            while True:
+                wait = self.wait_time()
+                if not wait and self.active < int(self.limit):
+                    break
+                self._cond.wait(wait or None)
+            self.active += 1
+        return time.time()
+
+    def release(self, started, ok=True, wait=None):
+        with self._cond:
+            self.active -= 1
+        self.record(time.time() - started, ok, wait)
+
+
+def _open(opener, request, throttle=None, retries=MAX_RETRIES):
+    """Opens a request, retrying transient failures with a jittered backoff"""
+    for attempt in range(retries + 1):
+        if _cancelled():
+            raise LookupCancelled("Request called off")
+        started = throttle.acquire() if throttle is not None else None
+        response = error = None
+        try:
+            response = opener(request)
+        except HTTPError as err:
+            response = error = err
+        except (EnvironmentError, HTTPException) as err:
+            error = err
+        transient = response is None or response.code in RETRY_STATUSES
+        wait = retry_after(response.headers) if transient and response is not None else None
+        if throttle is not None:
+            # a request broken off on purpose says nothing about the index
+            throttle.release(started, ok=not transient or _cancelled(), wait=wait)
+        if not transient or attempt == retries or _cancelled():
+            break
+        if isinstance(error, socket.timeout):
+            # the index is hanging, asking again would only hang as long again
+            break
+        if error is None:
+            # frees up the pooled connection
+            response.read()
+        time.sleep(backoff_delay(attempt, wait))
+    if error is not None:
+        raise error
+    return response
+
+
+@contextmanager
+def _timed(profile, phase):
+    """Adds the time spent in the block to a phase of the ``profile`` - a no-op for None"""
+    if profile is None:
+        yield
+        return
+    start = timer()
+    try:
+        yield
+    finally:
+        profile.add(phase, timer() - start)
+
+
+class Profile(object):
+    """Where the time of a run went, collected with ``--profile`` or ``Luddite(profile=...)``.
+
+    ``lookups`` holds a ``LookupProfile`` for each project fetched, ``requests`` a dict
+    for each HTTP request (url, status, cache, bytes and seconds: in total, waiting for
+    the response, reading and decoding it). ``phases`` maps each phase to its count and
+    total seconds - "index_url", "probe", "connect", "wait", "read", "decode", "parse",
+    "lookup" and "process" (checking a requirements line against its versions).
+    """
+
+    phase_order = (
+        "index_url",
+        "probe",
+        "connect",
+        "wait",
+        "read",
+        "decode",
+        "parse",
+        "lookup",
+        "process",
+    )
+
+    def __init__(self):
+        self.lookups = []
+        self.requests = []
+        self.phases = {}
+        self.started = timer()
+        self.finished = None
+        self._lock = threading.Lock()
+
+    def add(self, phase, seconds):
+        with self._lock:
+            count, total = self.phases.get(phase, (0, 0.0))
+            self.phases[phase] = count + 1, total + seconds
+
+    def add_request(self, **fields):
+        with self._lock:
+            self.requests.append(fields)
+        for phase in "wait", "read", "decode":
+            if fields.get(phase) is not None:
+                self.add(phase, fields[phase])
+
+    def start_lookup(self, name, index):
+        return LookupProfile(self, name, index)
+
+    def _add_lookup(self, lookup):
+        with self._lock:
+            self.lookups.append(lookup)
+        self.add("lookup", lookup.seconds)
+
+    def finish(self):
+        self.finished = timer()
+
+    def as_dict(self):
+        """Everything collected, as a JSON-friendly dict with the slowest lookups first"""
+        wall = (self.finished or timer()) - self.started
+        caches = {}
+        statuses = {}
+        for request in self.requests:
+            if request.get("cache"):
+                caches[request["cache"]] = caches.get(request["cache"], 0) + 1
+            status = str(request.get("status"))
+            statuses[status] = statuses.get(status, 0) + 1
+        lookups = sorted(self.lookups, key=lambda lookup: -lookup.seconds)
+        return {
+            "wall": wall,
+            "requests": len(self.requests),
+            "bytes": sum(request.get("bytes") or 0 for request in self.requests),
+            "cache": caches,
+            "status": statuses,
+            "phases": dict(
+                (phase, {"count": count, "seconds": total})
+                for phase, (count, total) in self.phases.items()
+            ),
+            "lookups": [lookup.as_dict() for lookup in lookups],
+        }
+
+    def to_json(self, **kwargs):
+        return json.dumps(self.as_dict(), sort_keys=True, **kwargs)
+
+    def report(self, top=10):
+        """Prints the phase breakdown and the ``top`` slowest lookups"""
+        data = self.as_dict()
+        print("---" + "{:-<77}".format("profile"))
+        msg = "   {:.3f}s wall, {} requests, {:.1f} kB"
+        print(msg.format(data["wall"], data["requests"], data["bytes"] / 1024.0), end="")
+        if data["cache"]:
+            cache = ", ".join("{} {}".format(n, k) for k, n in sorted(data["cache"].items()))
+            print(" (cache: {})".format(cache), end="")
+        print()
+        print("   {:<12}{:>8}{:>12}{:>12}".format("phase", "count", "total s", "mean ms"))
+        for phase in self.phase_order:
+            if phase in self.phases:
+                count, total = self.phases[phase]
+                mean_ms = total / count * 1000
+                print("   {:<12}{:>8}{:>12.3f}{:>12.1f}".format(phase, count, total, mean_ms))
+        if data["lookups"]:
+            print("   slowest lookups:")
+        for lookup in data["lookups"][:top]:
+            n_requests = len(lookup["requests"])
+            details = "{} requests, {:.1f} kB".format(n_requests, lookup["bytes"] / 1024.0)
+            if lookup["error"]:
+                details += ", " + lookup["error"]
+            print("   {:>8.3f}s  {} ({})".format(lookup["seconds"], lookup["name"], details))
+
+
+class LookupProfile(object):
+    """The timings and requests of one project lookup, part of a ``Profile``"""
+
+    def __init__(self, profile, name, index):
+        self.profile = profile
+        self.name = name
+        self.index = index
+        self.requests = []
+        self.seconds = None
+        self.error = None
+        self._start = timer()
+
+    def add(self, phase, seconds):
+        self.profile.add(phase, seconds)
+
+    def add_request(self, **fields):
+        self.requests.append(fields)
+        self.profile.add_request(**fields)
+
+    def finish(self, error=None):
+        self.seconds = timer() - self._start
+        if error is not None:
+            self.error = "{}: {}".format(type(error).__name__, error)
+        self.profile._add_lookup(self)
+
+    @property
+    def bytes(self):
+        return sum(request.get("bytes") or 0 for request in self.requests)
+
+    def as_dict(self):
+        return {
+            "name": self.name,
+            "index": self.index,
+            "seconds": self.seconds,
+            "bytes": self.bytes,
+            "error": self.error,
+            "requests": self.requests,
+        }
+
+
+def json_get(
+    url,
+    headers=(("Accept", "application/json"),),
+    cache=None,
+    pool=None,
+    extract=None,
+    throttle=None,
+    profile=None,
+    timeout=None,
+    fresh=None,
+    loads=_loads,
+    stats=None,
+):
+    """Fetches and decodes a JSON document.
+
+    With ``extract`` (see ``extract_json``) the response is parsed incrementally as it
+    arrives, and only the wanted values are kept. Responses like 429 and 503 are retried,
+    paced by the ``throttle`` if there is one. The request is recorded in ``profile``.
+    ``timeout`` is for when there's no ``pool``, which has its own timeouts. ``fresh``
+    says whether a cached copy can be used as is, if not up to the cache (its age).
+    ``loads(body, charset)`` decodes the response body, or a cached copy of it.
+    The request's status, cache outcome and timings are noted in ``stats``.
+    """
+    start = timer()
+    stats = {} if stats is None else stats
+    stats["url"] = url
+    key = _cache_key(url, extract)
+    headers, entry, data = _cached_json(key, headers, cache, fresh, loads)
+    if data is not None:
+        stats["cache"] = "hit"
+        if profile is not None:
+            seconds = timer() - start
+            profile.add_request(url=url, cache="hit", bytes=0, seconds=seconds, decode=seconds)
+        return data
+    stats["cache"] = None if cache is None else "stale" if entry else "miss"
+    request = Request(url=url, headers=headers)
+    if pool is not None:
+        opener = partial(pool.urlopen, stream=extract is not None, profile=profile)
+    else:
+        opener = urlopen if timeout is None else partial(urlopen, timeout=timeout)
+    try:
+        try:
+            response = _open(opener, request, throttle)
+        except HTTPError as err:
+            stats["status"] = err.code
+            # urllib treats a 304 as an error, but for a revalidation it's a cache hit
+            if err.code != 304 or entry is None:
+                raise
+            response = err
+        stats["wait"] = timer() - start
+        return _json_from_response(key, response, cache, entry, extract, stats, loads)
+    finally:
+        if profile is not None:
+            stats["seconds"] = timer() - start
+            profile.add_request(**stats)
+
+
+def _pypi_uri(name, index):
+    return "{}/{}/json".format(index.rstrip("/"), name.split("[")[0])
+
+
+def get_data_pypi(name, index=DEFAULT_INDEX, **kwargs):
+    uri = _pypi_uri(name, index)
+    data = json_get(uri, **kwargs)
     return data
 
 
@@ -104,20 +1141,273 @@ def _safe_version(v):
         pass
 
 
-def get_versions_pypi(name, index=DEFAULT_INDEX):
-    data = get_data_pypi(name, index)
+class VersionIndex(tuple):
+    """The version strings of a project in ascending order, parsed once and shared.
+
+    Besides being a plain tuple of strings, it keeps the parsed ``Version`` objects
+    alongside (``parsed``), has the ``latest`` and ``latest_non_pre`` versions
+    precomputed, and does membership checks with a set lookup. Pickled, it's just
+    the strings, so it comes back from a process pool cheaply; the ``Version``
+    objects are parsed again only if they're needed.
+    """
+
+    def __new__(cls, versions=(), parsed=None, latest_non_pre=None):
+        self = super(VersionIndex, cls).__new__(cls, versions)
+        self._parsed = None if parsed is None else tuple(parsed)
+        self._members = frozenset(self)
+        self.latest = self[-1] if self else None
+        self.latest_non_pre = latest_non_pre or self.latest
+        if latest_non_pre is None:
+            for raw_version, version in zip(reversed(self), reversed(self.parsed)):
+                if not version.is_prerelease:
+                    self.latest_non_pre = raw_version
+                    break
+        return self
+
+    @property
+    def parsed(self):
+        if self._parsed is None:
+            self._parsed = tuple(Version(v) for v in self)
+        return self._parsed
+
+    def __reduce__(self):
+        return VersionIndex, (tuple(self), None, self.latest_non_pre)
+
+    @classmethod
+    def from_pairs(cls, pairs):
+        """From unsorted (Version, version string) pairs"""
+        pairs = sorted(pairs)
+        return cls([raw for _, raw in pairs], [v for v, _ in pairs])
+
+    def __contains__(self, version):
+        return version in self._members
+
+    def newest(self, specifier):
+        """The newest version a ``SpecifierSet`` allows, or None.
+
+        Bisecting on the parsed versions narrows them down to those the specifiers
+        could allow, which are then checked from the newest down until one is allowed,
+        so it's usually a check or two however long the history is. Like pip, a
+        pre-release is only the answer if asked for, or if nothing else is allowed.
+        """
+        parsed = self.parsed
+        lo, hi = 0, len(parsed)
+        for spec in specifier:
+            spec_lo, spec_hi = _spec_bounds(spec, parsed)
+            lo, hi = max(lo, spec_lo), min(hi, spec_hi)
+        pre = None
+        for i in range(hi - 1, lo - 1, -1):
+            if specifier.contains(parsed[i], prereleases=True):
+                if specifier.prereleases or not parsed[i].is_prerelease:
+                    return self[i]
+                if pre is None:
+                    pre = self[i]
+        return pre
+
+
+def _series(prefix, step=0):
+    """The first version of a release series, e.g. 1.4.dev0 for "1.4" (1.5.dev0 with step=1)"""
+    release = prefix.release[:-1] + (prefix.release[-1] + step,)
+    return Version("{}!{}.dev0".format(prefix.epoch, ".".join(str(n) for n in release)))
+
+
+def _through(parsed, version):
+    """Like ``bisect_right``, but past the local versions of ``version`` (1.0+abc) too"""
+    hi = bisect_right(parsed, version)
+    public = Version(version.public)
+    while hi < len(parsed) and parsed[hi].local and Version(parsed[hi].public) == public:
+        hi += 1
+    return hi
+
+
+def _spec_bounds(spec, parsed):
+    """(lo, hi) - all the versions a ``Specifier`` allows are within ``parsed[lo:hi]``"""
+    op, raw = spec.operator, spec.version
+    lo, hi = 0, len(parsed)
+    try:
+        version = Version(raw[:-2] if raw.endswith(".*") else raw)
+    except InvalidVersion:
+        # "===" compares strings, anything goes
+        return lo, hi
+    if raw.endswith(".*"):
+        plain = version.public == version.base_version
+        if op == "==" and plain:
+            lo = bisect_left(parsed, _series(version))
+            hi = bisect_left(parsed, _series(version, step=1))
+    elif op == "==":
+        lo, hi = bisect_left(parsed, version), _through(parsed, version)
+    elif op == "<=":
+        hi = _through(parsed, version)
+    elif op == "<":
+        hi = bisect_left(parsed, version)
+    elif op == ">=":
+        lo = bisect_left(parsed, version)
+    elif op == ">":
+        lo = bisect_right(parsed, version)
+    elif op == "~=":
+        lo = bisect_left(parsed, version)
+        prefix = Version("{}!{}".format(version.epoch, ".".join(map(str, version.release[:-1]))))
+        hi = bisect_left(parsed, _series(prefix, step=1))
+    return lo, hi
+
+
+def _parse_versions_pypi(data):
     versions = []
     for raw_version, details in data["releases"].items():
         version = _safe_version(raw_version)
         if version is not None:
             if any(not d.get("yanked", False) for d in details):
                 versions.append((version, raw_version))
-    versions.sort()
-    return tuple(v for (_, v) in versions)
+    return VersionIndex.from_pairs(versions)
+
+
+def _simple_uri(name, index):
+    """PEP 691 project page, for indexes which look like they serve the simple API"""
+    root = index.rstrip("/")
+    if root.endswith("/pypi"):
+        root = root[: -len("/pypi")] + "/simple"
+    elif not root.endswith("/simple"):
+        return None
+    return "{}/{}/".format(root, canonicalize_name(name.split("[")[0]))
+
+
+def _version_from_filename(filename):
+    if filename.endswith((".whl", ".egg")):
+        parts = filename.split("-")
+        return parts[1] if len(parts) > 2 else None
+    for ext in ".tar.gz", ".tar.bz2", ".tar.xz", ".tgz", ".tar", ".zip":
+        if filename.endswith(ext):
+            _name, sep, version = filename[: -len(ext)].rpartition("-")
+            return version if sep else None
+
+
+def _parse_versions_simple(data):
+    # a release is listed unless every one of its files was yanked, same as the JSON API
+    yanked = {}
+    for details in data["files"]:
+        version = _safe_version(_version_from_filename(details["filename"]) or "")
+        if version is not None:
+            yanked[version] = yanked.get(version, True) and bool(details.get("yanked"))
+    versions = []
+    for raw_version in data["versions"]:
+        version = _safe_version(raw_version)
+        if version is not None and yanked.get(version) is False:
+            versions.append((version, raw_version))
+    return VersionIndex.from_pairs(versions)
+
+
+# endpoints a worker may get versions from, most preferred first:
+# (uri, Accept, parser, the parts of the document the parser needs)
+PYPI_ENDPOINTS = (
+    (
+        _simple_uri,
+        "application/vnd.pypi.simple.v1+json",
+        _parse_versions_simple,
+        (("versions",), ("files", "*", "filename"), ("files", "*", "yanked")),
+    ),
+    (_pypi_uri, "application/json", _parse_versions_pypi, (("releases", "*", "*", "yanked"),)),
+)
+_unsupported_endpoints = set()
+
+
+def _candidates(endpoints, name, index):
+    """(uri, uri_func, accept, parse) for each endpoint worth trying"""
+    candidates = []
+    for uri_func, accept, parse, paths in endpoints:
+        uri = uri_func(name, index)
+        if uri is not None and (index, uri_func) not in _unsupported_endpoints:
+            candidates.append((uri, uri_func, accept, parse, paths))
+    return candidates
+
+
+def _is_current(changelog, endpoints, name, index):
+    """Whether cached responses for a project are still current, by the ``changelog``.
+
+    None (no changelog) leaves it to the age of the cached responses.
+    """
+    if changelog is None:
+        return None
+    flavor = "devpi" if endpoints is DEVPI_ENDPOINTS else "pypi"
+    return changelog.is_current(index, name, flavor)
+
+
+def decode_versions(parse, body, charset):
+    """Decodes a JSON document and gets the versions out of it with ``parse``.
+
+    This is the CPU bound part of a lookup, which a ``decoder`` process pool does:
+    the arguments are plain bytes and a module level function, and the ``VersionIndex``
+    returned pickles as just the version strings, so they're cheap to send over.
+    """
+    return parse(_loads(body, charset))
+
+
+def _decode_in(decoder, parse, body, charset):
+    return decoder.submit(decode_versions, parse, body, charset).result()
+
 
+def _get_versions(
+    endpoints, name, index, stream=False, profile=None, changelog=None, decoder=None, **kwargs
+):
+    """Tries the endpoints in order, remembering which ones the index doesn't support.
 
-def get_version_pypi(name, index=DEFAULT_INDEX):
-    latest = get_data_pypi(name, index)["info"]["version"]
+    With ``stream=True`` documents are parsed as they arrive, keeping only what the
+    parser needs, so that huge release histories don't have to be held in memory.
+    Otherwise the JSON decoding and version parsing can be done by a ``decoder``
+    executor (e.g. a process pool, to get past the GIL), see ``decode_versions``.
+    """
+    candidates = _candidates(endpoints, name, index)
+    fresh = _is_current(changelog, endpoints, name, index)
+    lookup = None if profile is None else profile.start_lookup(name, index)
+    error = None
+    try:
+        for i, (uri, uri_func, accept, parse, paths) in enumerate(candidates):
+            extract = paths if stream else None
+            headers = (("Accept", accept),)
+            loads = _loads
+            if decoder is not None and extract is None:
+                # the decoder's result is the versions, not the document
+                loads = partial(_decode_in, decoder, parse)
+            stats = {}
+            try:
+                data = json_get(
+                    uri,
+                    headers=headers,
+                    extract=extract,
+                    profile=lookup,
+                    fresh=fresh,
+                    loads=loads,
+                    stats=stats,
+                    **kwargs
+                )
+                if loads is _loads:
+                    with _timed(lookup, "parse"):
+                        versions = parse(data)
+                else:
+                    versions = data
+                if changelog is not None and stats["cache"] != "hit":
+                    # only what the index said in this run is current as of its serial
+                    changelog.looked_up(index, name)
+                return versions
+            except Exception as err:
+                if i == len(candidates) - 1 or _cancelled():
+                    raise
+                if isinstance(err, (ValueError, KeyError)):
+                    # not the format we asked for, e.g. an HTML page, so don't ask again
+                    _unsupported_endpoints.add((index, uri_func))
+    except Exception as err:
+        error = err
+        raise
+    finally:
+        if lookup is not None:
+            lookup.finish(error)
+
+
+def get_versions_pypi(name, index=DEFAULT_INDEX, **kwargs):
+    return _get_versions(PYPI_ENDPOINTS, name, index, **kwargs)
+
+
+def get_version_pypi(name, index=DEFAULT_INDEX, **kwargs):
+    latest = get_data_pypi(name, index, **kwargs)["info"]["version"]
     return latest
 
 
@@ -129,42 +1419,89 @@ def strip_suffixes(s, *suffixes):
     return s
 
 
-def get_data_devpi(name, index):
+def _devpi_uri(name, index):
     index = strip_suffixes(index, "+simple/", "+simple")
-    uri = "{}/{}".format(index.rstrip("/"), name.split("[")[0])
-    data = json_get(uri)
+    return "{}/{}".format(index.rstrip("/"), name.split("[")[0])
+
+
+def get_data_devpi(name, index, **kwargs):
+    uri = _devpi_uri(name, index)
+    data = json_get(uri, **kwargs)
     return data
 
 
-def get_versions_devpi(name, index):
-    data = get_data_devpi(name, index)
+def _parse_versions_devpi(data):
     versions = []
     for raw_version, details in data["result"].items():
         version = _safe_version(raw_version)
         if version is not None:
             versions.append((version, raw_version))
-    versions.sort()
-    return tuple(v for (_, v) in versions)
+    return VersionIndex.from_pairs(versions)
 
 
-def get_version_devpi(name, index):
-    latest = get_versions_devpi(name, index)[-1]
+# only the keys of "result" are needed, the yanked flag is just the smallest thing in there
+DEVPI_ENDPOINTS = (
+    (_devpi_uri, "application/json", _parse_versions_devpi, (("result", "*", "yanked"),)),
+)
+
+
+def get_versions_devpi(name, index, **kwargs):
+    return _get_versions(DEVPI_ENDPOINTS, name, index, **kwargs)
+
+
+def get_version_devpi(name, index, **kwargs):
+    latest = get_versions_devpi(name, index, **kwargs)[-1]
     return latest
 
 
+def _pip_config_files():
+    """The config files ``pip config get`` would read, lowest precedence first"""
+    config_file = os.environ.get("PIP_CONFIG_FILE")
+    if config_file == os.devnull:
+        return []
+    home = os.path.expanduser("~")
+    if sys.platform == "win32":
+        program_data = os.environ.get("ALLUSERSPROFILE", "C:\\ProgramData")
+        app_data = os.environ.get("APPDATA", home)
+        global_files = [os.path.join(program_data, "pip", "pip.ini")]
+        user_files = [os.path.join(app_data, "pip", "pip.ini")]
+        site_file = os.path.join(sys.prefix, "pip.ini")
+    else:
+        xdg_dirs = os.environ.get("XDG_CONFIG_DIRS") or "/etc/xdg"
+        global_files = [os.path.join(d, "pip", "pip.conf") for d in xdg_dirs.split(os.pathsep)]
+        global_files.append("/etc/pip.conf")
+        xdg_home = os.environ.get("XDG_CONFIG_HOME") or os.path.join(home, ".config")
+        user_files = [os.path.join(home, ".pip", "pip.conf")]
+        if sys.platform == "darwin":
+            user_files.append(os.path.join(home, "Library", "Application Support", "pip", "pip.conf"))
+        user_files.append(os.path.join(xdg_home, "pip", "pip.conf"))
+        site_file = os.path.join(sys.prefix, "pip.conf")
+    files = global_files[::-1]
+    if not (config_file and os.path.exists(config_file)):
+        files += user_files
+    files.append(site_file)
+    if config_file:
+        files.append(config_file)
+    return files
+
+
 def get_index_url(default=DEFAULT_INDEX):
-    args = [sys.executable] + "-m pip config get global.index-url".split()
-    with open(os.devnull, "w") as shh:
-        try:
-            output = subprocess.check_output(args, stderr=shh)
-        except subprocess.CalledProcessError:
-            # this is not working for older versions pip < 10.0.0
-            return default
-        else:
-            return output.decode().strip() or default
+    """The index pip would use, read from PIP_INDEX_URL or pip's config files"""
+    env_index = os.environ.get("PIP_INDEX_URL")
+    if env_index:
+        return env_index
+    parser = RawConfigParser()
+    try:
+        parser.read(_pip_config_files())
+    except ConfigParserError:
+        return default
+    for option in "index-url", "index_url":
+        if parser.has_option("global", option):
+            return parser.get("global", option).strip() or default
+    return default
 
 
-def guess_index_type(index_url):
+def guess_index_type(index_url, pool=None, timeout=None):
     index_url = strip_suffixes(index_url, "+simple/", "+simple")
     try:
         request = Request(index_url, method="HEAD")
@@ -172,7 +1509,11 @@ def guess_index_type(index_url):
         # Python 2
         request = Request(index_url)
         request.get_method = lambda: "HEAD"
-    response = urlopen(request)
+    if pool is not None:
+        opener = pool.urlopen
+    else:
+        opener = urlopen if timeout is None else partial(urlopen, timeout=timeout)
+    response = opener(request)
     if response.code != 200:
         err = LudditeError("Unexpected response code {}".format(response.code))
         err.response_data = response.read()
@@ -183,49 +1524,1072 @@ def guess_index_type(index_url):
     return "pypi"
 
 
-def choose_worker(index_url):
-    choices = {"pypi": get_versions_pypi, "devpi": get_versions_devpi}
-    index_type = guess_index_type(index_url)
-    func = choices.get(index_type, get_versions_pypi)
-    return func
+class IndexTypeCache(object):
+    """Remembers the detected type of each index for ``ttl`` seconds, in a JSON file"""
 
+    def __init__(self, path=os.path.join(DEFAULT_CACHE_DIR, "index-types.json"), ttl=24 * 60 * 60):
+        self.path = str(path)
+        self.ttl = ttl
+        self._lock = threading.Lock()
 
-result_map = {
-    # string template: color
-    "noop": ("", None),
-    "skip": ("? skipped a line: {stripped}", "magenta"),
-    "pass": ("✔ {req.name} is up to date @ {latest}", "green"),
-    "warn": ("! {req.name} {version} will be outdated soon (index has {latest})", "yellow"),
-    "gone": ("! {req.name} {version} is not in the index {from_versions}", "yellow"),
-    "free": ("! {req.name} appears unpinned?", "yellow"),
-    "fail": ("✖ {req.name} {version} (index has {latest_non_pre})", "red"),
-    "oops": ("💩 couldn't get {req.name}, sorry ({error})", "magenta"),
-}
+    def _load(self):
+        try:
+            with open(self.path) as f:
+                return json.load(f)
+        except (IOError, OSError, ValueError):
+            return {}
 
+    def get(self, index_url):
+        entry = self._load().get(index_url)
+        if entry is not None and 0 <= time.time() - entry["stored"] < self.ttl:
+            return entry["type"]
 
-class RequirementsLine(object):
-    def __init__(self, text, line_number=None):
-        self.text = text
-        self.line_number = line_number
-        line, _sep, _comment = text.partition(" #")
-        line = line.strip()
-        self.stripped = "" if line.startswith("#") else line
-        self.req = None
-        self.version = None
-        self.from_versions = ""
-        if self.stripped:
+    def set(self, index_url, index_type):
+        with self._lock:
+            data = self._load()
+            data[index_url] = {"type": index_type, "stored": time.time()}
+            dirname = os.path.dirname(self.path)
             try:
-                self.req = Requirement(self.stripped)
-            except (InvalidRequirement, ValueError):
+                if dirname and not os.path.isdir(dirname):
+                    os.makedirs(dirname)
+                tmp = "{}.{}".format(self.path, os.getpid())
+                with open(tmp, "w") as f:
+                    json.dump(data, f)
+                getattr(os, "replace", os.rename)(tmp, self.path)
+            except (IOError, OSError):
+                # it's only a cache
                 pass
-            else:
+
+
+def _xmlrpc(url, method, params=(), timeout=None):
+    body = xmlrpc_dumps(tuple(params), method).encode("utf-8")
+    request = Request(url, data=body, headers={"Content-Type": "text/xml"})
+    response = urlopen(request) if timeout is None else urlopen(request, timeout=timeout)
+    (result,), _method = xmlrpc_loads(response.read())
+    return result
+
+
+class ChangeLog(object):
+    """Keeps cached index responses current by the index's event serial, not their age.
+
+    Once per run, each index is asked what changed since the serial it was last synced
+    at - PyPI's XML-RPC ``changelog_since_serial``, or for devpi, whether its
+    ``X-Devpi-Serial`` moved at all. Cached responses of projects looked up at that serial
+    and unchanged since are used as they are, the others are revalidated. The serial each
+    project was looked up at is kept in a JSON file.
+    """
+
+    # PyPI returns at most this many events, later ones are picked up next time
+    max_events = 50000
+
+    def __init__(self, path=os.path.join(DEFAULT_CACHE_DIR, "serials.json"), timeout=10):
+        self.path = str(path)
+        self.timeout = timeout
+        self._state = None
+        self._synced = {}  # index: (serial now, names changed since the last sync or None)
+        self._looked_up = {}
+        self._lock = threading.Lock()
+
+    def _load(self):
+        if self._state is None:
+            try:
+                with open(self.path) as f:
+                    self._state = json.load(f)
+            except (IOError, OSError, ValueError):
+                self._state = {}
+        return self._state
+
+    def _changes_pypi(self, index, since):
+        url = index.rstrip("/")
+        if since is None:
+            return _xmlrpc(url, "changelog_last_serial", timeout=self.timeout), None
+        events = _xmlrpc(url, "changelog_since_serial", [since], timeout=self.timeout)
+        if not events:
+            return since, set()
+        # (name, version, timestamp, action, serial)
+        serial = max(event[4] for event in events)
+        if len(events) >= self.max_events:
+            return serial, None
+        return serial, set(canonicalize_name(event[0]) for event in events)
+
+    def _changes_devpi(self, index, since):
+        request = Request(index, headers={"Accept": "application/json"})
+        request.get_method = lambda: "HEAD"
+        response = urlopen(request, timeout=self.timeout)
+        serial = int(response.headers["X-Devpi-Serial"])
+        return serial, set() if serial == since else None
+
+    def sync(self, index, flavor="pypi"):
+        """(serial, names changed since the last sync) - asks the index once per run"""
+        with self._lock:
+            if index not in self._synced:
+                since = self._load().get(index, {}).get("serial")
+                changes = self._changes_devpi if flavor == "devpi" else self._changes_pypi
+                try:
+                    self._synced[index] = changes(index, since)
+                except Exception:
+                    # no changelog to be had (e.g. a plain simple index), so no shortcuts
+                    self._synced[index] = None, None
+            return self._synced[index]
+
+    def is_current(self, index, name, flavor="pypi"):
+        """Whether the cached responses for a project can be used without asking the index.
+
+        None if the changelog can't tell (no changelog to be had, the first run, too many
+        changes), which leaves it to the age of the cached responses.
+        """
+        _serial, changed = self.sync(index, flavor)
+        if changed is None:
+            return None
+        name = canonicalize_name(name)
+        if name in changed:
+            return False
+        state = self._load().get(index, {})
+        if state.get("projects", {}).get(name) == state.get("serial"):
+            return True
+        return None
+
+    def looked_up(self, index, name):
+        """Notes that a project's versions are current as of this run's serial"""
+        with self._lock:
+            self._looked_up.setdefault(index, set()).add(canonicalize_name(name))
+
+    def save(self):
+        with self._lock:
+            state = self._load()
+            for index, (serial, changed) in self._synced.items():
+                old = state.pop(index, {})
+                if serial is None:
+                    # the index couldn't be asked this time, what was known still holds
+                    if old:
+                        state[index] = old
+                    continue
+                projects = {}
+                if changed is not None:
+                    # current at the last sync and unchanged since, so still current now
+                    for name, looked_up_at in old["projects"].items():
+                        if looked_up_at == old["serial"] and name not in changed:
+                            projects[name] = serial
+                for name in self._looked_up.get(index, ()):
+                    projects[name] = serial
+                state[index] = {"serial": serial, "projects": projects}
+            dirname = os.path.dirname(self.path)
+            try:
+                if dirname and not os.path.isdir(dirname):
+                    os.makedirs(dirname)
+                tmp = "{}.{}".format(self.path, os.getpid())
+                with open(tmp, "w") as f:
+                    json.dump(state, f)
+                getattr(os, "replace", os.rename)(tmp, self.path)
+            except (IOError, OSError):
+                pass
+
+
+def _not_hosted(err):
+    """whether a lookup failed because the index doesn't have the project at all"""
+    return getattr(err, "code", None) in (404, 410)
+
+
+class NotFoundCache(object):
+    """Remembers which projects an index doesn't have, for ``ttl`` seconds.
+
+    It's kept in memory, and in a JSON file at ``path`` (if there is one) when saved.
+    """
+
+    def __init__(self, path=None, ttl=60 * 60):
+        self.path = None if path is None else str(path)
+        self.ttl = ttl
+        self._entries = None  # "index name": when it was found missing
+        self._lock = threading.Lock()
+
+    def _load(self):
+        if self._entries is None:
+            self._entries = {}
+            if self.path is not None:
+                try:
+                    with open(self.path) as f:
+                        self._entries = json.load(f)
+                except (IOError, OSError, ValueError):
+                    pass
+        return self._entries
+
+    @staticmethod
+    def _key(index, name):
+        return "{} {}".format(index, canonicalize_name(name))
+
+    def is_missing(self, index, name):
+        with self._lock:
+            stored = self._load().get(self._key(index, name))
+        return stored is not None and 0 <= time.time() - stored < self.ttl
+
+    def set_missing(self, index, name, missing=True):
+        with self._lock:
+            entries = self._load()
+            if missing:
+                entries[self._key(index, name)] = time.time()
+            else:
+                entries.pop(self._key(index, name), None)
+
+    def save(self):
+        if self.path is None:
+            return
+        with self._lock:
+            now = time.time()
+            entries = dict((k, t) for k, t in self._load().items() if 0 <= now - t < self.ttl)
+            dirname = os.path.dirname(self.path)
+            try:
+                if dirname and not os.path.isdir(dirname):
+                    os.makedirs(dirname)
+                tmp = "{}.{}".format(self.path, os.getpid())
+                with open(tmp, "w") as f:
+                    json.dump(entries, f)
+                getattr(os, "replace", os.rename)(tmp, self.path)
+            except (IOError, OSError):
+                pass
+
+
+def choose_worker(index_url, pool=None, type_cache=None, snapshot=None, profile=None):
+    if snapshot is not None:
+        # offline: the snapshot answers for every index, no probe needed
+        return snapshot
+    choices = {"pypi": get_versions_pypi, "devpi": get_versions_devpi}
+    index_type = None if type_cache is None else type_cache.get(index_url)
+    if index_type is None:
+        with _timed(profile, "probe"):
+            index_type = guess_index_type(index_url, pool=pool)
+        if type_cache is not None:
+            type_cache.set(index_url, index_type)
+    func = choices.get(index_type, get_versions_pypi)
+    return func
+
+
+class IndexProbe(object):
+    """A worker which picks the real worker with ``choose_worker`` in the background.
+
+    Lookups can be queued up straight away - they wait for the probe to finish,
+    instead of everything waiting for it up front.
+    """
+
+    def __init__(self, index_url, pool=None, type_cache=None, profile=None):
+        self.index_url = index_url
+        self._worker = None
+        self._error = None
+        self._done = threading.Event()
+        args = index_url, pool, type_cache, profile
+        thread = threading.Thread(target=self._probe, args=args, name="luddite-probe")
+        thread.daemon = True
+        thread.start()
+
+    def _probe(self, index_url, pool, type_cache, profile):
+        try:
+            self._worker = choose_worker(
+                index_url, pool=pool, type_cache=type_cache, profile=profile
+            )
+        except Exception as err:
+            self._error = err
+        finally:
+            self._done.set()
+
+    def done(self):
+        return self._done.is_set()
+
+    def result(self):
+        """The chosen worker - blocks until the probe has finished"""
+        self._done.wait()
+        if self._error is not None:
+            raise self._error
+        return self._worker
+
+    def __call__(self, name, index=None, **kwargs):
+        return self.result()(name, index=index, **kwargs)
+
+
+class MirrorGroup(object):
+    """A worker spreading lookups over equivalent mirrors, hedging against slow ones.
+
+    Each lookup goes to the next mirror in turn. If it hasn't been answered within the
+    ``percentile`` latency of recent lookups (``delay`` seconds until there are enough
+    of them), it's sent to another mirror as well, and the first good answer wins; the
+    other request is called off. Failed lookups go to the next mirror straight away.
+    """
+
+    min_samples = 20
+
+    def __init__(
+        self, mirrors, type_cache=None, percentile=95, delay=1.0, window=500, max_workers=32
+    ):
+        self.mirrors = list(mirrors)
+        self.type_cache = type_cache
+        self.percentile = percentile
+        self.delay = delay
+        self.window = window
+        self.executor = ThreadPoolExecutor(max_workers=max_workers)
+        self._workers = {}
+        self._latencies = []
+        self._turn = 0
+        self._lock = threading.Lock()
+
+    def hedge_delay(self):
+        """Seconds to wait for an answer before asking another mirror too"""
+        with self._lock:
+            latencies = sorted(self._latencies)
+        if len(latencies) < self.min_samples:
+            return self.delay
+        rank = int(len(latencies) * self.percentile / 100.0)
+        return latencies[min(rank, len(latencies) - 1)]
+
+    def _record(self, seconds):
+        with self._lock:
+            self._latencies.append(seconds)
+            del self._latencies[: -self.window]
+
+    def _worker_for(self, mirror, pool, profile):
+        with self._lock:
+            if mirror not in self._workers:
+                self._workers[mirror] = IndexProbe(
+                    mirror, pool=pool, type_cache=self.type_cache, profile=profile
+                )
+            return self._workers[mirror]
+
+    def _attempt(self, attempt, mirror, name, kwargs):
+        _attempts.current = attempt
+        try:
+            start = timer()
+            worker = self._worker_for(mirror, kwargs.get("pool"), kwargs.get("profile"))
+            versions = worker(name, index=mirror, **kwargs)
+            self._record(timer() - start)
+            return versions
+        finally:
+            _attempts.current = None
+
+    def __call__(self, name, index=None, **kwargs):
+        with self._lock:
+            first = self._turn % len(self.mirrors)
+            self._turn += 1
+        remaining = self.mirrors[first:] + self.mirrors[:first]
+        pending = {}
+        errors = []
+        delay = self.hedge_delay()
+        parent = getattr(_attempts, "current", None)
+
+        def ask_next():
+            attempt = _Attempt(parent)
+            future = self.executor.submit(self._attempt, attempt, remaining.pop(0), name, kwargs)
+            pending[future] = attempt
+
+        ask_next()
+        try:
+            while pending:
+                done = wait_futures(
+                    list(pending), delay if remaining else None, return_when=FIRST_COMPLETED
+                ).done
+                for future in done:
+                    del pending[future]
+                    if future.exception() is None:
+                        return future.result()
+                    errors.append(future.exception())
+                if remaining and (not done or not pending):
+                    # too slow, or failed
+                    ask_next()
+        finally:
+            pool = kwargs.get("pool")
+            for future, attempt in pending.items():
+                attempt.cancelled = True
+                future.cancel()
+                if pool is not None and hasattr(pool, "abort"):
+                    pool.abort(attempt)
+        raise errors[0]
+
+
+class IndexGroup(object):
+    """A worker looking projects up on several indexes at once, merging their versions.
+
+    As with pip's ``--extra-index-url``, a project may be on any of the ``indexes``, so
+    they're all asked at the same time, each with its own (probed) kind of worker unless
+    there's one in ``workers``. An index which doesn't have a project isn't asked about
+    it again while ``not_found`` remembers. Any other failure fails the whole lookup,
+    rather than give an answer which may be missing versions.
+    """
+
+    def __init__(self, indexes, type_cache=None, not_found=None, workers=None, max_workers=32):
+        self.indexes = list(indexes)
+        self.type_cache = type_cache
+        self.not_found = NotFoundCache() if not_found is None else not_found
+        self.executor = ThreadPoolExecutor(max_workers=max_workers)
+        self._workers = dict(workers or {})
+        self._lock = threading.Lock()
+
+    def _worker_for(self, index, pool, profile):
+        with self._lock:
+            if index not in self._workers:
+                self._workers[index] = IndexProbe(
+                    index, pool=pool, type_cache=self.type_cache, profile=profile
+                )
+            return self._workers[index]
+
+    def _lookup(self, index, name, kwargs):
+        worker = self._worker_for(index, kwargs.get("pool"), kwargs.get("profile"))
+        return worker(name, index=index, **kwargs)
+
+    def __call__(self, name, index=None, **kwargs):
+        indexes = [i for i in self.indexes if not self.not_found.is_missing(i, name)]
+        if not indexes:
+            raise LudditeError("{} is on none of the indexes".format(name))
+        futures = [self.executor.submit(self._lookup, i, name, kwargs) for i in indexes]
+        found = []
+        missing = []
+        try:
+            for index, future in zip(indexes, futures):
+                try:
+                    found.append(future.result())
+                except Exception as err:
+                    if not _not_hosted(err):
+                        raise
+                    missing.append(err)
+                    self.not_found.set_missing(index, name)
+                else:
+                    self.not_found.set_missing(index, name, missing=False)
+        finally:
+            for future in futures:
+                future.cancel()
+        if not found:
+            raise missing[0]
+        if len(found) == 1:
+            return found[0]
+        # the same version string means the same release, wherever it's from
+        versions = {}
+        for index_versions in found:
+            if not isinstance(index_versions, VersionIndex):
+                index_versions = VersionIndex(index_versions)
+            versions.update(zip(index_versions, index_versions.parsed))
+        return VersionIndex.from_pairs((v, raw) for raw, v in versions.items())
+
+
+class Snapshot(object):
+    """An offline copy of the version lists of many projects, in an SQLite file.
+
+    A snapshot is a worker itself: lookups are answered from the (read-only,
+    memory-mapped) database without touching the network. Write one with
+    ``take_snapshot``, or ``luddite snapshot`` on the command line.
+    """
+
+    mmap_size = 256 * 1024 * 1024
+    schema = (
+        "CREATE TABLE meta (key TEXT PRIMARY KEY, value TEXT)",
+        "CREATE TABLE projects (name TEXT PRIMARY KEY, versions TEXT NOT NULL) WITHOUT ROWID",
+    )
+
+    def __init__(self, path):
+        self.path = str(path)
+        if not os.path.isfile(self.path):
+            raise LudditeError("No snapshot at {}".format(self.path))
+        uri = "file:{}?mode=ro".format(pathname2url(os.path.abspath(self.path)))
+        try:
+            self._db = sqlite3.connect(uri, uri=True, check_same_thread=False)
+        except TypeError:
+            # Python 2
+            self._db = sqlite3.connect(self.path, check_same_thread=False)
+        self._db.execute("PRAGMA mmap_size = {:d}".format(self.mmap_size))
+        self._lock = threading.Lock()
+        meta = dict(self._db.execute("SELECT key, value FROM meta"))
+        self.index = meta.get("index")
+        self.created = float(meta.get("created", 0))
+
+    def __len__(self):
+        with self._lock:
+            [(n,)] = self._db.execute("SELECT COUNT(*) FROM projects")
+        return n
+
+    def close(self):
+        self._db.close()
+
+    @classmethod
+    def write(cls, path, projects, index=None):
+        """Writes (name, versions) pairs to a new snapshot, replacing any old one at ``path``"""
+        path = str(path)
+        tmp = "{}.{}".format(path, os.getpid())
+        if os.path.exists(tmp):
+            os.remove(tmp)
+        db = sqlite3.connect(tmp)
+        try:
+            for statement in cls.schema:
+                db.execute(statement)
+            meta = [("index", index), ("created", repr(time.time()))]
+            db.executemany("INSERT INTO meta VALUES (?, ?)", meta)
+            rows = ((canonicalize_name(name), "\n".join(versions)) for name, versions in projects)
+            db.executemany("INSERT OR REPLACE INTO projects VALUES (?, ?)", rows)
+            db.commit()
+        finally:
+            db.close()
+        getattr(os, "replace", os.rename)(tmp, path)
+        return cls(path)
+
+    def __call__(self, name, index=None, **kwargs):
+        key = canonicalize_name(name.split("[")[0])
+        with self._lock:
+            row = self._db.execute("SELECT versions FROM projects WHERE name = ?", (key,)).fetchone()
+        if row is None:
+            raise LudditeError("{} is not in the snapshot".format(name))
+        return VersionIndex(row[0].split("\n") if row[0] else ())
+
+
+def take_snapshot(path, names, index=DEFAULT_INDEX, worker_for=None, n_threads=4, **kwargs):
+    """Fetches the versions of all ``names`` and writes them to a ``Snapshot`` at ``path``.
+
+    ``names`` may also hold (name, index) pairs, for projects to get from another index.
+    ``worker_for(index)`` picks the worker for an index, by default it's probed.
+    Returns the snapshot and a dict of the projects which couldn't be fetched.
+    """
+    todo = {}
+    for name in names:
+        name, name_index = name if isinstance(name, tuple) else (name, index)
+        todo.setdefault(canonicalize_name(name), name_index)
+    workers = {}
+    failed = {}
+    with ThreadPoolExecutor(max_workers=n_threads) as executor:
+        futures = []
+        for name, name_index in sorted(todo.items()):
+            if name_index not in workers:
+                if worker_for is not None:
+                    workers[name_index] = worker_for(name_index)
+                else:
+                    workers[name_index] = IndexProbe(name_index, pool=kwargs.get("pool"))
+            future = executor.submit(workers[name_index], name, index=name_index, **kwargs)
+            futures.append((name, future))
+
+        def projects():
+            for name, future in futures:
+                try:
+                    yield name, future.result()
+                except Exception as err:
+                    failed[name] = err
+
+        snapshot = Snapshot.write(path, projects(), index=index)
+    return snapshot, failed
+
+
+# the asyncio engine fetches and parses on the event loop for the workers it knows about
+_worker_endpoints = {
+    get_versions_pypi: PYPI_ENDPOINTS,
+    get_versions_devpi: DEVPI_ENDPOINTS,
+}
+
+
+class _BytesSocket(object):
+    """lets http.client parse an HTTP response which was already received"""
+
+    def __init__(self, data):
+        self._data = data
+
+    def makefile(self, *args, **kwargs):
+        return io.BytesIO(self._data)
+
+
+class _AsyncHTTPConnection(object):
+    """asyncio protocol speaking just enough HTTP/1.1 for ``AsyncHTTPPool``.
+
+    It buffers a response until the message framing says it's complete, then hands
+    the raw bytes to the waiting future. The connection can then be reused.
+    """
+
+    def __init__(self):
+        self.transport = None
+        self.closed = False
+        self._buffer = bytearray()
+        self._waiter = None
+        self._method = None
+
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def data_received(self, data):
+        self._buffer += data
+        self._check_complete()
+
+    def eof_received(self):
+        self.closed = True
+        self._check_complete(eof=True)
+        return False
+
+    def connection_lost(self, exc):
+        self.closed = True
+        self._check_complete(eof=True, exc=exc)
+
+    def pause_writing(self):
+        pass
+
+    def resume_writing(self):
+        pass
+
+    def close(self):
+        self.closed = True
+        if self.transport is not None:
+            self.transport.close()
+
+    def request(self, method, payload, waiter):
+        self._buffer = bytearray()
+        self._method = method
+        self._waiter = waiter
+        self.transport.write(payload)
+
+    def _message_length(self):
+        """Length of the complete message in the buffer, None if it's not there yet"""
+        buf = self._buffer
+        end = buf.find(b"\r\n\r\n")
+        if end < 0:
+            return None
+        body_start = end + 4
+        head = bytes(buf[:end]).decode("latin-1").lower()
+        status = int(head.split(None, 2)[1])
+        if self._method == "HEAD" or status in (204, 304) or 100 <= status < 200:
+            return body_start
+        if re.search(r"^transfer-encoding:.*chunked", head, re.M):
+            pos = body_start
+            while True:
+                line_end = buf.find(b"\r\n", pos)
+                if line_end < 0:
+                    return None
+                size = int(bytes(buf[pos:line_end]).split(b";")[0], 16)
+                pos = line_end + 2
+                if size == 0:
+                    if buf[pos : pos + 2] == b"\r\n":
+                        return pos + 2
+                    trailer_end = buf.find(b"\r\n\r\n", pos)
+                    return None if trailer_end < 0 else trailer_end + 4
+                pos += size + 2
+                if pos > len(buf):
+                    return None
+        match = re.search(r"^content-length:\s*(\d+)", head, re.M)
+        if match is not None:
+            length = body_start + int(match.group(1))
+            return length if len(buf) >= length else None
+        # delimited by the server closing the connection
+        self.closed = True
+        return None
+
+    def _check_complete(self, eof=False, exc=None):
+        waiter = self._waiter
+        if waiter is None or waiter.done():
+            return
+        try:
+            length = self._message_length()
+        except (ValueError, IndexError) as err:
+            # a garbled status line or chunk size, there's no telling where the message ends
+            self._waiter = None
+            self.close()
+            waiter.set_exception(HTTPException("Malformed response ({})".format(err)))
+            return
+        if length is None and eof and self._buffer.find(b"\r\n\r\n") >= 0:
+            length = len(self._buffer)
+        if length is not None:
+            self._waiter = None
+            waiter.set_result(bytes(self._buffer[:length]))
+        elif eof:
+            self._waiter = None
+            waiter.set_exception(exc or socket.error("connection closed by server"))
+
+
+class AsyncHTTPPool(object):
+    """Keep-alive HTTP(S) connections for the asyncio engine, pooled per index host.
+
+    ``urlopen`` returns an asyncio future which resolves to a fully read response,
+    with the same interface as the responses from ``HTTPPool.urlopen``. The timeouts
+    are as for ``HTTPPool``, except that ``read_timeout`` is for the whole response.
+    """
+
+    max_redirects = 5
+
+    def __init__(self, loop, maxsize=100, ssl_context=None, timeout=None, read_timeout=None):
+        self.loop = loop
+        self.maxsize = maxsize
+        self.ssl_context = ssl_context
+        self.timeout = timeout
+        self.read_timeout = timeout if read_timeout is None else read_timeout
+        self._idle = {}
+
+    def close(self):
+        idle, self._idle = self._idle, {}
+        for conns in idle.values():
+            for conn in conns:
+                conn.close()
+
+    def _put_conn(self, key, conn):
+        idle = self._idle.setdefault(key, [])
+        if not conn.closed and len(idle) < self.maxsize:
+            idle.append(conn)
+        else:
+            conn.close()
+
+    def _connect(self, key):
+        """Returns a future resolving to (connection, reused)"""
+        result = self.loop.create_future()
+        idle = self._idle.get(key)
+        while idle:
+            conn = idle.pop()
+            if not conn.closed:
+                result.set_result((conn, True))
+                return result
+        scheme, netloc = key
+        parts = urlsplit("{}://{}".format(scheme, netloc))
+        ssl_context = None
+        if scheme == "https":
+            if self.ssl_context is None:
+                self.ssl_context = ssl.create_default_context()
+            ssl_context = self.ssl_context
+        port = parts.port or (443 if scheme == "https" else 80)
+        connecting = self.loop.create_task(
+            self.loop.create_connection(_AsyncHTTPConnection, parts.hostname, port, ssl=ssl_context)
+        )
+        expiry = None
+        if self.timeout is not None:
+            expiry = self.loop.call_later(self.timeout, connecting.cancel)
+
+        def connected(task):
+            if expiry is not None:
+                expiry.cancel()
+            if task.cancelled():
+                result.set_exception(socket.timeout("timed out connecting to {}".format(netloc)))
+            elif task.exception() is not None:
+                result.set_exception(task.exception())
+            else:
+                _transport, conn = task.result()
+                result.set_result((conn, False))
+
+        connecting.add_done_callback(connected)
+        return result
+
+    def _request(self, method, url, headers):
+        result = self.loop.create_future()
+        parts = urlsplit(url)
+        key = parts.scheme, parts.netloc
+        path = parts.path or "/"
+        if parts.query:
+            path += "?" + parts.query
+        lines = ["{} {} HTTP/1.1".format(method, path), "Host: {}".format(parts.netloc)]
+        headers = dict(headers)
+        headers.setdefault("Accept-Encoding", "identity")
+        lines += ["{}: {}".format(k, v) for k, v in headers.items()]
+        payload = ("\r\n".join(lines) + "\r\n\r\n").encode("latin-1")
+
+        def send(connecting):
+            if connecting.exception() is not None:
+                result.set_exception(connecting.exception())
+                return
+            conn, reused = connecting.result()
+            received = self.loop.create_future()
+            expiry = None
+            if self.read_timeout is not None:
+                expiry = self.loop.call_later(self.read_timeout, expire, received, conn)
+            received.add_done_callback(lambda f: done(f, conn, reused, expiry))
+            conn.request(method, payload, received)
+
+        def expire(received, conn):
+            if not received.done():
+                received.set_exception(socket.timeout("timed out reading from {}".format(url)))
+                conn.close()
+
+        def done(received, conn, reused, expiry):
+            if expiry is not None:
+                expiry.cancel()
+            if received.exception() is not None:
+                conn.close()
+                if reused and not isinstance(received.exception(), socket.timeout):
+                    # the server dropped an idle keep-alive connection, try a fresh one
+                    self._connect_fresh(key).add_done_callback(send)
+                else:
+                    result.set_exception(received.exception())
+                return
+            try:
+                response = HTTPResponse(_BytesSocket(received.result()), method=method)
+                response.begin()
+                body = response.read()
+            except Exception as err:
+                conn.close()
+                result.set_exception(err)
+                return
+            if response.will_close:
+                conn.close()
+            else:
+                self._put_conn(key, conn)
+            result.set_result(PooledResponse(url, response.status, response.msg, body))
+
+        self._connect(key).add_done_callback(send)
+        return result
+
+    def _connect_fresh(self, key):
+        self._idle.pop(key, None)
+        return self._connect(key)
+
+    def urlopen(self, request):
+        """Async counterpart of ``HTTPPool.urlopen``: non-2xx responses are returned, not raised"""
+        result = self.loop.create_future()
+        url = request.get_full_url()
+        method = request.get_method()
+        headers = dict(request.header_items())
+        if urlsplit(url).scheme in getproxies() and not proxy_bypass(urlsplit(url).hostname):
+            # proxies are left to urllib, on a thread
+            opener = urlopen
+            if self.read_timeout is not None:
+                opener = partial(urlopen, timeout=self.read_timeout)
+            return self.loop.run_in_executor(None, opener, request)
+        state = {"url": url, "method": method, "redirects": self.max_redirects}
+
+        def done(fut):
+            if fut.exception() is not None:
+                result.set_exception(fut.exception())
+                return
+            response = fut.result()
+            location = response.headers.get("Location")
+            if response.code not in (301, 302, 303, 307, 308) or not location:
+                result.set_result(response)
+                return
+            if not state["redirects"]:
+                msg = "Too many redirects fetching {}".format(url)
+                result.set_exception(LudditeError(msg))
+                return
+            state["redirects"] -= 1
+            state["url"] = urljoin(state["url"], location)
+            if response.code == 303 and state["method"] != "HEAD":
+                state["method"] = "GET"
+            self._request(state["method"], state["url"], headers).add_done_callback(done)
+
+        self._request(method, url, headers).add_done_callback(done)
+        return result
+
+
+def async_json_get(
+    pool,
+    url,
+    headers=(("Accept", "application/json"),),
+    cache=None,
+    throttle=None,
+    retries=MAX_RETRIES,
+    profile=None,
+    fresh=None,
+    loads=_loads,
+    stats=None,
+):
+    """Like ``json_get``, but returns an asyncio future using an ``AsyncHTTPPool``"""
+    start = timer()
+    stats = {} if stats is None else stats
+    stats["url"] = url
+    result = pool.loop.create_future()
+    headers, entry, data = _cached_json(url, headers, cache, fresh, loads)
+    if data is not None:
+        stats["cache"] = "hit"
+        if profile is not None:
+            seconds = timer() - start
+            profile.add_request(url=url, cache="hit", bytes=0, seconds=seconds, decode=seconds)
+        result.set_result(data)
+        return result
+    stats["cache"] = None if cache is None else "stale" if entry else "miss"
+
+    def attempt(n):
+        fut = pool.urlopen(Request(url=url, headers=headers))
+        fut.add_done_callback(partial(done, n, time.time()))
+
+    def finish(data=None, error=None):
+        if profile is not None:
+            stats["seconds"] = timer() - start
+            profile.add_request(**stats)
+        if error is not None:
+            result.set_exception(error)
+        else:
+            result.set_result(data)
+
+    def done(n, started, fut):
+        response = error = None
+        try:
+            response = fut.result()
+        except HTTPError as err:
+            response = error = err
+        except (EnvironmentError, HTTPException) as err:
+            error = err
+        except Exception as err:
+            finish(error=err)
+            return
+        transient = response is None or response.code in RETRY_STATUSES
+        wait = retry_after(response.headers) if transient and response is not None else None
+        if throttle is not None:
+            throttle.record(time.time() - started, ok=not transient, wait=wait)
+        if transient and n < retries:
+            pool.loop.call_later(backoff_delay(n, wait), attempt, n + 1)
+            return
+        stats["wait"] = timer() - start
+        if error is not None:
+            stats["status"] = error.code if isinstance(error, HTTPError) else None
+            # a 304 is only an error to urllib, for a revalidation it's a cache hit
+            if not (isinstance(error, HTTPError) and error.code == 304 and entry is not None):
+                finish(error=error)
+                return
+        try:
+            data = _json_from_response(url, response, cache, entry, stats=stats, loads=loads)
+        except Exception as err:
+            finish(error=err)
+        else:
+            finish(data)
+
+    attempt(0)
+    return result
+
+
+def _copy_result(target, source):
+    """Settles the asyncio future ``target`` the way ``source`` was, unless it's done already"""
+    if target.done():
+        return
+    if source.exception() is not None:
+        target.set_exception(source.exception())
+    else:
+        target.set_result(source.result())
+
+
+def _decode_on(loop, decoder, parse, body, charset):
+    return loop.run_in_executor(decoder, decode_versions, parse, body, charset)
+
+
+def async_get_versions(
+    pool,
+    endpoints,
+    name,
+    index,
+    cache=None,
+    throttle=None,
+    profile=None,
+    changelog=None,
+    decoder=None,
+):
+    """Like ``_get_versions``, but returns an asyncio future using an ``AsyncHTTPPool``"""
+    result = pool.loop.create_future()
+    candidates = _candidates(endpoints, name, index)
+    # the changelog may need to ask the index first, which blocks the loop just the once
+    fresh = _is_current(changelog, endpoints, name, index)
+    lookup = None if profile is None else profile.start_lookup(name, index)
+
+    def attempt(i):
+        uri, uri_func, accept, parse, _paths = candidates[i]
+        headers = (("Accept", accept),)
+        loads = _loads
+        if decoder is not None:
+            # the document comes back as a future for the versions, from the decoder
+            loads = partial(_decode_on, pool.loop, decoder, parse)
+        stats = {}
+        fetched = async_json_get(
+            pool,
+            uri,
+            headers=headers,
+            cache=cache,
+            throttle=throttle,
+            profile=lookup,
+            fresh=fresh,
+            loads=loads,
+            stats=stats,
+        )
+        fetched.add_done_callback(partial(decoded, i, uri_func, parse, stats))
+
+    def decoded(i, uri_func, parse, stats, fut):
+        if decoder is None or fut.exception() is not None:
+            done(i, uri_func, parse, stats, fut)
+        else:
+            fut.result().add_done_callback(partial(done, i, uri_func, None, stats))
+
+    def done(i, uri_func, parse, stats, fut):
+        last = i == len(candidates) - 1
+        try:
+            with _timed(lookup, "parse"):
+                versions = fut.result() if parse is None else parse(fut.result())
+        except Exception as err:
+            if last:
+                if lookup is not None:
+                    lookup.finish(err)
+                result.set_exception(err)
+                return
+            if isinstance(err, (ValueError, KeyError)):
+                _unsupported_endpoints.add((index, uri_func))
+            attempt(i + 1)
+        else:
+            if lookup is not None:
+                lookup.finish()
+            if changelog is not None and stats["cache"] != "hit":
+                changelog.looked_up(index, name)
+            result.set_result(versions)
+
+    attempt(0)
+    return result
+
+
+result_map = {
+    # string template: color
+    "noop": ("", None),
+    "skip": ("? skipped a line: {stripped}", "magenta"),
+    "pass": ("✔ {req.name} is up to date @ {latest}", "green"),
+    "warn": ("! {req.name} {version} will be outdated soon (index has {latest})", "yellow"),
+    "gone": ("! {req.name} {version} is not in the index {from_versions}", "yellow"),
+    "free": ("! {req.name} appears unpinned?", "yellow"),
+    "fail": ("✖ {req.name} {version} (index has {latest_non_pre})", "red"),
+    "oops": ("💩 couldn't get {req.name}, sorry ({error})", "magenta"),
+    "late": ("⌛ couldn't get {req.name} in time ({error})", "magenta"),
+}
+
+range_result_map = {
+    # the wording for lines with a version range rather than a pin
+    "pass": ("✔ {req.name}{specifier} allows the latest @ {latest}", "green"),
+    "warn": (
+        "! {req.name}{specifier} allows {allowed}, outdated soon (index has {latest})",
+        "yellow",
+    ),
+    "gone": (
+        "! {req.name}{specifier} allows none of the index's versions (up to {latest})",
+        "yellow",
+    ),
+    "fail": (
+        "✖ {req.name}{specifier} allows up to {allowed} (index has {latest_non_pre})",
+        "red",
+    ),
+}
+
+
+def _result_template(status, ranged=False):
+    """(template, color) for a result"""
+    if ranged and status in range_result_map:
+        return range_result_map[status]
+    return result_map[status]
+
+
+def _timed_out(err):
+    """whether a lookup failed for running out of time, rather than anything else"""
+    if isinstance(err, (DeadlineExceeded, socket.timeout)):
+        return True
+    # urllib wraps timeouts while connecting
+    return isinstance(getattr(err, "reason", None), socket.timeout)
+
+
+class RequirementsLine(object):
+    def __init__(self, text, line_number=None):
+        self.text = text
+        self.line_number = line_number
+        line, _sep, _comment = text.partition(" #")
+        line = line.strip()
+        self.stripped = "" if line.startswith("#") else line
+        self.req = None
+        self.version = None
+        self.specifier = ""
+        self.from_versions = ""
+        if self.stripped:
+            try:
+                self.req = Requirement(self.stripped)
+            except (InvalidRequirement, ValueError):
+                pass
+            else:
+                self.specifier = str(self.req.specifier)
                 if len(self.req.specifier) == 1:
-                    spec = str(self.req.specifier)
-                    if spec.startswith("=="):
-                        _, self.version = spec.split("==", 1)
+                    [spec] = self.req.specifier
+                    if spec.operator == "==" and not spec.version.endswith(".*"):
+                        self.version = spec.version
         self.error = None
         self.latest = None
         self.latest_non_pre = None
+        # the newest version a range allows
+        self.allowed = None
 
     def is_index(self):
         parts = self.stripped.split()
@@ -237,27 +2601,61 @@ class RequirementsLine(object):
                 if part.startswith(pre):
                     return part[len(pre):]
 
-    def process(self, worker, index=None):
-        if not self.stripped or self.is_index():
+    def is_extra_index(self):
+        parts = self.stripped.split()
+        if "--extra-index-url" in parts[:-1]:
+            return parts[parts.index("--extra-index-url") + 1]
+        for part in parts:
+            if part.startswith("--extra-index-url="):
+                return part[len("--extra-index-url="):]
+
+    def is_include(self):
+        """The file pulled in by a -r (requirements) or -c (constraints) line"""
+        parts = self.stripped.split()
+        if len(parts) > 1 and parts[0] in ("-r", "--requirement", "-c", "--constraint"):
+            return parts[1]
+        for pre in "--requirement=", "--constraint=", "-r", "-c":
+            if parts and parts[0].startswith(pre) and len(parts[0]) > len(pre):
+                return parts[0][len(pre):]
+
+    @property
+    def needs_lookup(self):
+        """whether processing this line will call the worker at all"""
+        return bool(self.stripped) and self.req is not None and bool(self.specifier)
+
+    @property
+    def ranged(self):
+        """whether the line allows a range of versions, rather than pinning one"""
+        return self.version is None and bool(self.specifier)
+
+    def process(self, worker, index=None, **kwargs):
+        if self.is_include() and self.error is not None:
+            # the file it pulls in couldn't be read
+            return "skip"
+        if not self.stripped or self.is_index() or self.is_extra_index() or self.is_include():
             return "noop"
         if self.req is None:
             return "skip"
-        if self.version is None:
+        if not self.specifier:
             return "free"
+        # the line may have been processed before, in --watch mode
+        self.error = self.latest = self.latest_non_pre = self.allowed = None
+        self.from_versions = ""
         try:
-            index_versions = worker(self.req.name, index=index)
+            index_versions = worker(self.req.name, index=index, **kwargs)
+            if not isinstance(index_versions, VersionIndex):
+                index_versions = VersionIndex(index_versions)
         except Exception as e:
             self.error = e
-            return "oops"
-        else:
+            return "late" if _timed_out(e) else "oops"
+        if self.ranged:
+            return self._process_range(index_versions)
+        if self.version not in index_versions:
             versions_str = ", ".join(index_versions)
             self.from_versions = "(from versions: {})".format(versions_str)
-        if self.version not in index_versions:
             return "gone"
-        self.latest = index_versions[-1]
-        self.latest_non_pre = max(
-            index_versions, key=lambda v: (not Version(v).is_prerelease, Version(v))
-        )
+        self.latest = index_versions.latest
+        self.latest_non_pre = index_versions.latest_non_pre
         if self.version == self.latest:
             return "pass"
         elif self.version == self.latest_non_pre:
@@ -265,17 +2663,54 @@ class RequirementsLine(object):
         else:
             return "fail"
 
+    def _process_range(self, index_versions):
+        self.allowed = index_versions.newest(self.req.specifier)
+        self.latest = index_versions.latest
+        self.latest_non_pre = index_versions.latest_non_pre
+        if self.allowed is None:
+            return "gone"
+        if self.allowed == self.latest:
+            return "pass"
+        elif Version(self.allowed) >= Version(self.latest_non_pre):
+            return "warn"
+        else:
+            return "fail"
+
 
 class RequirementsFile(object):
-    def __init__(self, fname):
+    def __init__(self, fname, included_by=None):
         self.fname = fname
+        self.included_by = included_by
         self.lines = self.parse()
-        self.width = max(len(line.text) for line in self.lines)
+        self.width = max([0] + [len(line.text) for line in self.lines])
 
     def parse(self):
         with open(str(self.fname)) as f:
             return [RequirementsLine(text=t, line_number=n) for n, t in enumerate(f, 1)]
 
+    def reparse(self):
+        """Reads the file again, keeping the parsed lines which haven't changed.
+
+        Returns the lines which are new (or changed) since the last parse.
+        """
+        previous = {}
+        for line in self.lines:
+            previous.setdefault(line.text, []).append(line)
+        lines = []
+        changed = []
+        with open(str(self.fname)) as f:
+            for n, text in enumerate(f, 1):
+                if previous.get(text):
+                    line = previous[text].pop(0)
+                    line.line_number = n
+                else:
+                    line = RequirementsLine(text=text, line_number=n)
+                    changed.append(line)
+                lines.append(line)
+        self.lines = lines
+        self.width = max([0] + [len(line.text) for line in self.lines])
+        return changed
+
     @property
     def index(self):
         index_url = None
@@ -286,43 +2721,1697 @@ class RequirementsFile(object):
             [index_url] = index_urls
         return index_url
 
+    @property
+    def extra_indexes(self):
+        return list(filter(None, [x.is_extra_index() for x in self.lines]))
+
+    def includes(self):
+        """Paths of the files this one pulls in with -r/-c, relative to the current directory"""
+        return [path for _line, path in self._include_lines()]
+
+    def _include_lines(self):
+        base = os.path.dirname(str(self.fname))
+        for line in self.lines:
+            target = line.is_include()
+            if target is not None and "://" not in target:
+                yield line, os.path.normpath(os.path.join(base, target))
+
+
+def site_packages(path):
+    """The site-packages directories of an environment, or ``path`` itself if it's one"""
+    if glob.glob(os.path.join(path, "*.dist-info")):
+        return [path]
+    layouts = [
+        ("lib", "python*", "site-packages"),
+        ("lib64", "python*", "site-packages"),
+        ("lib", "python*", "dist-packages"),
+        ("Lib", "site-packages"),
+    ]
+    dirs = []
+    seen = set()
+    for layout in layouts:
+        for site_dir in sorted(glob.glob(os.path.join(path, *layout))):
+            # lib64 is usually a symlink to lib
+            if os.path.realpath(site_dir) not in seen:
+                seen.add(os.path.realpath(site_dir))
+                dirs.append(site_dir)
+    return dirs
+
+
+def _read_metadata(path):
+    """(name, version) from the headers of a METADATA or PKG-INFO file"""
+    fields = {}
+    with io.open(path, encoding="utf-8", errors="replace") as f:
+        for line in f:
+            if not line.strip():
+                # the headers are over, the rest is the long description
+                break
+            key, _sep, value = line.partition(":")
+            if key in ("Name", "Version"):
+                fields[key] = value.strip()
+    return fields.get("Name"), fields.get("Version")
+
+
+def installed_distributions(path):
+    """(name, version) of each distribution installed in an environment, by name"""
+    site_dirs = site_packages(path)
+    if not site_dirs:
+        raise LudditeError("No site-packages found in {}".format(path))
+    found = {}
+    for site_dir in site_dirs:
+        for entry in sorted(os.listdir(site_dir)):
+            metadata = os.path.join(site_dir, entry)
+            if entry.endswith(".dist-info"):
+                metadata = os.path.join(metadata, "METADATA")
+            elif entry.endswith(".egg-info"):
+                if os.path.isdir(metadata):
+                    metadata = os.path.join(metadata, "PKG-INFO")
+            else:
+                continue
+            try:
+                name, version = _read_metadata(metadata)
+            except EnvironmentError:
+                continue
+            if name and version:
+                found.setdefault(canonicalize_name(name), (name, version))
+    return [found[key] for key in sorted(found)]
+
+
+class InstalledEnvironment(RequirementsFile):
+    """The distributions installed in a virtualenv (or a site-packages directory), as pins"""
+
+    def parse(self):
+        dists = installed_distributions(str(self.fname))
+        return [
+            RequirementsLine(text="{}=={}".format(name, version), line_number=n)
+            for n, (name, version) in enumerate(dists, 1)
+        ]
+
+    def reparse(self):
+        self.lines = self.parse()
+        self.width = max([0] + [len(line.text) for line in self.lines])
+        return self.lines
+
+
+_JSON_TOKEN = re.compile(r'"(?:[^"\\]|\\.)*"\s*:?|[{}\[\]]')
+
+
+def read_pipfile_lock(f):
+    """Yields (line number, section, name, version) from a Pipfile.lock, as it's read.
+
+    JSON strings can't span lines, so the document is scanned a line at a time,
+    keeping only the keys of the objects the scan is in.
+    """
+    keys = []
+    key = None
+    for n, line in enumerate(f, 1):
+        for token in _JSON_TOKEN.findall(line):
+            if token in "{[":
+                keys.append(key)
+                key = None
+            elif token in "}]":
+                keys.pop()
+                key = None
+            elif token.endswith(":"):
+                key = json.loads(token[:-1])
+            else:
+                # keys: [None (the document), section, package]
+                if key == "version" and len(keys) == 3 and keys[1] != "_meta":
+                    yield n, keys[1], keys[2], json.loads(token).lstrip("=")
+                key = None
+
+
+_TOML_TABLE = re.compile(r"^\[(\[?)\s*([^\]]+?)\s*\]\]?\s*(?:#.*)?$")
+_TOML_KEY = re.compile(r"^([A-Za-z0-9_-]+)\s*=\s*(.*?)\s*$")
+_TOML_STRING = re.compile(r'^"((?:[^"\\]|\\.)*)"|^\'([^\']*)\'')
+_TOML_STRING_IN = re.compile(r'"(?:[^"\\]|\\.)*"|\'[^\']*\'')
+
+
+def _toml_string(value):
+    match = _TOML_STRING.match(value)
+    if match is None:
+        return None
+    if match.group(2) is not None:
+        return match.group(2)
+    return json.loads('"{}"'.format(match.group(1)))
+
+
+def _toml_strings(value):
+    """The strings in an inline TOML array, like ``["main", "dev"]``"""
+    return [_toml_string(match.group(0)) for match in _TOML_STRING_IN.finditer(value)]
+
+
+def _toml_entries(f, array):
+    """Yields (line number, keys, subtables) for each ``[[array]]`` table in a TOML file.
+
+    ``keys`` holds the raw values of the table's own keys (strings are unquoted), and
+    ``subtables`` those of its ``[array.name]`` tables by name. Only unindented lines
+    are looked at, which is where lock files put keys and table headers.
+    """
+    entry = None
+    for n, line in enumerate(f, 1):
+        header = _TOML_TABLE.match(line)
+        if header is not None:
+            is_array, name = header.groups()
+            if entry is not None and (name == array or not name.startswith(array + ".")):
+                yield entry
+                entry = None
+            if is_array and name == array:
+                entry = n, {}, {}
+                current = entry[1]
+            elif entry is not None:
+                current = entry[2].setdefault(name[len(array) + 1 :], {})
+            continue
+        match = _TOML_KEY.match(line)
+        if entry is not None and match is not None:
+            key, value = match.groups()
+            string = _toml_string(value)
+            current[key] = value if string is None else string
+    if entry is not None:
+        yield entry
+
+
+def read_poetry_lock(f):
+    """Yields (line number, section, name, version) from a poetry.lock"""
+    for n, keys, subtables in _toml_entries(f, "package"):
+        source = subtables.get("source", {}).get("type")
+        if source in ("git", "directory", "file", "url") or "version" not in keys:
+            continue
+        # poetry 2 lists the groups a package is for, older lock files have a category
+        groups = _toml_strings(keys.get("groups", ""))
+        section = ", ".join(groups) if groups else keys.get("category")
+        yield n, section, keys["name"], keys["version"]
+
+
+def read_uv_lock(f):
+    """Yields (line number, None, name, version) from a uv.lock, which has no sections"""
+    for n, keys, _subtables in _toml_entries(f, "package"):
+        # workspace members, paths and VCS checkouts aren't on an index
+        if "version" in keys and keys.get("source", "").lstrip("{ ").startswith("registry"):
+            yield n, None, keys["name"], keys["version"]
+
+
+def read_pylock(f):
+    """Yields (line number, None, name, version) from a pylock.toml (PEP 751)"""
+    for n, keys, subtables in _toml_entries(f, "packages"):
+        if "version" in keys and not set(subtables) & {"vcs", "directory", "archive"}:
+            yield n, None, keys["name"], keys["version"]
+
+
+def lock_reader(fname):
+    """The reader for a lock file, or None for requirements files"""
+    basename = os.path.basename(str(fname))
+    if basename == "Pipfile.lock":
+        return read_pipfile_lock
+    if basename == "poetry.lock":
+        return read_poetry_lock
+    if basename == "uv.lock":
+        return read_uv_lock
+    if re.match(r"^pylock(\.[^.]+)?\.toml$", basename):
+        return read_pylock
+
+
+class LockFile(RequirementsFile):
+    """The packages pinned in a lock file, as requirement lines noting their section.
+
+    Entries are picked out as the file is scanned, rather than loading the whole
+    document. Each line's number is where its entry is in the lock file.
+    """
+
+    def parse(self):
+        reader = lock_reader(self.fname)
+        with io.open(str(self.fname), encoding="utf-8") as f:
+            lines = []
+            for n, section, name, version in reader(f):
+                text = "{}=={}".format(name, version)
+                if section is not None:
+                    text += "  # {}".format(section)
+                lines.append(RequirementsLine(text, line_number=n))
+            return lines
+
+    def reparse(self):
+        self.lines = self.parse()
+        self.width = max([0] + [len(line.text) for line in self.lines])
+        return self.lines
+
+
+def _read_requirements(fname, included_by=None):
+    cls = LockFile if lock_reader(fname) is not None else RequirementsFile
+    try:
+        return cls(fname, included_by)
+    except (IOError, OSError) as err:
+        if included_by is None:
+            raise
+        # the line including it is reported as skipped, the rest of the run goes on
+        for line, path in included_by._include_lines():
+            if path == fname:
+                line.error = err
+        return None
+
+
+def load_environments(paths, n_threads=4):
+    """``InstalledEnvironment``s for ``paths``, scanned concurrently"""
+    with ThreadPoolExecutor(max_workers=n_threads) as executor:
+        return list(executor.map(InstalledEnvironment, paths))
+
+
+def load_requirements(fnames, n_threads=4):
+    """``RequirementsFile``s for ``fnames`` and all the files they include with -r/-c.
+
+    Lock files (Pipfile.lock, poetry.lock, uv.lock, pylock.toml) get a ``LockFile``.
+
+    Each file is read once, however many times it's included (cycles included).
+    Included files are read concurrently, a level of includes at a time, and come
+    after the files given. The line of an include which can't be read is skipped.
+    """
+    seen = set()
+    todo = []
+    for fname in fnames:
+        key = os.path.realpath(str(fname))
+        if key not in seen:
+            seen.add(key)
+            todo.append((fname, None))
+    return _read_with_includes(todo, seen, n_threads)
+
+
+def load_includes(req_files, n_threads=4):
+    """``RequirementsFile``s for the files ``req_files`` include which aren't among them yet.
+
+    For when the files were read again, and may include others now.
+    """
+    seen = set(os.path.realpath(str(req_file.fname)) for req_file in req_files)
+    todo = []
+    for req_file in req_files:
+        todo.extend(_new_includes(req_file, seen))
+    return _read_with_includes(todo, seen, n_threads)
+
+
+def _new_includes(req_file, seen):
+    """(path, req_file) for the files ``req_file`` includes which aren't in ``seen`` yet"""
+    todo = []
+    for path in req_file.includes():
+        key = os.path.realpath(path)
+        if key not in seen:
+            seen.add(key)
+            todo.append((path, req_file))
+    return todo
+
+
+def _read_with_includes(todo, seen, n_threads=4):
+    """Reads the (fname, included_by) in ``todo``, then what they include, a level at a time"""
+    req_files = []
+    with ThreadPoolExecutor(max_workers=n_threads) as executor:
+        while todo:
+            read = executor.map(lambda args: _read_requirements(*args), todo)
+            parsed = [req_file for req_file in read if req_file is not None]
+            req_files.extend(parsed)
+            todo = []
+            for req_file in parsed:
+                todo.extend(_new_includes(req_file, seen))
+    return req_files
+
+
+summary_map = {
+    # status: label in the combined summary of a multi-file run
+    "pass": "up to date",
+    "warn": "outdated soon",
+    "fail": "out of date",
+    "gone": "not in the index",
+    "free": "unpinned",
+    "skip": "skipped",
+    "oops": "failed lookups",
+    "late": "timed out",
+}
+
+
+def _resolved(future):
+    """a worker which just hands back the result of an already submitted lookup"""
+    return lambda name, index=None, **kwargs: future.result()
+
+
+def _late(deadline):
+    """a worker for a lookup which didn't finish before the deadline"""
+
+    def worker(name, index=None, **kwargs):
+        raise DeadlineExceeded("gave up at the {:g}s deadline".format(deadline))
+
+    return worker
+
+
+class _Waiter(object):
+    """Waits on the lookup futures of a run until the deadline, then gives up on the rest.
+
+    ``wait_any(futures, timeout)`` returns those of the futures which are done, after
+    at least one is or ``timeout`` passes. ``give_up()`` stops the unfinished lookups.
+    """
+
+    def __init__(self, futures, wait_any, give_up, deadline=None):
+        self.futures = futures
+        self.wait_any = wait_any
+        self.give_up = give_up
+        self.deadline = deadline
+        self.give_up_at = None if deadline is None else time.time() + deadline
+        self.late = None
+
+    def wait(self, futures):
+        """Returns those of ``futures`` which are done, or have been given up on"""
+        if self.late is not None:
+            return set(futures)
+        timeout = None if self.give_up_at is None else max(self.give_up_at - time.time(), 0)
+        done = self.wait_any(futures, timeout)
+        if not done:
+            self.late = set(f for f in self.futures.values() if not f.done())
+            self.give_up()
+            return set(futures)
+        return done
+
+    def worker(self, future):
+        """The worker for the line(s) looked up by a future which is done"""
+        if self.late is not None and future in self.late:
+            return _late(self.deadline)
+        return _resolved(future)
+
 
 class Luddite(object):
-    def __init__(self, fname=DEFAULT_FNAME, index=None):
-        self.req_file = RequirementsFile(fname)
-        self.index = index or self.req_file.index or get_index_url()
-        self.get_versions = choose_worker(self.index)
-
-    def run(self, n_threads=4):
-        print("   using index: {}".format(self.index))
-        print("---" + "{:-<77}".format(self.req_file.fname))
-        with ThreadPoolExecutor(max_workers=n_threads) as executor:
-            futures = [
-                executor.submit(line.process, worker=self.get_versions, index=self.index)
-                for line in self.req_file.lines
-            ]
-            for line, future in zip(self.req_file.lines, futures):
-                result = future.result()
-                template, color = result_map[result]
-                line_out = line.text.rstrip("\r\n")
-                if result == "noop":
-                    print(line_out)
-                    continue
-                pad = self.req_file.width - len(line_out) + 2
-                print(line_out, end=" " * pad)
-                cprint(template.format(**vars(line)), color=color)
+    """Checks one or more requirements files against the package index.
 
+    ``fname`` may be a single filename or a list of them, and ``envs`` a list of
+    environments whose installed distributions are checked as if they were pinned.
+    Each distinct project is looked up only once per index, no matter how many
+    lines, files and environments pin it. Lookups on the main index are spread over
+    it and its ``mirrors``, if any (see ``MirrorGroup``). Projects are looked up on the
+    ``extra_indexes`` (and those in the files) too, as pip would (see ``IndexGroup``),
+    remembering in ``not_found`` which indexes don't have a project. JSON decoding and
+    version parsing can be handed to a ``decoder`` executor, e.g. a ``ProcessPoolExecutor``.
+    """
 
-def main():
-    version_str = "%(prog)s v{}".format(__version__)
-    parser = argparse.ArgumentParser(description="Luddite checks for out-of-date package versions")
-    parser.add_argument("fname", nargs="?", default=DEFAULT_FNAME, metavar="<requirements.txt>")
+    def __init__(
+        self,
+        fname=DEFAULT_FNAME,
+        index=None,
+        cache=None,
+        pool=None,
+        stream=False,
+        type_cache=None,
+        snapshot=None,
+        throttle=None,
+        profile=None,
+        output_format="text",
+        server=None,
+        envs=(),
+        mirrors=(),
+        changelog=None,
+        decoder=None,
+        extra_indexes=(),
+        not_found=None,
+    ):
+        fnames = fname if isinstance(fname, (list, tuple)) else [fname]
+        self.req_files = load_requirements(fnames) + load_environments(envs)
+        self.req_file = self.req_files[0]
+        self.cache = cache
+        self.pool = pool
+        self.stream = stream
+        self.type_cache = type_cache
+        self.snapshot = snapshot
+        self.throttle = throttle
+        self.profile = profile
+        self.output_format = output_format
+        self.server = server
+        self.mirrors = list(mirrors)
+        self.changelog = changelog
+        self.decoder = decoder
+        # like pip, extra indexes from any of the files apply to all of them
+        self.extra_indexes = []
+        for url in list(extra_indexes) + [u for f in self.req_files for u in f.extra_indexes]:
+            if url not in self.extra_indexes:
+                self.extra_indexes.append(url)
+        self.not_found = NotFoundCache() if not_found is None else not_found
+        # (index, result) of each line which was looked up, by line - only kept while watching
+        self.results = None
+        with _timed(profile, "index_url"):
+            self.index = index or self.req_file.index
+            if not self.index:
+                self.index = (snapshot is not None and snapshot.index) or get_index_url()
+        self._override_index = index is not None
+        self._get_versions = None
+        self._workers = {}
+        # the index type is probed in the background while lookups get queued up
+        self.worker_for(self.index)
+
+    @property
+    def get_versions(self):
+        """The worker for the main index, once it's known"""
+        if self._get_versions is not None:
+            return self._get_versions
+        worker = self.worker_for(self.index)
+        return worker.result() if isinstance(worker, IndexProbe) else worker
+
+    @get_versions.setter
+    def get_versions(self, worker):
+        self._get_versions = worker
+
+    @property
+    def fetch_options(self):
+        """keyword arguments passed through the version workers to ``json_get``"""
+        return {
+            "cache": self.cache,
+            "pool": self.pool,
+            "stream": self.stream,
+            "throttle": self.throttle,
+            "profile": self.profile,
+            "changelog": self.changelog,
+            "decoder": self.decoder,
+        }
+
+    def index_for(self, req_file):
+        if self._override_index:
+            return self.index
+        # included files go to the index of the file including them, unless they say otherwise
+        while req_file is not None:
+            if req_file.index:
+                return req_file.index
+            req_file = req_file.included_by
+        return self.index
+
+    def worker_for(self, index):
+        """The worker for an index - possibly an ``IndexProbe`` which hasn't finished yet"""
+        if index == self.index and self._get_versions is not None:
+            return self._get_versions
+        if index not in self._workers:
+            if self.snapshot is not None:
+                worker = choose_worker(index, snapshot=self.snapshot)
+            elif self.server is not None:
+                worker = self.server
+            else:
+                if self.mirrors and index == self.index:
+                    worker = MirrorGroup([index] + self.mirrors, type_cache=self.type_cache)
+                else:
+                    worker = IndexProbe(
+                        index, pool=self.pool, type_cache=self.type_cache, profile=self.profile
+                    )
+                extras = [url for url in self.extra_indexes if url != index]
+                if extras:
+                    worker = IndexGroup(
+                        [index] + extras,
+                        type_cache=self.type_cache,
+                        not_found=self.not_found,
+                        workers={index: worker},
+                    )
+            self._workers[index] = worker
+        return self._workers[index]
+
+    def lookups(self):
+        """Yields (req_file, index, line, key) for every line - key is None unless it needs a lookup"""
+        for req_file in self.req_files:
+            index = self.index_for(req_file)
+            for line in req_file.lines:
+                key = None
+                if line.needs_lookup and self._known(line, index) is None:
+                    key = index, canonicalize_name(line.req.name)
+                yield req_file, index, line, key
+
+    def _known(self, line, index):
+        """The result a line had last time round, if it can be reused as it is"""
+        if self.results is None or line not in self.results:
+            return None
+        known_index, result = self.results[line]
+        # failed lookups are tried again
+        if known_index != index or result in ("oops", "late"):
+            return None
+        return result
+
+    def _prefetch(self):
+        """Asks the ``luddite serve`` daemon for all the projects in one go"""
+        if self.server is not None:
+            projects = set(
+                (line.req.name, index) for _, index, line, key in self.lookups() if key is not None
+            )
+            self.server.prefetch(sorted(projects))
+
+    def print_result(self, line, result, req_file=None):
+        template, color = _result_template(result, line.ranged)
+        line_out = line.text.rstrip("\r\n")
+        if result == "noop":
+            print(line_out)
+            return
+        pad = (req_file or self.req_file).width - len(line_out) + 2
+        print(line_out, end=" " * pad)
+        cprint(template.format(**vars(line)), color=color)
+
+    def _report(self, results, n_lookups):
+        """Prints (req_file, index, line, result) in order, with a summary for multiple files"""
+        current = (None, None)
+        counts = dict.fromkeys(summary_map, 0)
+        for req_file, index, line, result in results:
+            if current[0] is not req_file:
+                if self.snapshot is not None:
+                    # offline, every index is answered from the snapshot
+                    if current[0] is None:
+                        print(
+                            "   using snapshot: {} (of {})".format(
+                                self.snapshot.path, self.snapshot.index or "an unknown index"
+                            )
+                        )
+                elif current[1] != index:
+                    print("   using index: {}".format(index))
+                    for extra_index in self.extra_indexes:
+                        if extra_index != index:
+                            print("   extra index: {}".format(extra_index))
+                print("---" + "{:-<77}".format(req_file.fname))
+                current = req_file, index
+            self.print_result(line, result, req_file)
+            if result in counts:
+                counts[result] += 1
+        if len(self.req_files) > 1:
+            print("---" + "{:-<77}".format("summary"))
+            msg = "   {} files checked, {} projects looked up"
+            print(msg.format(len(self.req_files), n_lookups))
+            for status in "pass", "warn", "fail", "gone", "free", "skip", "oops", "late":
+                if counts[status]:
+                    _template, color = result_map[status]
+                    cprint("   {:>6} {}".format(counts[status], summary_map[status]), color=color)
+
+    def _process(self, line, worker, index):
+        result = self._known(line, index)
+        if result is not None:
+            return result
+        with _timed(self.profile, "process"):
+            result = line.process(worker, index=index)
+        if self.results is not None and line.needs_lookup:
+            self.results[line] = index, result
+        return result
+
+    def record(self, req_file, index, line, result):
+        """The result of a line as a JSON-friendly dict, as printed with ``--format ndjson``"""
+        return {
+            "file": str(req_file.fname),
+            "index": index,
+            "line_number": line.line_number,
+            "requirement": line.stripped,
+            "name": None if line.req is None else line.req.name,
+            "version": line.version,
+            "latest": line.latest,
+            "latest_non_pre": line.latest_non_pre,
+            "allowed": line.allowed,
+            "status": result,
+            "error": None if line.error is None else str(line.error),
+        }
+
+    def _report_ndjson(self, results):
+        """Prints a JSON record per requirement, as soon as its result is in"""
+        for req_file, index, line, result in results:
+            if result != "noop":
+                print(json.dumps(self.record(req_file, index, line, result), sort_keys=True))
+                sys.stdout.flush()
+
+    def _in_file_order(self, rows, futures, waiter):
+        for req_file, index, line, key in rows:
+            worker = self.worker_for(index)
+            if key is not None:
+                waiter.wait([futures[key]])
+                worker = waiter.worker(futures[key])
+            yield req_file, index, line, worker
+
+    def _in_completion_order(self, rows, futures, waiter):
+        """Lines which need no lookup first, then the others as their lookups finish"""
+        waiting = {}
+        for req_file, index, line, key in rows:
+            if key is None:
+                yield req_file, index, line, self.worker_for(index)
+            else:
+                waiting.setdefault(futures[key], []).append((req_file, index, line))
+        while waiting:
+            done = waiter.wait(list(waiting))
+            for future in [f for f in list(waiting) if f in done]:
+                worker = waiter.worker(future)
+                for req_file, index, line in waiting.pop(future):
+                    yield req_file, index, line, worker
+
+    def _output(self, rows, futures, waiter):
+        if self.output_format == "ndjson":
+            lines = self._in_completion_order(rows, futures, waiter)
+        else:
+            lines = self._in_file_order(rows, futures, waiter)
+        results = (
+            (req_file, index, line, self._process(line, worker, index))
+            for req_file, index, line, worker in lines
+        )
+        if self.output_format == "ndjson":
+            self._report_ndjson(results)
+        else:
+            self._report(results, n_lookups=len(futures))
+        if self.changelog is not None:
+            self.changelog.save()
+        self.not_found.save()
+        if self.profile is not None:
+            self.profile.finish()
+
+    def _stat(self):
+        stats = []
+        for req_file in self.req_files:
+            try:
+                st = os.stat(str(req_file.fname))
+            except OSError:
+                # editors may replace the file rather than write to it
+                return None
+            stats.append((st.st_mtime, st.st_size))
+        return stats
+
+    def watch(self, check, interval=0.2, stop=None):
+        """Calls ``check`` (``run`` or ``run_async``) again whenever a requirements file changes.
+
+        Unchanged lines aren't parsed or looked up again, their results are reused - only
+        the lines which were added or changed are looked up, and files newly included
+        with -r/-c are read. Runs until interrupted, or ``stop`` is set.
+        """
+        self.results = {}
+        stop = stop or threading.Event()
+        seen = None
+        try:
+            while not stop.is_set():
+                stats = self._stat()
+                if stats is not None and stats != seen:
+                    if seen is not None:
+                        self._reparse()
+                        if sys.stdout.isatty():
+                            print("\x1b[2J\x1b[H", end="")
+                        print("---" + "{:-<77}".format(time.strftime("%H:%M:%S changed ")))
+                    seen = stats
+                    check()
+                    sys.stdout.flush()
+                stop.wait(interval)
+        except KeyboardInterrupt:
+            pass
+
+    def _reparse(self):
+        changed = set()
+        for req_file in self.req_files:
+            changed.update(req_file.reparse())
+        self.req_files.extend(load_includes(self.req_files))
+        # the lines which are gone, or changed, have no results worth keeping
+        current = set(line for req_file in self.req_files for line in req_file.lines)
+        for line in list(self.results):
+            if line not in current or line in changed:
+                del self.results[line]
+
+    def _give_up(self, futures, attempt):
+        """Cancels the lookups which haven't started, and breaks off the ones which have"""
+        # no retries or fallbacks for the lookups of the run from now on
+        attempt.cancelled = True
+        for future in futures.values():
+            future.cancel()
+        abort = getattr(self.pool, "abort", None)
+        if abort is not None:
+            abort()
+
+    def run(self, n_threads=4, deadline=None):
+        """Looks up the pinned projects on a pool of threads, printing results in file order.
+
+        Lookups still unfinished ``deadline`` seconds after the start are reported as
+        "late", instead of holding up the lines after them. With the "ndjson" output
+        format, results are printed as the lookups finish instead.
+        """
+        self._prefetch()
+        executor = ThreadPoolExecutor(max_workers=n_threads)
+        futures = {}
+        attempt = _Attempt()
+
+        def wait_any(fs, timeout):
+            return wait_futures(fs, timeout, return_when=FIRST_COMPLETED).done
+
+        waiter = _Waiter(futures, wait_any, partial(self._give_up, futures, attempt), deadline)
+        try:
+            rows = []
+            for req_file, index, line, key in self.lookups():
+                if key is not None and key not in futures:
+                    worker = self.worker_for(index)
+                    futures[key] = executor.submit(
+                        _as_attempt,
+                        attempt,
+                        worker,
+                        line.req.name,
+                        index=index,
+                        **self.fetch_options
+                    )
+                rows.append((req_file, index, line, key))
+            self._output(rows, futures, waiter)
+        finally:
+            # hung lookups are left behind, not waited for
+            executor.shutdown(wait=waiter.late is None)
+
+    def _fetch_async(self, pool, name, index, attempt=None):
+        """Returns an asyncio future for the versions of a project"""
+        loop = pool.loop
+        worker = self.worker_for(index)
+        if isinstance(worker, IndexProbe):
+            if not worker.done():
+                # wait for the probe on a thread, the loop has other lookups to get on with
+                result = loop.create_future()
+                probed = loop.run_in_executor(None, worker.result)
+                fetch = partial(self._fetch_probed, pool, name, index, attempt, result)
+                probed.add_done_callback(fetch)
+                return result
+            try:
+                worker = worker.result()
+            except Exception as err:
+                # the probe failed, so does every lookup waiting on it
+                failed = loop.create_future()
+                failed.set_exception(err)
+                return failed
+        return self._fetch_with(pool, worker, name, index, attempt)
+
+    def _fetch_probed(self, pool, name, index, attempt, result, probed):
+        if result.done():
+            return
+        if probed.exception() is not None:
+            result.set_exception(probed.exception())
+            return
+        fetched = self._fetch_with(pool, probed.result(), name, index, attempt)
+        fetched.add_done_callback(partial(_copy_result, result))
+
+    def _fetch_with(self, pool, worker, name, index, attempt=None):
+        loop = pool.loop
+        endpoints = _worker_endpoints.get(worker)
+        if endpoints is None:
+            # a worker we don't know how to drive from the loop gets a thread instead
+            fetch = partial(_as_attempt, attempt, worker, name, index, **self.fetch_options)
+            return loop.run_in_executor(None, fetch)
+        return async_get_versions(
+            pool,
+            endpoints,
+            name,
+            index,
+            cache=self.cache,
+            throttle=self.throttle,
+            profile=self.profile,
+            changelog=self.changelog,
+            decoder=self.decoder,
+        )
+
+    def run_async(self, concurrency=100, deadline=None):
+        """Like ``run``, but with the lookups done as coroutines on an asyncio loop.
+
+        At most ``concurrency`` lookups are in flight at any time, fewer if the
+        ``throttle`` says so. Results are printed in file order, same as with ``run``,
+        and the ``deadline`` works the same way too.
+        """
+        if asyncio is None:
+            raise LudditeError("The asyncio engine requires Python 3")
+        if self.stream:
+            # the event loop's connections read whole bodies
+            raise LudditeError("The asyncio engine can't parse responses as they stream in")
+        self._prefetch()
+        rows = list(self.lookups())
+        loop = asyncio.new_event_loop()
+        # same timeouts as the pool for the threads
+        pool = AsyncHTTPPool(
+            loop,
+            maxsize=concurrency,
+            timeout=getattr(self.pool, "timeout", None),
+            read_timeout=getattr(self.pool, "read_timeout", None),
+        )
+        lookups = []
+        fetched = {}
+        attempt = _Attempt()
+        for _req_file, index, line, key in rows:
+            if key is not None and key not in fetched:
+                fetched[key] = loop.create_future()
+                lookups.append((key, line.req.name, index))
+        state = {"queued": 0, "active": 0}
+
+        def limit():
+            if self.throttle is None:
+                return concurrency
+            return min(concurrency, int(self.throttle.limit))
+
+        def start_next():
+            wait = 0 if self.throttle is None else self.throttle.wait_time()
+            if wait:
+                # the index sent a Retry-After
+                loop.call_later(wait, start_next)
+                return
+            while state["queued"] < len(lookups) and state["active"] < limit():
+                key, name, index = lookups[state["queued"]]
+                state["queued"] += 1
+                state["active"] += 1
+                fetching = self._fetch_async(pool, name, index, attempt)
+                fetching.add_done_callback(partial(done, key))
+
+        def done(key, fut):
+            state["active"] -= 1
+            if fetched[key].done():
+                # given up on already
+                return
+            if fut.exception() is not None:
+                fetched[key].set_exception(fut.exception())
+            else:
+                fetched[key].set_result(fut.result())
+            start_next()
+
+        def wait_any(fs, timeout):
+            waiting = asyncio.wait(fs, timeout=timeout, return_when=asyncio.FIRST_COMPLETED)
+            # lookups make progress on the loop while earlier results print
+            done, _pending = loop.run_until_complete(waiting)
+            return done
+
+        def give_up():
+            state["queued"] = len(lookups)
+            for future in fetched.values():
+                if not future.done():
+                    future.set_exception(DeadlineExceeded())
+                    future.exception()
+            # lookups handed to threads are broken off like with ``run``
+            self._give_up({}, attempt)
+
+        loop.call_soon(start_next)
+        try:
+            self._output(rows, fetched, _Waiter(fetched, wait_any, give_up, deadline))
+        finally:
+            pool.close()
+            loop.close()
+
+
+class Result(object):
+    """What came of checking one requirement line - as yielded by ``check``"""
+
+    __slots__ = (
+        "line_number",
+        "requirement",
+        "name",
+        "version",
+        "index",
+        "latest",
+        "latest_non_pre",
+        "specifier",
+        "allowed",
+        "status",
+        "error",
+    )
+
+    def __init__(self, line, status, index=None):
+        self.line_number = line.line_number
+        self.requirement = line.stripped
+        self.name = None if line.req is None else line.req.name
+        self.version = line.version
+        self.index = index
+        self.latest = line.latest
+        self.latest_non_pre = line.latest_non_pre
+        self.specifier = line.specifier
+        self.allowed = line.allowed
+        self.status = status
+        self.error = line.error
+
+    def __repr__(self):
+        return "<Result {!r}: {}>".format(self.requirement, self.status)
+
+    def message(self):
+        """The result, as luddite prints it"""
+        ranged = self.version is None and bool(self.specifier)
+        template, _color = _result_template(self.status, ranged)
+        fields = dict((slot, getattr(self, slot)) for slot in self.__slots__)
+        return template.format(req=self, stripped=self.requirement, from_versions="", **fields)
+
+    def as_dict(self):
+        data = dict((slot, getattr(self, slot)) for slot in self.__slots__)
+        data["error"] = None if self.error is None else str(self.error)
+        return data
+
+
+def _result(line, index, future):
+    worker = None if future is None else _resolved(future)
+    return Result(line, line.process(worker, index=index), index=index)
+
+
+def check(
+    requirements,
+    index=None,
+    n_threads=4,
+    window=1000,
+    memo_size=10000,
+    worker_for=None,
+    pool=None,
+    type_cache=None,
+    extra_indexes=(),
+    not_found=None,
+    **kwargs
+):
+    """Checks requirement lines from any iterable - a list, a file, ``sys.stdin`` - as they come.
+
+    Yields a ``Result`` for each line, in order. Lookups start as soon as a line is read,
+    reading at most ``window`` lines ahead of the results. A project is looked up once
+    for as long as it's among the ``memo_size`` most recently seen, so memory use stays
+    flat however many lines there are. ``worker_for(index)`` picks the worker for an
+    index, by default it's probed, and projects are looked up on the ``extra_indexes``
+    (and those in the lines) too. Other keyword arguments go through to ``json_get``.
+    """
+    index = index or get_index_url()
+    extra_indexes = list(extra_indexes)
+    not_found = NotFoundCache() if not_found is None else not_found
+    workers = {}
+    memo = OrderedDict()  # (index, name): future, least recently seen first
+    pending = deque()
+    executor = ThreadPoolExecutor(max_workers=n_threads)
+    kwargs["pool"] = pool
+    try:
+        for n, text in enumerate(requirements, 1):
+            line = RequirementsLine(text, line_number=n)
+            future = None
+            if line.is_index():
+                index = line.is_index()
+            elif line.is_extra_index():
+                extra_indexes.append(line.is_extra_index())
+            elif line.needs_lookup:
+                group = index, tuple(url for url in extra_indexes if url != index)
+                key = group + (canonicalize_name(line.req.name),)
+                future = memo.pop(key, None)
+                if future is None:
+                    if group not in workers:
+                        if worker_for is not None:
+                            workers[group] = worker_for(index)
+                        elif group[1]:
+                            workers[group] = IndexGroup(
+                                group[:1] + group[1], type_cache=type_cache, not_found=not_found
+                            )
+                        else:
+                            workers[group] = IndexProbe(index, pool=pool, type_cache=type_cache)
+                    future = executor.submit(workers[group], line.req.name, index=index, **kwargs)
+                memo[key] = future
+                if len(memo) > memo_size:
+                    memo.popitem(last=False)
+            pending.append((line, index, future))
+            while pending and (
+                len(pending) > window or pending[0][2] is None or pending[0][2].done()
+            ):
+                yield _result(*pending.popleft())
+        while pending:
+            yield _result(*pending.popleft())
+    finally:
+        # the caller may have stopped early
+        for _line, _index, future in pending:
+            if future is not None:
+                future.cancel()
+        executor.shutdown(wait=False)
+
+
+def print_results(results, output_format="text"):
+    """Prints what ``check`` yields, as it comes"""
+    for result in results:
+        if result.status == "noop":
+            continue
+        if output_format == "ndjson":
+            print(json.dumps(result.as_dict(), sort_keys=True))
+        else:
+            _template, color = result_map[result.status]
+            print(result.requirement, end="  ")
+            cprint(result.message(), color=color)
+        sys.stdout.flush()
+
+
+class VersionService(object):
+    """The lookups behind ``luddite serve``: version lists kept in memory between requests.
+
+    Entries older than ``ttl`` seconds are still answered from memory, while a new
+    copy is fetched in the background. Those not asked for again and older than
+    ``max_age`` are forgotten. Failed lookups are tried again next time. Projects are
+    looked up on the ``extra_indexes`` as well (see ``IndexGroup``). Clients can only
+    have projects looked up on these indexes. Other keyword arguments are passed
+    through the workers to ``json_get``.
+    """
+
+    def __init__(
+        self,
+        index=None,
+        ttl=300,
+        max_age=3600,
+        n_threads=16,
+        pool=None,
+        type_cache=None,
+        extra_indexes=(),
+        not_found=None,
+        **kwargs
+    ):
+        self.index = index or get_index_url()
+        self.ttl = ttl
+        self.max_age = max_age
+        self.pool = pool
+        self.type_cache = type_cache
+        self.extra_indexes = list(extra_indexes)
+        self.not_found = NotFoundCache() if not_found is None else not_found
+        self.fetch_options = dict(kwargs, pool=pool)
+        self.executor = ThreadPoolExecutor(max_workers=n_threads)
+        self._entries = {}  # (index, name): (fetched at, future)
+        self._refreshing = set()
+        self._workers = {}
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def close(self):
+        self.executor.shutdown(wait=False)
+
+    def _submit(self, name, index):
+        if index not in self._workers:
+            extras = [url for url in self.extra_indexes if url != index]
+            if extras:
+                self._workers[index] = IndexGroup(
+                    [index] + extras, type_cache=self.type_cache, not_found=self.not_found
+                )
+            else:
+                self._workers[index] = IndexProbe(index, pool=self.pool, type_cache=self.type_cache)
+        worker = self._workers[index]
+        return self.executor.submit(worker, name, index=index, **self.fetch_options)
+
+    def _refreshed(self, key, started, future):
+        with self._lock:
+            self._refreshing.discard(key)
+            if future.exception() is None:
+                self._entries[key] = started, future
+
+    def lookup(self, name, index=None):
+        """A future for the versions of a project"""
+        index = index or self.index
+        key = index, canonicalize_name(name)
+        now = time.time()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or entry[1].done() and entry[1].exception() is not None:
+                entry = self._entries[key] = now, self._submit(name, index)
+            elif now - entry[0] > self.ttl and key not in self._refreshing:
+                self._refreshing.add(key)
+                refresh = self._submit(name, index)
+                refresh.add_done_callback(partial(self._refreshed, key, now))
+        return entry[1]
+
+    def evict(self):
+        """Forgets the versions fetched more than ``max_age`` seconds ago"""
+        now = time.time()
+        with self._lock:
+            for key, (fetched_at, future) in list(self._entries.items()):
+                if now - fetched_at > self.max_age and future.done():
+                    del self._entries[key]
+
+    def _allowed(self, index):
+        indexes = [self.index] + self.extra_indexes
+        return index is None or index.rstrip("/") in [url.rstrip("/") for url in indexes]
+
+    def versions(self, projects):
+        """Looks up (name, index) pairs, returning a JSON-friendly result for each.
+
+        Only the service's own indexes are asked, a pair for any other gets an error.
+        """
+        self.evict()
+        futures = []
+        for name, index in projects:
+            if self._allowed(index):
+                futures.append(self.lookup(name, index))
+            else:
+                futures.append(None)
+        results = []
+        for future, (_name, index) in zip(futures, projects):
+            if future is None:
+                error = "luddite serve doesn't look projects up on {}".format(index)
+                results.append({"error": error, "late": False})
+                continue
+            try:
+                results.append({"versions": list(future.result())})
+            except Exception as err:
+                results.append({"error": str(err), "late": _timed_out(err)})
+        return results
+
+
+class _ServiceHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    server_version = "luddite/" + __version__
+
+    def do_GET(self):
+        if self.path != "/":
+            return self._send(404, {"error": "Not found"})
+        self._send(200, {"version": __version__, "projects": len(self.server.service)})
+
+    def do_POST(self):
+        if self.path != "/versions":
+            return self._send(404, {"error": "Not found"})
+        try:
+            length = int(self.headers.get("Content-Length") or 0)
+            projects = json.loads(self.rfile.read(length).decode("utf-8"))["projects"]
+            pairs = [(p["name"], p.get("index")) for p in projects]
+        except (ValueError, KeyError, TypeError) as err:
+            return self._send(400, {"error": "Bad request: {!r}".format(err)})
+        self._send(200, {"projects": self.server.service.versions(pairs)})
+
+    def _send(self, code, data):
+        body = json.dumps(data).encode("utf-8")
+        self.send_response(code)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def address_string(self):
+        # clients on a unix socket have no address
+        return str(self.client_address[0]) if self.client_address else "local"
+
+
+class _TCPServiceServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+
+class _UnixServiceServer(ThreadingMixIn, UnixStreamServer):
+    daemon_threads = True
+
+    def server_bind(self):
+        if os.path.exists(self.server_address):
+            # left behind by a server which didn't get to clean up
+            os.remove(self.server_address)
+        UnixStreamServer.server_bind(self)
+
+    def server_close(self):
+        UnixStreamServer.server_close(self)
+        if os.path.exists(self.server_address):
+            os.remove(self.server_address)
+
+
+def _parse_address(address):
+    """(unix socket path, None) or (host, port) for a ``luddite serve`` address"""
+    host, sep, port = address.rpartition(":")
+    if os.sep in address or not sep or not port.isdigit():
+        return address, None
+    return host or "127.0.0.1", int(port)
+
+
+def make_server(address, service):
+    """A threaded HTTP server for ``service``, on a unix socket if ``address`` is a path"""
+    host, port = _parse_address(address)
+    if port is None:
+        server = _UnixServiceServer(host, _ServiceHandler)
+    else:
+        server = _TCPServiceServer((host, port), _ServiceHandler)
+    server.service = service
+    return server
+
+
+class _UnixHTTPConnection(HTTPConnection):
+    def __init__(self, socket_path, timeout=None):
+        HTTPConnection.__init__(self, "localhost", timeout=timeout)
+        self.socket_path = socket_path
+
+    def connect(self):
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.settimeout(self.timeout)
+        self.sock.connect(self.socket_path)
+
+
+class VersionClient(object):
+    """A worker which asks a ``luddite serve`` daemon instead of the index.
+
+    ``prefetch`` gets the versions of many projects in one request, and lookups
+    are then answered from what came back. ``timeout`` is for connecting to the
+    daemon, ``read_timeout`` (by default none) for waiting on its answer - which only
+    comes once it has looked everything up, on its own timeouts.
+    """
+
+    def __init__(self, address=DEFAULT_SERVER, timeout=10, read_timeout=None):
+        self.address = address
+        self.timeout = timeout
+        self.read_timeout = read_timeout
+        self._results = {}
+        self._lock = threading.Lock()
+
+    def _connection(self):
+        host, port = _parse_address(self.address)
+        if port is None:
+            return _UnixHTTPConnection(host, timeout=self.timeout)
+        return HTTPConnection(host, port, timeout=self.timeout)
+
+    def request(self, projects):
+        """The daemon's results for (name, index) pairs"""
+        payload = {"projects": [{"name": name, "index": index} for name, index in projects]}
+        conn = self._connection()
+        try:
+            conn.connect()
+            conn.sock.settimeout(self.read_timeout)
+            body = json.dumps(payload).encode("utf-8")
+            conn.request("POST", "/versions", body, {"Content-Type": "application/json"})
+            response = conn.getresponse()
+            data = json.loads(response.read().decode("utf-8"))
+        finally:
+            conn.close()
+        if response.status != 200:
+            raise LudditeError("luddite serve said: {}".format(data.get("error")))
+        return data["projects"]
+
+    def prefetch(self, projects):
+        projects = list(projects)
+        try:
+            results = self.request(projects)
+        except (EnvironmentError, HTTPException, ValueError, LudditeError) as err:
+            msg = "no answer from luddite serve at {} ({})".format(self.address, err)
+            results = [{"error": msg}] * len(projects)
+        with self._lock:
+            for (name, index), result in zip(projects, results):
+                self._results[index, canonicalize_name(name)] = result
+
+    def __call__(self, name, index=None, **kwargs):
+        key = index, canonicalize_name(name)
+        if key not in self._results:
+            self.prefetch([(name, index)])
+        result = self._results[key]
+        if "error" in result:
+            error = socket.timeout if result.get("late") else LudditeError
+            raise error(result["error"])
+        return VersionIndex(result["versions"])
+
+
+def _add_fetch_arguments(parser):
+    """Options shared by the check, ``snapshot`` and ``serve`` commands"""
+    parser.add_argument(
+        "fname",
+        nargs="*",
+        default=[DEFAULT_FNAME],
+        metavar="<requirements.txt>",
+        help="one or more files, or glob patterns",
+    )
     parser.add_argument("-i", "--index-url", metavar="<url>")
-    parser.add_argument("-n", "--n-threads", type=int, default=4, metavar="<N>")
+    parser.add_argument(
+        "--extra-index-url",
+        action="append",
+        default=[],
+        metavar="<url>",
+        help="another index to look projects up on, merging the versions (may be repeated)",
+    )
+    parser.add_argument(
+        "-n",
+        "--n-threads",
+        type=int,
+        metavar="<N>",
+        help="concurrent lookups (default 4), the most allowed with --adaptive (default 32)",
+    )
+    parser.add_argument(
+        "--adaptive",
+        action="store_true",
+        help="find out how many concurrent lookups the index can take, backing off if it's busy",
+    )
+    parser.add_argument("--cache", action="store_true", help="cache index responses on disk")
+    parser.add_argument("--cache-dir", metavar="<dir>", help="implies --cache")
+    parser.add_argument("--cache-max-age", type=float, default=300, metavar="<seconds>")
+    parser.add_argument(
+        "--stream",
+        action="store_true",
+        help="parse index responses as they arrive, keeping only the version data",
+    )
+    parser.add_argument(
+        "--processes",
+        type=int,
+        metavar="<N>",
+        help="decode index responses in N worker processes (0 for one per CPU)",
+    )
+    parser.add_argument(
+        "--timeout",
+        type=float,
+        default=10,
+        metavar="<seconds>",
+        help="for connecting to the index (default 10)",
+    )
+    parser.add_argument(
+        "--read-timeout",
+        type=float,
+        default=60,
+        metavar="<seconds>",
+        help="for each read from the index (default 60)",
+    )
+    parser.add_argument(
+        "--profile",
+        action="store_true",
+        help="print where the time went: phases and the slowest lookups",
+    )
+    parser.add_argument(
+        "--profile-json",
+        metavar="<file>",
+        help="write the profile data as JSON to a file ('-' for stdout)",
+    )
+
+
+def _throttle(args):
+    """Resolves the -n default, and returns the throttle for --adaptive (or None)"""
+    if args.n_threads is None:
+        args.n_threads = 32 if args.adaptive else 4
+    if args.adaptive:
+        return Throttle(initial=min(4, args.n_threads), maximum=args.n_threads)
+
+
+def _profile(args):
+    if args.profile or args.profile_json:
+        return Profile()
+
+
+def _report_profile(args, profile):
+    if profile is None:
+        return
+    profile.finish()
+    if args.profile:
+        profile.report()
+    if args.profile_json == "-":
+        print(profile.to_json())
+    elif args.profile_json:
+        with open(args.profile_json, "w") as f:
+            f.write(profile.to_json())
+
+
+def _caches(args):
+    """The (response cache, index type cache) asked for on the command line"""
+    if not (args.cache or args.cache_dir):
+        return None, None
+    cache_dir = args.cache_dir or DEFAULT_CACHE_DIR
+    cache = ResponseCache(os.path.join(cache_dir, "http"), max_age=args.cache_max_age)
+    type_cache = IndexTypeCache(os.path.join(cache_dir, "index-types.json"))
+    return cache, type_cache
+
+
+@contextmanager
+def _decoder(args):
+    """The process pool for --processes, shut down afterwards (None without it)"""
+    if args.processes is None:
+        yield None
+        return
+    decoder = ProcessPoolExecutor(max_workers=args.processes or None)
+    try:
+        yield decoder
+    finally:
+        decoder.shutdown()
+
+
+def _not_found(args):
+    """Which indexes don't have which projects, kept with the response cache if there is one"""
+    path = None
+    if args.cache or args.cache_dir:
+        path = os.path.join(args.cache_dir or DEFAULT_CACHE_DIR, "not-found.json")
+    return NotFoundCache(path)
+
+
+def _changelog(args):
+    """Serial tracking for the response cache, if there is one"""
+    if args.cache or args.cache_dir:
+        cache_dir = args.cache_dir or DEFAULT_CACHE_DIR
+        return ChangeLog(os.path.join(cache_dir, "serials.json"), timeout=args.timeout)
+
+
+def _expand_globs(patterns):
+    fnames = []
+    for pattern in patterns:
+        try:
+            matches = glob.glob(pattern, recursive=True)
+        except TypeError:
+            # Python 2
+            matches = glob.glob(pattern)
+        fnames.extend(sorted(matches) or [pattern])
+    return fnames
+
+
+def snapshot_main(argv):
+    parser = argparse.ArgumentParser(
+        prog="luddite snapshot",
+        description="Saves the versions of every project in the requirements files for --offline use",
+    )
+    _add_fetch_arguments(parser)
+    parser.add_argument(
+        "-o", "--output", default="luddite-snapshot.db", metavar="<snapshot>", help="file to write"
+    )
+    parser.add_argument(
+        "-p",
+        "--project",
+        action="append",
+        default=[],
+        metavar="<name>",
+        help="another project to include (may be repeated)",
+    )
+    parser.set_defaults(fname=[])
+    args = parser.parse_args(argv)
+    if not args.fname:
+        args.fname = [] if args.project else [DEFAULT_FNAME]
+    cache, type_cache = _caches(args)
+    throttle = _throttle(args)
+    profile = _profile(args)
+    not_found = _not_found(args)
+    names = []
+    worker_for = None
+    pool = HTTPPool(maxsize=args.n_threads, timeout=args.timeout, read_timeout=args.read_timeout)
+    with pool, _decoder(args) as decoder:
+        index = args.index_url
+        if args.fname:
+            luddite = Luddite(
+                fname=_expand_globs(args.fname),
+                index=index,
+                pool=pool,
+                type_cache=type_cache,
+                profile=profile,
+                extra_indexes=args.extra_index_url,
+                not_found=not_found,
+            )
+            index = luddite.index
+            worker_for = luddite.worker_for
+            for req_file in luddite.req_files:
+                file_index = luddite.index_for(req_file)
+                names.extend((line.req.name, file_index) for line in req_file.lines if line.req)
+        index = index or get_index_url()
+        names.extend((name, index) for name in args.project)
+        if worker_for is None and args.extra_index_url:
+            extras = args.extra_index_url
+
+            def worker_for(index):
+                indexes = [index] + [url for url in extras if url != index]
+                return IndexGroup(indexes, type_cache=type_cache, not_found=not_found)
+
+        snapshot, failed = take_snapshot(
+            args.output,
+            names,
+            index=index,
+            worker_for=worker_for,
+            n_threads=args.n_threads,
+            cache=cache,
+            pool=pool,
+            stream=args.stream,
+            throttle=throttle,
+            profile=profile,
+            decoder=decoder,
+        )
+    not_found.save()
+    for name, err in sorted(failed.items()):
+        cprint("💩 couldn't get {}, sorry ({})".format(name, err), color="magenta")
+    print("{} projects saved to {}".format(len(snapshot), snapshot.path))
+    snapshot.close()
+    _report_profile(args, profile)
+
+
+def serve_main(argv):
+    parser = argparse.ArgumentParser(
+        prog="luddite serve",
+        description="Keeps version data in memory for 'luddite --server' to check against",
+    )
+    _add_fetch_arguments(parser)
+    parser.add_argument(
+        "--listen",
+        default=DEFAULT_SERVER,
+        metavar="<address>",
+        help="host:port, or the path of a unix socket (default %(default)s)",
+    )
+    parser.add_argument(
+        "--ttl",
+        type=float,
+        default=300,
+        metavar="<seconds>",
+        help="refresh version data older than this (default 300)",
+    )
+    parser.add_argument(
+        "--max-age",
+        type=float,
+        default=3600,
+        metavar="<seconds>",
+        help="forget version data older than this, which nobody asked for since (default 3600)",
+    )
+    # requirements files given are looked up straight away, to warm up
+    parser.set_defaults(fname=[])
+    args = parser.parse_args(argv)
+    cache, type_cache = _caches(args)
+    throttle = _throttle(args)
+    profile = _profile(args)
+    pool = HTTPPool(maxsize=args.n_threads, timeout=args.timeout, read_timeout=args.read_timeout)
+    with pool, _decoder(args) as decoder:
+        service = VersionService(
+            index=args.index_url,
+            ttl=args.ttl,
+            max_age=args.max_age,
+            n_threads=args.n_threads,
+            pool=pool,
+            type_cache=type_cache,
+            extra_indexes=args.extra_index_url,
+            not_found=_not_found(args),
+            cache=cache,
+            stream=args.stream,
+            throttle=throttle,
+            profile=profile,
+            decoder=decoder,
+        )
+        if args.fname:
+            luddite = Luddite(fname=_expand_globs(args.fname), index=args.index_url, pool=pool)
+            for _, index, line, key in luddite.lookups():
+                if key is not None:
+                    service.lookup(line.req.name, index)
+        server = make_server(args.listen, service)
+        print("luddite serve listening on {}".format(args.listen))
+        sys.stdout.flush()
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            server.server_close()
+            service.close()
+            service.not_found.save()
+    _report_profile(args, profile)
+
+
+def main(argv=None):
+    argv = sys.argv[1:] if argv is None else argv
+    if argv[:1] == ["snapshot"]:
+        return snapshot_main(argv[1:])
+    if argv[:1] == ["serve"]:
+        return serve_main(argv[1:])
+    version_str = "%(prog)s v{}".format(__version__)
+    parser = argparse.ArgumentParser(
+        description="Luddite checks for out-of-date package versions",
+        epilog=(
+            "Give '-' to read requirements from stdin. "
+            "Use 'luddite snapshot' to save index data for --offline checks, "
+            "or 'luddite serve' to keep it in memory for --server checks."
+        ),
+    )
+    _add_fetch_arguments(parser)
+    parser.add_argument("--engine", choices=["threads", "asyncio"], default="threads")
+    parser.add_argument(
+        "--offline", metavar="<snapshot>", help="look versions up in a snapshot, not the index"
+    )
+    parser.add_argument(
+        "--env",
+        action="append",
+        default=[],
+        metavar="<path>",
+        help="check what's installed in a virtualenv or site-packages (may be repeated, or a glob)",
+    )
+    parser.add_argument(
+        "--mirror",
+        action="append",
+        default=[],
+        metavar="<url>",
+        help="a mirror of the index, for slow lookups to be retried on (may be repeated)",
+    )
+    parser.add_argument(
+        "--server",
+        default=os.environ.get("LUDDITE_SERVER"),
+        metavar="<address>",
+        help="check against a 'luddite serve' daemon (host:port or unix socket path)",
+    )
+    parser.add_argument(
+        "--deadline",
+        type=float,
+        metavar="<seconds>",
+        help="report lookups still unfinished after this long as timed out",
+    )
+    parser.add_argument(
+        "--watch",
+        action="store_true",
+        help="check again whenever the files change, looking up only new projects",
+    )
+    parser.add_argument(
+        "--format",
+        choices=["text", "ndjson"],
+        default="text",
+        help="ndjson prints a JSON record per requirement as soon as it's looked up",
+    )
     parser.add_argument("-v", "--version", action="version", version=version_str)
-    args = parser.parse_args()
-    luddite = Luddite(fname=args.fname, index=args.index_url)
-    luddite.run(n_threads=args.n_threads)
+    parser.set_defaults(fname=[])
+    args = parser.parse_args(argv)
+    if args.fname == ["-"]:
+        unsupported = [
+            option
+            for option, given in [
+                ("--engine asyncio", args.engine != "threads"),
+                ("--env", args.env),
+                ("--mirror", args.mirror),
+                ("--deadline", args.deadline is not None),
+                ("--watch", args.watch),
+            ]
+            if given
+        ]
+        if unsupported:
+            parser.error("{} can't be used when reading from stdin".format(", ".join(unsupported)))
+    if args.engine == "asyncio" and args.stream:
+        parser.error("--stream can't be used with --engine asyncio")
+    if not args.fname:
+        args.fname = [] if args.env else [DEFAULT_FNAME]
+    cache, type_cache = _caches(args)
+    throttle = _throttle(args)
+    profile = _profile(args)
+    snapshot = Snapshot(args.offline) if args.offline else None
+    server = VersionClient(args.server, timeout=args.timeout) if args.server else None
+    changelog = _changelog(args)
+    not_found = _not_found(args)
+    pool = HTTPPool(maxsize=args.n_threads, timeout=args.timeout, read_timeout=args.read_timeout)
+    with pool, _decoder(args) as decoder:
+        if args.fname == ["-"]:
+            # a pipe, e.g. from pip freeze: checked line by line as it comes
+            worker = snapshot or server
+            results = check(
+                sys.stdin,
+                index=args.index_url,
+                n_threads=args.n_threads,
+                worker_for=None if worker is None else lambda index: worker,
+                pool=pool,
+                type_cache=type_cache,
+                extra_indexes=args.extra_index_url,
+                not_found=not_found,
+                cache=cache,
+                stream=args.stream,
+                throttle=throttle,
+                profile=profile,
+                changelog=changelog,
+                decoder=decoder,
+            )
+            print_results(results, args.format)
+            if changelog is not None:
+                changelog.save()
+            not_found.save()
+            _report_profile(args, profile)
+            return
+        luddite = Luddite(
+            fname=_expand_globs(args.fname),
+            index=args.index_url,
+            cache=cache,
+            pool=pool,
+            stream=args.stream,
+            type_cache=type_cache,
+            snapshot=snapshot,
+            throttle=throttle,
+            profile=profile,
+            output_format=args.format,
+            server=server,
+            envs=_expand_globs(args.env),
+            mirrors=args.mirror,
+            changelog=changelog,
+            decoder=decoder,
+            extra_indexes=args.extra_index_url,
+            not_found=not_found,
+        )
+        if args.engine == "asyncio":
+            run = partial(luddite.run_async, concurrency=args.n_threads, deadline=args.deadline)
+        else:
+            run = partial(luddite.run, n_threads=args.n_threads, deadline=args.deadline)
+        if args.watch:
+            luddite.watch(run)
+        else:
+            run()
+    _report_profile(args, profile)
 
 
 if __name__ == "__main__":
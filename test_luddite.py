@@ -1,11 +1,17 @@
 # coding: utf-8
 from __future__ import unicode_literals
 
+import io
 import json
+import os
+import pickle
 import sys
-from subprocess import CalledProcessError
+import time
+import zlib
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 
 import pytest
+from packaging.specifiers import SpecifierSet
 
 import luddite
 
@@ -77,15 +83,50 @@ def test_index_lookup_failed(mocker):
 
 
 def test_package_unpinned(mocker):
-    line = luddite.RequirementsLine("dist>=1.0")
+    line = luddite.RequirementsLine("dist")
     worker = mocker.Mock(side_effect=Exception)
     assert line.process(worker) == "free"
 
 
+def test_package_range(mocker):
+    line = luddite.RequirementsLine("dist>=1.0")
+    worker = mocker.Mock(return_value=("0.9", "1.0", "1.1"))
+    assert line.process(worker) == "pass"
+    assert line.allowed == line.latest == "1.1"
+
+
 def test_multiple_constraints(mocker):
     line = luddite.RequirementsLine("dist>=1.5,<2.0")
-    worker = mocker.Mock(side_effect=Exception)
-    assert line.process(worker) == "free"
+    worker = mocker.Mock(return_value=("1.4", "1.5", "1.9", "1.10", "2.0", "2.1"))
+    assert line.version is None
+    assert line.process(worker) == "fail"
+    assert line.allowed == "1.10"
+    assert line.latest_non_pre == "2.1"
+    template, _color = luddite._result_template("fail", line.ranged)
+    assert template.format(**vars(line)) == "✖ dist<2.0,>=1.5 allows up to 1.10 (index has 2.1)"
+    assert luddite.RequirementsLine("dist>=3").process(worker) == "gone"
+
+
+@pytest.mark.parametrize(
+    "specifier, allowed",
+    [
+        ("<2", "1.9"),
+        ("<=2.0", "2.0+local"),
+        (">1.0", "2.0+local"),
+        ("==1.*", "1.9"),
+        ("==2.0", "2.0+local"),
+        ("!=2.0,!=2.0+local,<2.1", "1.9"),
+        ("~=1.0", "1.9"),
+        ("~=1.0.0", "1.0.post1"),
+        (">=2.1a1", "2.1rc1"),
+        (">=3", None),
+        ("===1.0.post1", "1.0.post1"),
+    ],
+)
+def test_version_index_newest(specifier, allowed):
+    versions = ["0.9", "1.0", "1.0.post1", "1.9", "2.0", "2.0+local", "2.1rc1"]
+    index = luddite.VersionIndex(versions)
+    assert index.newest(SpecifierSet(specifier)) == allowed
 
 
 def test_parse_reqs_file(tmpdir):
@@ -155,28 +196,65 @@ def test_json_get_fails(mocker):
     assert cm.value.response_data == b"boom"
 
 
-def test_autodetect_index_url(mocker, tmpdir):
+def test_autodetect_index_url(mocker, tmpdir, monkeypatch):
+    monkeypatch.delenv("PIP_INDEX_URL", raising=False)
+    pip_conf = tmpdir.join("pip.conf")
+    pip_conf.write("[global]\nindex-url = https://test-index/\n")
+    monkeypatch.setenv("PIP_CONFIG_FILE", str(pip_conf))
     reqs = tmpdir.join("requirements.txt")
     reqs.write("whatever")
-    mocker.patch("luddite.subprocess.check_output", return_value=b"https://test-index/")
     mocker.patch("luddite.guess_index_type", return_value="pypi")
     lud = luddite.Luddite(reqs)
     assert lud.index == "https://test-index/"
     assert lud.get_versions is luddite.get_versions_pypi
 
 
+def test_autodetect_index_url_from_env(monkeypatch):
+    monkeypatch.setenv("PIP_INDEX_URL", "https://env-index/")
+    assert luddite.get_index_url() == "https://env-index/"
+
+
 def test_autodetect_index_url_failed(mocker, tmpdir, monkeypatch):
     monkeypatch.delenv("PIP_INDEX_URL", raising=False)
     monkeypatch.delenv("LUDDITE_DEFAULT_INDEX", raising=False)
+    monkeypatch.setenv("PIP_CONFIG_FILE", os.devnull)
     reqs = tmpdir.join("requirements.txt")
     reqs.write("whatever")
-    mocker.patch("luddite.subprocess.check_output", side_effect=CalledProcessError(1, "wtf"))
     mocker.patch("luddite.guess_index_type", return_value="devpi")
     lud = luddite.Luddite(reqs)
     assert lud.index == luddite.DEFAULT_INDEX == "https://pypi.org/pypi/"
     assert lud.get_versions is luddite.get_versions_devpi
 
 
+def test_index_type_cached(mocker, tmpdir):
+    type_cache = luddite.IndexTypeCache(str(tmpdir.join("types.json")), ttl=60)
+    guess = mocker.patch("luddite.guess_index_type", return_value="devpi")
+    assert luddite.choose_worker("http://idx/", type_cache=type_cache) is luddite.get_versions_devpi
+    assert luddite.choose_worker("http://idx/", type_cache=type_cache) is luddite.get_versions_devpi
+    guess.assert_called_once_with("http://idx/", pool=None)
+    type_cache.ttl = 0
+    luddite.choose_worker("http://idx/", type_cache=type_cache)
+    assert guess.call_count == 2
+
+
+def test_index_probe_does_not_block_queueing(mocker):
+    release = luddite.threading.Event()
+
+    def slow_guess(index_url, pool=None):
+        release.wait()
+        return "pypi"
+
+    mocker.patch("luddite.guess_index_type", side_effect=slow_guess)
+    worker = mocker.patch("luddite.get_versions_pypi", return_value=("1.0",))
+    probe = luddite.IndexProbe("http://idx/")
+    with luddite.ThreadPoolExecutor(max_workers=1) as executor:
+        future = executor.submit(probe, "dist", index="http://idx/")
+        assert not future.done()
+        release.set()
+        assert future.result() == ("1.0",)
+    worker.assert_called_once_with("dist", index="http://idx/")
+
+
 def test_guess_index_type_pypi(mocker):
     mock_response = mocker.MagicMock()
     mock_response.code = 200
@@ -237,6 +315,7 @@ def test_integration(tmpdir, capsys, mocker, monkeypatch):
     }
     mock_response.read.return_value = json.dumps(releases).encode()
     mocker.patch("luddite.urlopen", return_value=mock_response)
+    mocker.patch("luddite.HTTPPool.urlopen", return_value=mock_response)
     mocker.patch("sys.argv", "luddite -i http://index-from-cmdline".split())
 
     tmpdir.join("requirements.txt").write(
@@ -298,3 +377,1532 @@ def test_yanked_versions_skipped(mocker):
     mocker.patch("luddite.get_charset", return_value="utf-8")
     vs = luddite.get_versions_pypi("dist", "http://myindex/+simple/")
     assert vs == ("1.1", "1.2", "1.4")
+
+
+def test_json_get_cache_fresh_hit(mocker, tmpdir):
+    cache = luddite.ResponseCache(str(tmpdir), max_age=60)
+    cache.set("http://example.org/dist/json", b'{"cached": true}')
+    mock_urlopen = mocker.patch("luddite.urlopen")
+    assert luddite.json_get("http://example.org/dist/json", cache=cache) == {"cached": True}
+    assert not mock_urlopen.called
+
+
+def test_json_get_cache_revalidated_with_304(mocker, tmpdir):
+    cache = luddite.ResponseCache(str(tmpdir), max_age=0)
+    cache.set("http://example.org/dist/json", b'{"cached": true}', etag='"abc"')
+    error = luddite.HTTPError("http://example.org/dist/json", 304, "Not Modified", {}, None)
+    mock_urlopen = mocker.patch("luddite.urlopen", side_effect=error)
+    assert luddite.json_get("http://example.org/dist/json", cache=cache) == {"cached": True}
+    [request], _kwargs = mock_urlopen.call_args
+    assert request.get_header("If-none-match") == '"abc"'
+
+
+def test_json_get_stores_validators(mocker, tmpdir):
+    cache = luddite.ResponseCache(str(tmpdir))
+    mock_response = mocker.MagicMock()
+    mock_response.code = 200
+    mock_response.read.return_value = b'{"fresh": true}'
+    mock_response.headers = mocker.MagicMock()
+    mock_response.headers.get_content_charset.return_value = "utf-8"
+    mock_response.headers.get.side_effect = {"ETag": '"xyz"', "Last-Modified": None}.get
+    mocker.patch("luddite.urlopen", return_value=mock_response)
+    assert luddite.json_get("http://example.org/dist/json", cache=cache) == {"fresh": True}
+    entry = cache.get("http://example.org/dist/json")
+    assert entry["etag"] == '"xyz"'
+    assert entry["body"] == b'{"fresh": true}'
+
+
+def test_response_cache_evicts_least_recently_used(tmpdir):
+    cache = luddite.ResponseCache(str(tmpdir), max_size=700)
+    cache.set("http://example.org/a", b"a" * 150)
+    cache.set("http://example.org/b", b"b" * 150)
+    os.utime(cache._fname("http://example.org/a"), (0, 0))
+    cache.set("http://example.org/c", b"c" * 150)
+    assert cache.get("http://example.org/a") is None
+    assert cache.get("http://example.org/b") is not None
+    assert cache.get("http://example.org/c") is not None
+
+
+def test_response_cache_set_unwritable(mocker, tmpdir):
+    cache = luddite.ResponseCache(str(tmpdir))
+    mocker.patch("os.replace" if hasattr(os, "replace") else "os.rename", side_effect=OSError)
+    cache.set("http://example.org/a", b"a")
+    assert cache.get("http://example.org/a") is None
+    assert tmpdir.listdir() == []
+
+
+def _mock_conn(mocker, *responses):
+    conn = mocker.MagicMock()
+    conn.getresponse.side_effect = [
+        mocker.MagicMock(status=status, msg=headers, will_close=False, **{"read.return_value": body})
+        for status, headers, body in responses
+    ]
+    return conn
+
+
+def test_pool_reuses_connections(mocker):
+    mocker.patch("luddite.getproxies", return_value={})
+    conn = _mock_conn(mocker, (200, {}, b"1"), (200, {}, b"2"))
+    new_conn = mocker.patch("luddite.HTTPPool._new_conn", return_value=conn)
+    pool = luddite.HTTPPool(maxsize=2)
+    assert pool.urlopen(luddite.Request("https://pypi.org/pypi/a/json")).read() == b"1"
+    assert pool.urlopen(luddite.Request("https://pypi.org/pypi/b/json")).read() == b"2"
+    new_conn.assert_called_once_with("https", "pypi.org")
+    assert conn.request.call_args_list[1][0][:2] == ("GET", "/pypi/b/json")
+
+
+def test_pool_follows_redirects(mocker):
+    mocker.patch("luddite.getproxies", return_value={})
+    conn = _mock_conn(mocker, (301, {"Location": "/pypi/b/json"}, b""), (200, {}, b"ok"))
+    mocker.patch("luddite.HTTPPool._new_conn", return_value=conn)
+    response = luddite.HTTPPool().urlopen(luddite.Request("https://pypi.org/pypi/B/json"))
+    assert response.code == 200
+    assert response.url == "https://pypi.org/pypi/b/json"
+
+
+def test_pool_retries_stale_keepalive_connection(mocker):
+    mocker.patch("luddite.getproxies", return_value={})
+    stale = mocker.MagicMock()
+    stale.request.side_effect = luddite.socket.error("connection reset")
+    fresh = _mock_conn(mocker, (200, {}, b"ok"))
+    mocker.patch("luddite.HTTPPool._new_conn", return_value=fresh)
+    pool = luddite.HTTPPool()
+    pool._put_conn(("https", "pypi.org"), stale)
+    assert pool.urlopen(luddite.Request("https://pypi.org/pypi/a/json")).read() == b"ok"
+    assert stale.close.called
+
+
+@pytest.mark.skipif(sys.version_info < (3,), reason="Python 3 only")
+@pytest.mark.parametrize("payload", [
+    b"HTTP/1.1 200 OK\r\nContent-Length: 5\r\n\r\nhello",
+    b"HTTP/1.1 200 OK\r\nTransfer-Encoding: chunked\r\n\r\n2\r\nhe\r\n3\r\nllo\r\n0\r\n\r\n",
+])
+def test_async_connection_message_framing(mocker, payload):
+    conn = luddite._AsyncHTTPConnection()
+    conn.connection_made(mocker.MagicMock())
+    waiter = mocker.MagicMock()
+    waiter.done.return_value = False
+    conn.request("GET", b"", waiter)
+    conn.data_received(payload[:-3])
+    assert not waiter.set_result.called
+    conn.data_received(payload[-3:] + b"HTTP/1.1 ...")
+    waiter.set_result.assert_called_once_with(payload)
+    response = luddite.HTTPResponse(luddite._BytesSocket(payload), method="GET")
+    response.begin()
+    assert response.read() == b"hello"
+
+
+@pytest.mark.skipif(sys.version_info < (3,), reason="Python 3 only")
+@pytest.mark.parametrize("payload", [
+    b"HTTP/1.1 200 OK\r\nTransfer-Encoding: chunked\r\n\r\nzz\r\n",
+    b"garbage\r\n\r\n",
+])
+def test_async_connection_malformed_response(mocker, payload):
+    conn = luddite._AsyncHTTPConnection()
+    conn.connection_made(mocker.MagicMock())
+    waiter = mocker.MagicMock()
+    waiter.done.return_value = False
+    conn.request("GET", b"", waiter)
+    conn.data_received(payload)
+    [err], _kwargs = waiter.set_exception.call_args
+    assert isinstance(err, luddite.HTTPException)
+    assert conn.closed
+
+
+@pytest.mark.skipif(sys.version_info < (3,), reason="Python 3 only")
+@pytest.mark.enable_socket  # the event loop's self-pipe is a socketpair
+def test_run_async_same_output_as_run(mocker, tmpdir, capsys):
+    reqs = tmpdir.join("requirements.txt")
+    reqs.write("# comment\ndist1==1.1\nwhat the feck\ndist2==1.4\ndist3\n")
+    mocker.patch("luddite.guess_index_type", return_value="pypi")
+    lud = luddite.Luddite(str(reqs), index="http://myindex/")
+    lud.get_versions = mocker.Mock(return_value=("1.1", "1.4"))
+    lud.run()
+    threaded = capsys.readouterr().out
+    lud.run_async(concurrency=2)
+    assert capsys.readouterr().out == threaded
+
+
+@pytest.mark.skipif(sys.version_info < (3,), reason="Python 3 only")
+@pytest.mark.enable_socket  # the event loop's self-pipe is a socketpair
+def test_run_async_fetches_on_the_loop(mocker, tmpdir, capsys):
+    reqs = tmpdir.join("requirements.txt")
+    reqs.write("dist1==1.1\ndist2==1.4\n")
+    mocker.patch("luddite.guess_index_type", return_value="devpi")
+    lud = luddite.Luddite(str(reqs), index="http://myindex/+simple/")
+
+    def urlopen(self, request):
+        assert request.get_full_url() in ("http://myindex/dist1", "http://myindex/dist2")
+        headers = mocker.MagicMock(**{"get_content_charset.return_value": "utf-8"})
+        body = b'{"result": {"1.1": {}, "1.4": {}}}'
+        future = self.loop.create_future()
+        future.set_result(luddite.PooledResponse(request.get_full_url(), 200, headers, body))
+        return future
+
+    mocker.patch("luddite.AsyncHTTPPool.urlopen", urlopen)
+    lud.run_async()
+    out = capsys.readouterr().out
+    assert "✖ dist1 1.1 (index has 1.4)" in out
+    assert "✔ dist2 is up to date @ 1.4" in out
+
+
+@pytest.mark.skipif(sys.version_info < (3,), reason="Python 3 only")
+@pytest.mark.enable_socket  # the event loop's self-pipe is a socketpair
+def test_run_async_waits_for_probe_off_the_loop(mocker, tmpdir, capsys):
+    reqs = tmpdir.join("requirements.txt")
+    reqs.write("dist1==1.1\ndist2==1.4\n")
+    probing = luddite.threading.Event()
+
+    def guess_index_type(index_url, pool=None):
+        probing.wait(5)
+        return "devpi"
+
+    mocker.patch("luddite.guess_index_type", guess_index_type)
+    lud = luddite.Luddite(str(reqs), index="http://myindex/+simple/")
+
+    def urlopen(self, request):
+        headers = mocker.MagicMock(**{"get_content_charset.return_value": "utf-8"})
+        body = b'{"result": {"1.1": {}, "1.4": {}}}'
+        future = self.loop.create_future()
+        future.set_result(luddite.PooledResponse(request.get_full_url(), 200, headers, body))
+        return future
+
+    mocker.patch("luddite.AsyncHTTPPool.urlopen", urlopen)
+    original = luddite.Luddite._fetch_async
+
+    def fetch_async(self, pool, name, index, *args):
+        # the probe can only finish if the loop keeps running meanwhile
+        pool.loop.call_soon(probing.set)
+        return original(self, pool, name, index, *args)
+
+    mocker.patch("luddite.Luddite._fetch_async", fetch_async)
+    start = time.time()
+    lud.run_async()
+    assert time.time() - start < 2
+    out = capsys.readouterr().out
+    assert "✖ dist1 1.1 (index has 1.4)" in out
+    assert "✔ dist2 is up to date @ 1.4" in out
+
+
+@pytest.mark.skipif(sys.version_info < (3,), reason="Python 3 only")
+@pytest.mark.enable_socket  # the event loop's self-pipe is a socketpair
+def test_run_async_probe_failed(mocker, tmpdir, capsys):
+    reqs = tmpdir.join("requirements.txt")
+    reqs.write("dist1==1.1\ndist2==1.4\ndist3==1.0\n")
+    mocker.patch("luddite.guess_index_type", side_effect=luddite.LudditeError("index is down"))
+    lud = luddite.Luddite(str(reqs), index="http://myindex/")
+    probe = lud.worker_for(lud.index)
+    with pytest.raises(luddite.LudditeError):
+        probe.result()
+    lud.run_async(concurrency=1)
+    out = capsys.readouterr().out
+    for name in "dist1", "dist2", "dist3":
+        assert "💩 couldn't get {}, sorry (index is down)".format(name) in out
+
+
+@pytest.mark.skipif(sys.version_info < (3,), reason="Python 3 only")
+@pytest.mark.enable_socket  # the event loop's self-pipe is a socketpair
+def test_run_async_deadline_with_slow_probe(mocker, tmpdir, capsys):
+    reqs = tmpdir.join("requirements.txt")
+    reqs.write("dist1==1.1\ndist2==1.4\n")
+    released = luddite.threading.Event()
+
+    def guess_index_type(index_url, pool=None):
+        released.wait(5)
+        return "pypi"
+
+    mocker.patch("luddite.guess_index_type", guess_index_type)
+    start = time.time()
+    try:
+        luddite.Luddite(str(reqs), index="http://myindex/").run_async(deadline=0.2)
+    finally:
+        released.set()
+    assert time.time() - start < 2
+    out = capsys.readouterr().out
+    assert out.count("in time (gave up at the 0.2s deadline)") == 2
+
+
+def test_multiple_files_share_lookups(mocker, tmpdir, capsys):
+    reqs1 = tmpdir.join("requirements1.txt")
+    reqs1.write("dist1==1.1\nDist_2==1.4\n")
+    reqs2 = tmpdir.join("requirements2.txt")
+    reqs2.write("dist-2==1.4\ndist1==1.4\n")
+    mocker.patch("luddite.guess_index_type", return_value="pypi")
+    lud = luddite.Luddite([str(reqs1), str(reqs2)], index="http://myindex/")
+    lud.get_versions = mocker.Mock(return_value=("1.1", "1.4"))
+    lud.run()
+    assert lud.get_versions.call_count == 2
+    out = capsys.readouterr().out
+    assert out.count("using index: http://myindex/") == 1
+    assert "---{}".format(reqs2) in out
+    assert "2 files checked, 2 projects looked up" in out
+    assert "     3 up to date" in out
+    assert "     1 out of date" in out
+
+
+def test_main_expands_globs(mocker, tmpdir, monkeypatch):
+    tmpdir.join("a-requirements.txt").write("dist1==1.1\n")
+    tmpdir.join("b-requirements.txt").write("dist2==1.1\n")
+    monkeypatch.chdir(tmpdir)
+    mocker.patch("sys.argv", ["luddite", "-i", "http://myindex/", "*-requirements.txt"])
+    mock_luddite = mocker.patch("luddite.Luddite")
+    luddite.main()
+    _args, kwargs = mock_luddite.call_args
+    assert kwargs["fname"] == ["a-requirements.txt", "b-requirements.txt"]
+
+
+SIMPLE_JSON = {
+    "meta": {"api-version": "1.1"},
+    "name": "dist",
+    "versions": ["1.1", "1.2", "1.3", "1.4", "2.0"],
+    "files": [
+        {"filename": "dist-1.1.tar.gz", "yanked": False},
+        {"filename": "dist-1.2-py3-none-any.whl", "yanked": False},
+        {"filename": "dist-1.2.tar.gz", "yanked": "broken"},
+        {"filename": "dist-1.3.tar.gz", "yanked": "broken"},
+        {"filename": "dist-1.4.zip"},
+    ],
+}
+
+
+def test_parse_versions_simple():
+    # 1.3 has all files yanked, 2.0 has no files at all
+    assert luddite._parse_versions_simple(SIMPLE_JSON) == ("1.1", "1.2", "1.4")
+
+
+def test_get_versions_pypi_uses_simple_api(mocker):
+    mock_response = mocker.MagicMock()
+    mock_response.code = 200
+    mock_response.read.return_value = json.dumps(SIMPLE_JSON).encode()
+    mock_urlopen = mocker.patch("luddite.urlopen", return_value=mock_response)
+    mocker.patch("luddite.get_charset", return_value="utf-8")
+    vs = luddite.get_versions_pypi("Dist[extra]", "http://simple-index/pypi/")
+    assert vs == ("1.1", "1.2", "1.4")
+    [request], _kwargs = mock_urlopen.call_args
+    assert request.get_full_url() == "http://simple-index/simple/dist/"
+    assert request.get_header("Accept") == "application/vnd.pypi.simple.v1+json"
+    assert request.get_header("Accept-encoding") == "gzip, deflate"
+
+
+def test_get_versions_pypi_falls_back_to_json_api(mocker):
+    html_response = mocker.MagicMock(code=200)
+    html_response.read.return_value = b"<!DOCTYPE html><html></html>"
+    json_response = mocker.MagicMock(code=200)
+    json_response.read.return_value = b'{"releases": {"1.0": [{}]}}'
+    mock_urlopen = mocker.patch("luddite.urlopen", side_effect=[html_response, json_response])
+    mocker.patch("luddite.get_charset", return_value="utf-8")
+    assert luddite.get_versions_pypi("dist", "http://html-index/simple") == ("1.0",)
+    mock_urlopen.side_effect = [json_response]
+    assert luddite.get_versions_pypi("dist", "http://html-index/simple") == ("1.0",)
+    [request], _kwargs = mock_urlopen.call_args
+    assert request.get_full_url() == "http://html-index/simple/dist/json"
+
+
+def test_json_get_decompresses_gzip(mocker):
+    mock_response = mocker.MagicMock(code=200)
+    mock_response.headers.get.side_effect = {"Content-Encoding": "gzip"}.get
+    mock_response.read.return_value = gzip_compress(b'{"x": 1}')
+    mocker.patch("luddite.get_charset", return_value="utf-8")
+    mocker.patch("luddite.urlopen", return_value=mock_response)
+    assert luddite.json_get("http://example.org") == {"x": 1}
+
+
+def gzip_compress(data):
+    compressor = zlib.compressobj(9, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    return compressor.compress(data) + compressor.flush()
+
+
+def test_extract_json_in_tiny_chunks():
+    doc = {
+        "info": {"version": "1.4", "description": "lots of \"text\" \\ here ☃" * 10},
+        "releases": {
+            "1.0": [{"filename": "dist-1.0.tar.gz", "yanked": False, "size": -1.5e3}],
+            "1.4": [{"filename": "dist-1.4.tar.gz"}, {"yanked": True, "digests": {"x": [1]}}],
+            "2.0": [],
+        },
+        "urls": [{"yanked": False}],
+    }
+    text = json.dumps(doc)
+    chunks = [text[i : i + 3] for i in range(0, len(text), 3)]
+    paths = [("info", "version"), ("releases", "*", "*", "yanked")]
+    assert luddite.extract_json(chunks, paths) == {
+        "info": {"version": "1.4"},
+        "releases": {"1.0": [{"yanked": False}], "1.4": [{}, {"yanked": True}], "2.0": []},
+    }
+
+
+def test_get_versions_pypi_decoder(mocker, tmpdir):
+    json_response = mocker.MagicMock(code=200)
+    json_response.read.return_value = b'{"releases": {"1.0": [{}], "1.1rc1": [{}], "0.9": []}}'
+    json_response.headers.get.return_value = None
+    mocker.patch("luddite.urlopen", return_value=json_response)
+    mocker.patch("luddite.get_charset", return_value="utf-8")
+    cache = luddite.ResponseCache(str(tmpdir))
+    with ProcessPoolExecutor(max_workers=1) as decoder:
+        vs = luddite.get_versions_pypi("dist", "http://myindex/", decoder=decoder, cache=cache)
+        assert vs == ("1.0", "1.1rc1")
+        assert vs.latest_non_pre == "1.0"
+        # cached copies are decoded by the decoder too
+        vs = luddite.get_versions_pypi("dist", "http://myindex/", decoder=decoder, cache=cache)
+        assert vs == ("1.0", "1.1rc1")
+    assert luddite.urlopen.call_count == 1
+
+
+def test_extract_json_truncated():
+    with pytest.raises(ValueError):
+        luddite.extract_json(['{"releases": {"1.0": [{"yanked": fa'], [("releases",)])
+
+
+def test_get_versions_pypi_streaming(mocker, tmpdir):
+    body = {"releases": {"1.0": [{"yanked": False, "url": "x" * 100000}], "1.1": [{"yanked": True}]}}
+    mock_response = mocker.MagicMock(code=200)
+    mock_response.read.side_effect = io.BytesIO(json.dumps(body).encode()).read
+    mock_response.headers.get.return_value = None
+    mock_response.headers.get_content_charset.return_value = "utf-8"
+    mocker.patch("luddite.urlopen", return_value=mock_response)
+    cache = luddite.ResponseCache(str(tmpdir))
+    assert luddite.get_versions_pypi("dist", "http://myindex/", stream=True, cache=cache) == ("1.0",)
+    # it's the small extract that's cached, not the whole document
+    [fname] = tmpdir.listdir()
+    assert fname.size() < 1000
+    assert mock_response.read.call_args_list[0][0] == (64 * 1024,)
+
+
+def test_extract_json_not_json():
+    chunks = ["<!DOCTYPE html>", "<html>" + " " * 1000, "</html>"]
+    with pytest.raises(ValueError):
+        luddite.extract_json(iter(chunks), [("versions",)])
+
+
+def test_pool_streaming_response_closed_on_bad_json(mocker):
+    mocker.patch("luddite.getproxies", return_value={})
+    msg = mocker.MagicMock(**{"get.return_value": None, "get_content_charset.return_value": "utf-8"})
+    raw = mocker.MagicMock(status=200, msg=msg, will_close=False)
+    body = io.BytesIO(b"<!DOCTYPE html><html>" + b" " * 200000 + b"</html>")
+    raw.read.side_effect = lambda amt=None: body.read(amt)
+    raw.isclosed.side_effect = lambda: body.tell() == len(body.getvalue())
+    conn = mocker.MagicMock(**{"getresponse.return_value": raw})
+    mocker.patch("luddite.HTTPPool._new_conn", return_value=conn)
+    pool = luddite.HTTPPool()
+    with pytest.raises(ValueError):
+        luddite.json_get("https://pypi.org/simple/a/", pool=pool, extract=[("versions",)])
+    assert not pool._busy
+    assert not pool._idle
+    conn.close.assert_called_once_with()
+    assert body.tell() < 200000
+
+
+def test_pool_streaming_response_returns_connection(mocker):
+    mocker.patch("luddite.getproxies", return_value={})
+    raw = mocker.MagicMock(status=200, msg={}, will_close=False)
+    body = io.BytesIO(b"streamed")
+    raw.read.side_effect = lambda amt=None: body.read(amt)
+    raw.isclosed.side_effect = lambda: body.tell() == len(body.getvalue())
+    conn = mocker.MagicMock(**{"getresponse.return_value": raw})
+    mocker.patch("luddite.HTTPPool._new_conn", return_value=conn)
+    pool = luddite.HTTPPool()
+    response = pool.urlopen(luddite.Request("https://pypi.org/pypi/a/json"), stream=True)
+    assert not pool._idle
+    assert response.read(4) == b"stre"
+    assert not pool._idle
+    assert response.read(4) == b"amed"
+    assert pool._idle == {("https", "pypi.org"): [conn]}
+
+
+def test_version_index():
+    index = luddite.VersionIndex.from_pairs(
+        (luddite.Version(v), v) for v in ["1.10", "1.9", "2.0rc1", "1.2"]
+    )
+    assert index == ("1.2", "1.9", "1.10", "2.0rc1")
+    assert index.latest == "2.0rc1"
+    assert index.latest_non_pre == "1.10"
+    assert "1.9" in index
+    assert "1.9.0" not in index
+
+
+def test_version_index_pickles_as_strings():
+    index = luddite.VersionIndex(["0.9", "1.0a1"])
+    data = pickle.dumps(index, protocol=2)
+    assert b"Version" not in data.replace(b"VersionIndex", b"")
+    unpickled = pickle.loads(data)
+    assert unpickled == index
+    assert unpickled.latest == "1.0a1"
+    assert unpickled.latest_non_pre == "0.9"
+    assert unpickled._parsed is None
+    assert unpickled.parsed == index.parsed
+
+
+def test_version_index_shared_between_lines(mocker):
+    index = luddite.VersionIndex(["0.9", "1.0a1"])
+    worker = mocker.Mock(return_value=index)
+    mocker.patch("luddite.Version", side_effect=Exception("should not parse again"))
+    line1 = luddite.RequirementsLine("dist==0.9")
+    line2 = luddite.RequirementsLine("dist[extra]==1.0a1")
+    assert line1.process(worker) == "warn"
+    assert line2.process(worker) == "pass"
+    assert line1.latest == line2.latest == "1.0a1"
+    assert line1.latest_non_pre == "0.9"
+    assert line1.from_versions == ""
+
+
+def test_snapshot_roundtrip(tmpdir):
+    path = str(tmpdir.join("snap.db"))
+    projects = [("Dist_One", ["1.0", "1.1"]), ("dist2", ["0.1", "0.2a1"]), ("empty", [])]
+    snapshot = luddite.Snapshot.write(path, projects, index="http://myindex/")
+    assert len(snapshot) == 3
+    assert snapshot.index == "http://myindex/"
+    versions = snapshot("dist-one")
+    assert isinstance(versions, luddite.VersionIndex)
+    assert versions == ("1.0", "1.1")
+    assert snapshot("dist2[extra]").latest_non_pre == "0.1"
+    assert snapshot("empty") == ()
+    with pytest.raises(luddite.LudditeError, match="not in the snapshot"):
+        snapshot("dist3")
+
+
+def test_take_snapshot(mocker, tmpdir):
+    def worker(name, index=None, **kwargs):
+        if name == "broken":
+            raise Exception("nope")
+        return luddite.VersionIndex(["1.0", index])
+
+    path = str(tmpdir.join("snap.db"))
+    names = ["dist1", ("dist2", "9.9"), "broken"]
+    snapshot, failed = luddite.take_snapshot(path, names, index="2.0", worker_for=lambda i: worker)
+    assert list(failed) == ["broken"]
+    assert snapshot("dist1") == ("1.0", "2.0")
+    assert snapshot("dist2") == ("1.0", "9.9")
+
+
+def test_offline_run(mocker, tmpdir, capsys):
+    snapshot = luddite.Snapshot.write(
+        str(tmpdir.join("snap.db")), [("dist1", ["1.0", "1.1"]), ("dist2", ["1.0"])]
+    )
+    guess = mocker.patch("luddite.guess_index_type")
+    reqs = tmpdir.join("requirements.txt")
+    reqs.write("dist1==1.0\ndist2==1.0\ndist3==1.0\n")
+    luddite.Luddite(str(reqs), index="http://myindex/", snapshot=snapshot).run()
+    out = capsys.readouterr().out
+    assert "✖ dist1 1.0 (index has 1.1)" in out
+    assert "✔ dist2 is up to date @ 1.0" in out
+    assert "dist3 is not in the snapshot" in out
+    assert "(of an unknown index)" in out
+    assert "using index" not in out
+    guess.assert_not_called()
+
+
+def test_main_snapshot_then_offline(mocker, tmpdir, monkeypatch, capsys):
+    tmpdir.join("requirements.txt").write("dist1==1.0\n")
+    monkeypatch.chdir(tmpdir)
+    mocker.patch("luddite.guess_index_type", return_value="pypi")
+    worker = mocker.patch("luddite.get_versions_pypi", return_value=luddite.VersionIndex(["1.0"]))
+    luddite.main(["snapshot", "-i", "http://myindex/", "-p", "dist2", "-o", "snap.db", "requirements.txt"])
+    assert "2 projects saved to snap.db" in capsys.readouterr().out
+    assert worker.call_count == 2
+    monkeypatch.setenv("PIP_INDEX_URL", "http://elsewhere/")
+    luddite.main(["--offline", "snap.db"])
+    out = capsys.readouterr().out
+    assert "✔ dist1 is up to date @ 1.0" in out
+    assert "using snapshot: snap.db (of http://myindex/)" in out
+    assert "elsewhere" not in out
+    assert worker.call_count == 2
+
+
+def test_retry_after():
+    assert luddite.retry_after({"Retry-After": "7"}) == 7
+    assert luddite.retry_after({"Retry-After": "7000"}) == 60
+    date = "Wed, 21 Oct 2015 07:28:05 GMT"
+    assert luddite.retry_after({"Retry-After": date}, now=1445412480) == 5
+    assert luddite.retry_after({"Retry-After": date}, now=1445412490) == 0
+    assert luddite.retry_after({"Retry-After": "soon"}) is None
+    assert luddite.retry_after({}) is None
+
+
+def test_json_get_retries_when_busy(mocker):
+    busy = luddite.PooledResponse("http://example.org", 503, {"Retry-After": "2"})
+    limited = luddite.PooledResponse("http://example.org", 429, {})
+    ok = luddite.PooledResponse("http://example.org", 200, {}, b'{"x": 1}')
+    pool = mocker.Mock(**{"urlopen.side_effect": [busy, limited, ok]})
+    mocker.patch("luddite.get_charset", return_value="utf-8")
+    sleep = mocker.patch("luddite.time.sleep")
+    mocker.patch("luddite.random.uniform", return_value=0.3)
+    assert luddite.json_get("http://example.org", pool=pool) == {"x": 1}
+    assert sleep.call_args_list == [mocker.call(2), mocker.call(0.3)]
+
+
+def test_json_get_gives_up_after_retries(mocker):
+    busy = luddite.PooledResponse("http://example.org", 503, {})
+    pool = mocker.Mock(**{"urlopen.return_value": busy})
+    mocker.patch("luddite.time.sleep")
+    with pytest.raises(luddite.LudditeError, match="Unexpected response code 503"):
+        luddite.json_get("http://example.org", pool=pool)
+    assert pool.urlopen.call_count == luddite.MAX_RETRIES + 1
+
+
+def test_throttle_aimd(mocker):
+    now = mocker.patch("luddite.time.time", return_value=100.0)
+    throttle = luddite.Throttle(initial=2, maximum=3)
+    throttle.record(0.1)
+    assert throttle.limit == 2.5
+    throttle.record(0.5)  # slow compared to the best seen, so no growth
+    assert throttle.limit == 2.5
+    for _ in range(10):
+        throttle.record(0.1)
+    assert throttle.limit == 3
+    throttle.record(0.1, ok=False)
+    throttle.record(0.1, ok=False)  # same round trip, not halved again
+    assert throttle.limit == 1.5
+    now.return_value += 1
+    throttle.record(0.1, ok=False, wait=5)
+    assert throttle.limit == 1
+    assert throttle.wait_time() == 5
+
+
+@pytest.mark.skipif(sys.version_info < (3,), reason="Python 3 only")
+@pytest.mark.enable_socket  # the event loop's self-pipe is a socketpair
+def test_async_json_get_retries_when_busy(mocker):
+    loop = luddite.asyncio.new_event_loop()
+    pool = luddite.AsyncHTTPPool(loop)
+    responses = [
+        luddite.PooledResponse("http://example.org", 503, {"Retry-After": "0"}),
+        luddite.PooledResponse("http://example.org", 200, {}, b'{"x": 1}'),
+    ]
+
+    def urlopen(request):
+        future = loop.create_future()
+        future.set_result(responses.pop(0))
+        return future
+
+    mocker.patch.object(pool, "urlopen", urlopen)
+    mocker.patch("luddite.get_charset", return_value="utf-8")
+    throttle = luddite.Throttle(initial=4)
+    try:
+        fetched = luddite.async_json_get(pool, "http://example.org", throttle=throttle)
+        data = loop.run_until_complete(fetched)
+    finally:
+        loop.close()
+    assert data == {"x": 1}
+    assert throttle.limit == 2.5
+
+
+def test_json_get_profile(mocker, tmpdir):
+    cache = luddite.ResponseCache(str(tmpdir), max_age=60)
+    ok = luddite.PooledResponse("http://example.org", 200, {}, b'{"x": 1}')
+    pool = mocker.Mock(**{"urlopen.return_value": ok})
+    mocker.patch("luddite.get_charset", return_value="utf-8")
+    profile = luddite.Profile()
+    luddite.json_get("http://example.org", pool=pool, cache=cache, profile=profile)
+    luddite.json_get("http://example.org", pool=pool, cache=cache, profile=profile)
+    miss, hit = profile.requests
+    assert miss["status"] == 200
+    assert miss["bytes"] == 8
+    assert miss["cache"] == "miss"
+    assert miss["seconds"] >= miss["wait"]
+    assert hit["cache"] == "hit"
+    assert set(profile.phases) == {"wait", "read", "decode"}
+    assert profile.phases["decode"][0] == 2
+
+
+def test_run_with_profile(mocker, tmpdir, capsys):
+    reqs = tmpdir.join("requirements.txt")
+    reqs.write("dist1==1.1\ndist2==1.4\n")
+    mocker.patch("luddite.guess_index_type", return_value="pypi")
+    mocker.patch("luddite._simple_uri", return_value=None)
+
+    def json_get(url, **kwargs):
+        if "dist2" in url:
+            raise luddite.LudditeError("Unexpected response code 404")
+        kwargs["profile"].add_request(url=url, status=200, bytes=123, wait=0.01)
+        return {"releases": {"1.1": [{}], "1.4": [{}]}}
+
+    mocker.patch("luddite.json_get", json_get)
+    profile = luddite.Profile()
+    luddite.Luddite(str(reqs), index="http://myindex/", profile=profile).run()
+    data = json.loads(profile.to_json())
+    assert data["requests"] == 1
+    assert data["bytes"] == 123
+    assert data["phases"]["lookup"]["count"] == 2
+    assert data["phases"]["process"]["count"] == 2
+    assert data["phases"]["probe"]["count"] == 1
+    [lookup] = [lookup for lookup in data["lookups"] if lookup["name"] == "dist1"]
+    assert lookup["bytes"] == 123
+    assert lookup["requests"][0]["url"] == "http://myindex/dist1/json"
+    [failed] = [lookup for lookup in data["lookups"] if lookup["name"] == "dist2"]
+    assert failed["error"] == "LudditeError: Unexpected response code 404"
+    profile.report()
+    out = capsys.readouterr().out
+    assert "---profile---" in out
+    assert "slowest lookups:" in out
+    assert "dist2 (0 requests, 0.0 kB, LudditeError: Unexpected response code 404)" in out
+
+
+def test_main_profile_json(mocker, tmpdir, monkeypatch, capsys):
+    tmpdir.join("requirements.txt").write("dist1==1.1\n")
+    monkeypatch.chdir(tmpdir)
+    mocker.patch("luddite.guess_index_type", return_value="pypi")
+    mocker.patch("luddite.get_versions_pypi", return_value=luddite.VersionIndex(["1.1"]))
+    luddite.main(["-i", "http://myindex/", "--profile", "--profile-json", "profile.json"])
+    assert "---profile---" in capsys.readouterr().out
+    data = json.loads(tmpdir.join("profile.json").read())
+    assert data["phases"]["process"]["count"] == 1
+
+
+def test_pool_timeouts(mocker):
+    mocker.patch("luddite.getproxies", return_value={})
+    conn = _mock_conn(mocker, (200, {}, b"1"))
+    mocker.patch("luddite.HTTPPool._new_conn", return_value=conn)
+    pool = luddite.HTTPPool(timeout=3, read_timeout=30)
+    assert pool.urlopen(luddite.Request("https://pypi.org/pypi/a/json")).read() == b"1"
+    conn.connect.assert_called_once_with()
+    conn.sock.settimeout.assert_called_once_with(30)
+
+
+def test_pool_does_not_retry_timeouts(mocker):
+    mocker.patch("luddite.getproxies", return_value={})
+    slow = mocker.MagicMock()
+    slow.getresponse.side_effect = luddite.socket.timeout("timed out")
+    new_conn = mocker.patch("luddite.HTTPPool._new_conn")
+    pool = luddite.HTTPPool()
+    pool._put_conn(("https", "pypi.org"), slow)
+    with pytest.raises(luddite.socket.timeout):
+        pool.urlopen(luddite.Request("https://pypi.org/pypi/a/json"))
+    assert not new_conn.called
+    assert not pool._busy
+
+
+def test_pool_abort(mocker):
+    conn, other = mocker.MagicMock(), mocker.MagicMock()
+    attempt = luddite._Attempt()
+    pool = luddite.HTTPPool()
+    pool._busy[conn] = attempt
+    pool._busy[other] = None
+    pool.abort(attempt)
+    conn.sock.shutdown.assert_called_once_with(luddite.socket.SHUT_RDWR)
+    assert not other.sock.shutdown.called
+    pool.abort()
+    other.sock.shutdown.assert_called_once_with(luddite.socket.SHUT_RDWR)
+
+
+def test_timeout_is_late():
+    def worker(name, index=None, **kwargs):
+        raise luddite.socket.timeout("timed out")
+
+    line = luddite.RequirementsLine("dist==1.0")
+    assert line.process(worker) == "late"
+    assert str(line.error) == "timed out"
+
+
+def test_run_deadline(mocker, tmpdir, capsys):
+    reqs = tmpdir.join("requirements.txt")
+    reqs.write("dist1==1.1\nslow==1.0\ndist2==1.4\n")
+    mocker.patch("luddite.guess_index_type", return_value="pypi")
+    hung = luddite.threading.Event()
+
+    def worker(name, index=None, **kwargs):
+        if name == "slow":
+            hung.wait(5)
+        return ("1.1", "1.4")
+
+    lud = luddite.Luddite(str(reqs), index="http://myindex/")
+    lud.get_versions = worker
+    lud.pool = mocker.Mock()
+    try:
+        lud.run(deadline=0.2)
+    finally:
+        hung.set()
+    out = capsys.readouterr().out
+    assert "✖ dist1 1.1 (index has 1.4)" in out
+    assert "⌛ couldn't get slow in time (gave up at the 0.2s deadline)" in out
+    assert "✔ dist2 is up to date @ 1.4" in out
+    lud.pool.abort.assert_called_once_with()
+
+
+@pytest.mark.enable_socket
+def test_run_deadline_breaks_off_hanging_index(mocker, tmpdir, capsys):
+    reqs = tmpdir.join("requirements.txt")
+    reqs.write("dist1==1.1\ndist2==1.4\ndist3==1.0\n")
+    # accepts connections, and never answers on them
+    listener = luddite.socket.socket()
+    listener.bind(("127.0.0.1", 0))
+    listener.listen(10)
+    mocker.patch("luddite.guess_index_type", return_value="pypi")
+    executors = []
+
+    def executor(max_workers):
+        executors.append(ThreadPoolExecutor(max_workers=max_workers))
+        return executors[-1]
+
+    mocker.patch("luddite.ThreadPoolExecutor", executor)
+    index = "http://127.0.0.1:{}/pypi/".format(listener.getsockname()[1])
+    pool = luddite.HTTPPool(maxsize=2, timeout=30)
+    start = time.time()
+    try:
+        luddite.Luddite(str(reqs), index=index, pool=pool).run(n_threads=2, deadline=0.2)
+        # no retries or fallback endpoints, the lookups' threads are free to go
+        for lookups in executors:
+            lookups.shutdown(wait=True)
+    finally:
+        listener.close()
+    assert time.time() - start < 3
+    out = capsys.readouterr().out
+    assert out.count("in time (gave up at the 0.2s deadline)") == 3
+
+
+@pytest.mark.skipif(sys.version_info < (3,), reason="Python 3 only")
+@pytest.mark.enable_socket  # the event loop's self-pipe is a socketpair
+def test_run_async_deadline(mocker, tmpdir, capsys):
+    reqs = tmpdir.join("requirements.txt")
+    reqs.write("slow==1.0\ndist2==1.4\n")
+    mocker.patch("luddite.guess_index_type", return_value="pypi")
+
+    def fetch_async(self, pool, name, index, *args):
+        future = pool.loop.create_future()
+        if name != "slow":
+            future.set_result(("1.1", "1.4"))
+        return future
+
+    mocker.patch("luddite.Luddite._fetch_async", fetch_async)
+    luddite.Luddite(str(reqs), index="http://myindex/").run_async(deadline=0.1)
+    out = capsys.readouterr().out
+    assert "⌛ couldn't get slow in time (gave up at the 0.1s deadline)" in out
+    assert "✔ dist2 is up to date @ 1.4" in out
+
+
+def test_run_ndjson_in_completion_order(mocker, tmpdir, capsys):
+    reqs = tmpdir.join("requirements.txt")
+    reqs.write("# pins\nslow==1.0\ndist2==1.4\nfree\n")
+    mocker.patch("luddite.guess_index_type", return_value="pypi")
+    fast_done = luddite.threading.Event()
+
+    def worker(name, index=None, **kwargs):
+        if name == "slow":
+            fast_done.wait(5)
+            time.sleep(0.2)
+        else:
+            fast_done.set()
+        return ("1.0", "1.4", "1.5rc1")
+
+    lud = luddite.Luddite(str(reqs), index="http://myindex/", output_format="ndjson")
+    lud.get_versions = worker
+    lud.run()
+    records = [json.loads(line) for line in capsys.readouterr().out.splitlines()]
+    assert [r["name"] for r in records] == ["free", "dist2", "slow"]
+    assert records[2] == {
+        "file": str(reqs),
+        "index": "http://myindex/",
+        "line_number": 2,
+        "requirement": "slow==1.0",
+        "name": "slow",
+        "version": "1.0",
+        "latest": "1.5rc1",
+        "latest_non_pre": "1.4",
+        "allowed": None,
+        "status": "fail",
+        "error": None,
+    }
+    assert records[0]["status"] == "free"
+    assert records[1]["status"] == "warn"
+
+
+@pytest.mark.skipif(sys.version_info < (3,), reason="Python 3 only")
+@pytest.mark.enable_socket  # the event loop's self-pipe is a socketpair
+def test_run_async_ndjson_deadline(mocker, tmpdir, capsys):
+    reqs = tmpdir.join("requirements.txt")
+    reqs.write("slow==1.0\ndist2==1.4\n")
+    mocker.patch("luddite.guess_index_type", return_value="pypi")
+
+    def fetch_async(self, pool, name, index, *args):
+        future = pool.loop.create_future()
+        if name != "slow":
+            future.set_result(("1.1", "1.4"))
+        return future
+
+    mocker.patch("luddite.Luddite._fetch_async", fetch_async)
+    lud = luddite.Luddite(str(reqs), index="http://myindex/", output_format="ndjson")
+    lud.run_async(deadline=0.1)
+    records = [json.loads(line) for line in capsys.readouterr().out.splitlines()]
+    assert [(r["name"], r["status"]) for r in records] == [("dist2", "pass"), ("slow", "late")]
+    assert records[1]["error"] == "gave up at the 0.1s deadline"
+
+
+def test_version_service_keeps_versions_in_memory(mocker):
+    worker = mocker.Mock(side_effect=[("1.0",), ("1.0", "1.1")])
+    mocker.patch("luddite.IndexProbe", return_value=worker)
+    service = luddite.VersionService(index="http://myindex/", ttl=60)
+    assert service.versions([("Dist1", None), ("dist1", "http://myindex/")]) == [
+        {"versions": ["1.0"]},
+        {"versions": ["1.0"]},
+    ]
+    assert worker.call_count == 1
+    # past the ttl, the old versions are answered while new ones are fetched
+    mocker.patch("luddite.time.time", return_value=luddite.time.time() + 61)
+    assert service.lookup("dist1").result() == ("1.0",)
+    service.close()
+    service.executor.shutdown(wait=True)
+    assert service.lookup("dist1").result() == ("1.0", "1.1")
+    assert worker.call_count == 2
+
+
+def test_version_service_forgets_old_versions(mocker):
+    worker = mocker.Mock(return_value=("1.0",))
+    mocker.patch("luddite.IndexProbe", return_value=worker)
+    service = luddite.VersionService(index="http://myindex/", ttl=60, max_age=600)
+    service.versions([("dist1", None), ("dist2", None)])
+    mocker.patch("luddite.time.time", return_value=luddite.time.time() + 500)
+    service.versions([("dist2", None)])
+    service.executor.shutdown(wait=True)
+    mocker.patch("luddite.time.time", return_value=luddite.time.time() + 200)
+    service.evict()
+    # dist2 was asked for again, and refreshed then
+    assert sorted(name for _index, name in service._entries) == ["dist2"]
+
+
+def test_version_service_only_its_indexes(mocker):
+    worker = mocker.Mock(return_value=("1.0",))
+    mocker.patch("luddite.IndexProbe", return_value=worker)
+    mocker.patch("luddite.IndexGroup", return_value=worker)
+    service = luddite.VersionService(index="http://myindex/", extra_indexes=["http://extra/"])
+    assert service.versions(
+        [("dist1", "http://myindex"), ("dist1", "http://extra/"), ("dist1", "http://evil/")]
+    ) == [
+        {"versions": ["1.0"]},
+        {"versions": ["1.0"]},
+        {"error": "luddite serve doesn't look projects up on http://evil/", "late": False},
+    ]
+    assert worker.call_count == 2
+
+
+@pytest.mark.enable_socket
+def test_serve_and_client(mocker, tmpdir, capsys):
+    reqs = tmpdir.join("requirements.txt")
+    reqs.write("dist1==1.1\ndist2==1.4\nnope==1.0\n")
+
+    def worker(name, index=None, **kwargs):
+        if name == "nope":
+            raise luddite.LudditeError("no such project")
+        # a cold daemon takes longer to answer than to connect to
+        time.sleep(0.3)
+        return ("1.1", "1.4")
+
+    mocker.patch("luddite.IndexProbe", return_value=worker)
+    service = luddite.VersionService(index="http://myindex/")
+    server = luddite.make_server(str(tmpdir.join("luddite.sock")), service)
+    thread = luddite.threading.Thread(target=server.serve_forever)
+    thread.start()
+    try:
+        client = luddite.VersionClient(server.server_address, timeout=0.1)
+        lud = luddite.Luddite(str(reqs), index="http://myindex/", server=client)
+        lud.run()
+    finally:
+        server.shutdown()
+        server.server_close()
+        thread.join()
+    out = capsys.readouterr().out
+    assert "✖ dist1 1.1 (index has 1.4)" in out
+    assert "✔ dist2 is up to date @ 1.4" in out
+    assert "💩 couldn't get nope, sorry (no such project)" in out
+    assert len(service) == 3
+    assert not tmpdir.join("luddite.sock").exists()
+
+
+@pytest.mark.enable_socket
+def test_client_without_server(tmpdir, capsys):
+    reqs = tmpdir.join("requirements.txt")
+    reqs.write("dist1==1.1\n")
+    client = luddite.VersionClient(str(tmpdir.join("nobody.sock")))
+    luddite.Luddite(str(reqs), index="http://myindex/", server=client).run()
+    out = capsys.readouterr().out
+    assert "couldn't get dist1, sorry (no answer from luddite serve at" in out
+
+
+def test_watch_looks_up_only_changed_lines(mocker, tmpdir, capsys):
+    reqs = tmpdir.join("requirements.txt")
+    reqs.write("dist1==1.1\ndist2==1.4\n")
+    mocker.patch("luddite.guess_index_type", return_value="pypi")
+    worker = mocker.Mock(return_value=("1.1", "1.4"))
+    lud = luddite.Luddite(str(reqs), index="http://myindex/")
+    lud.get_versions = worker
+    stop = luddite.threading.Event()
+    kwargs = {"interval": 0.01, "stop": stop}
+    thread = luddite.threading.Thread(target=lud.watch, args=(lud.run,), kwargs=kwargs)
+    thread.start()
+
+    def wait_for_calls(n):
+        for _ in range(500):
+            if worker.call_count >= n:
+                return
+            luddite.time.sleep(0.01)
+
+    try:
+        wait_for_calls(2)
+        [dist2] = [line for line in lud.req_file.lines if line.text.startswith("dist2")]
+        tmpdir.join("more.txt").write("dist4==1.4\n")
+        reqs.write("dist1==1.4\ndist2==1.4\ndist3==1.1\n-r more.txt\n")
+        os.utime(str(reqs), (luddite.time.time() + 5, luddite.time.time() + 5))
+        wait_for_calls(5)
+    finally:
+        stop.set()
+        thread.join()
+    names = [c[0][0] for c in worker.call_args_list]
+    # the unchanged dist2 line kept its result, the re-pinned and new lines were looked up
+    assert sorted(names[:2]) == ["dist1", "dist2"]
+    assert sorted(names[2:]) == ["dist1", "dist3", "dist4"]
+    assert lud.req_file.lines[1] is dist2
+    assert [str(f.fname) for f in lud.req_files] == [str(reqs), str(tmpdir.join("more.txt"))]
+    out = capsys.readouterr().out
+    assert "✖ dist1 1.1 (index has 1.4)" in out
+    assert "changed" in out
+    assert "✔ dist1 is up to date @ 1.4" in out
+    assert out.count("✔ dist2 is up to date @ 1.4") == 2
+    assert "✖ dist3 1.1 (index has 1.4)" in out
+    assert "✔ dist4 is up to date @ 1.4" in out
+
+
+def test_includes(mocker, tmpdir, capsys):
+    reqs = tmpdir.join("requirements.txt")
+    reqs.write("-r base.txt\n--constraint=sub/constraints.txt\ndist1==1.1\n")
+    tmpdir.join("base.txt").write("dist1==1.1\n")
+    tmpdir.mkdir("sub").join("constraints.txt").write("-r ../requirements.txt\ndist2==1.4\n")
+    tmpdir.join("empty.txt").write("")
+    mocker.patch("luddite.guess_index_type", return_value="pypi")
+    worker = mocker.Mock(return_value=("1.1", "1.4"))
+    lud = luddite.Luddite([str(reqs), str(tmpdir.join("empty.txt"))], index="http://myindex/")
+    lud.get_versions = worker
+    lud.run()
+    fnames = [str(f.fname) for f in lud.req_files]
+    assert fnames == [
+        str(reqs),
+        str(tmpdir.join("empty.txt")),
+        str(tmpdir.join("base.txt")),
+        str(tmpdir.join("sub", "constraints.txt")),
+    ]
+    assert sorted(c[0][0] for c in worker.call_args_list) == ["dist1", "dist2"]
+    out = capsys.readouterr().out
+    assert out.count("✖ dist1 1.1 (index has 1.4)") == 2
+    assert "✔ dist2 is up to date @ 1.4" in out
+    assert "-r base.txt\n" in out
+    assert "4 files checked, 2 projects looked up" in out
+
+
+def test_include_missing(mocker, tmpdir, capsys):
+    reqs = tmpdir.join("requirements.txt")
+    reqs.write("-r missing.txt\ndist1==1.1\n")
+    mocker.patch("luddite.guess_index_type", return_value="pypi")
+    lud = luddite.Luddite(str(reqs), index="http://myindex/")
+    lud.get_versions = mocker.Mock(return_value=("1.1", "1.4"))
+    lud.run()
+    assert [str(f.fname) for f in lud.req_files] == [str(reqs)]
+    [include, _dist1] = lud.req_file.lines
+    assert isinstance(include.error, (IOError, OSError))
+    out = capsys.readouterr().out
+    assert "? skipped a line: -r missing.txt" in out
+    assert "✖ dist1 1.1 (index has 1.4)" in out
+    with pytest.raises((IOError, OSError)):
+        luddite.load_requirements([str(tmpdir.join("missing.txt"))])
+
+
+@pytest.mark.parametrize(
+    "text, target",
+    [
+        ("-r base.txt", "base.txt"),
+        ("-rbase.txt", "base.txt"),
+        ("--requirement=base.txt", "base.txt"),
+        ("-c constraints.txt  # pinned", "constraints.txt"),
+        ("--constraint constraints.txt", "constraints.txt"),
+        ("dist1==1.1", None),
+        ("-i http://myindex/", None),
+    ],
+)
+def test_include_lines(text, target):
+    line = luddite.RequirementsLine(text)
+    assert line.is_include() == target
+    if target is not None:
+        assert line.process(worker=None) == "noop"
+
+
+def _install(site_dir, name, version, egg_info=False):
+    metadata = "Metadata-Version: 2.1\nName: {}\nVersion: {}\n\nVersion: 0.0\n"
+    if egg_info:
+        site_dir.join("{}-{}.egg-info".format(name, version)).write(metadata.format(name, version))
+    else:
+        dist_info = site_dir.mkdir("{}-{}.dist-info".format(name, version))
+        dist_info.join("METADATA").write(metadata.format(name, version))
+
+
+def test_installed_environments(mocker, tmpdir, capsys):
+    venv1 = tmpdir.mkdir("venv1")
+    site_dir = venv1.mkdir("lib").mkdir("python3.9").mkdir("site-packages")
+    _install(site_dir, "dist1", "1.1")
+    _install(site_dir, "Dist_2", "1.4", egg_info=True)
+    site_dir.mkdir("dist1")
+    venv2 = tmpdir.mkdir("venv2")
+    _install(venv2, "dist1", "1.4")
+    worker = mocker.Mock(return_value=("1.1", "1.4"))
+    mocker.patch("luddite.IndexProbe", return_value=worker)
+    luddite.main(["--env", str(tmpdir.join("venv*")), "-i", "http://myindex/"])
+    assert sorted(c[0][0] for c in worker.call_args_list) == ["Dist_2", "dist1"]
+    out = capsys.readouterr().out
+    assert "---" + str(venv1) in out
+    assert "✖ dist1 1.1 (index has 1.4)" in out
+    assert "✔ Dist_2 is up to date @ 1.4" in out
+    assert "✔ dist1 is up to date @ 1.4" in out
+    with pytest.raises(luddite.LudditeError):
+        luddite.InstalledEnvironment(str(tmpdir.mkdir("empty")))
+
+
+def test_mirror_group_hedges_slow_mirror(mocker):
+    released = luddite.threading.Event()
+    attempts = []
+
+    def worker(name, index=None, **kwargs):
+        attempts.append(luddite._attempts.current)
+        if index == "http://slow/":
+            released.wait(5)
+            return ("1.0",)
+        return ("1.0", "1.1")
+
+    mocker.patch("luddite.IndexProbe", return_value=worker)
+    pool = mocker.Mock()
+    group = luddite.MirrorGroup(["http://slow/", "http://fast/"], delay=0.05)
+    try:
+        assert group("dist", pool=pool) == ("1.0", "1.1")
+    finally:
+        released.set()
+    slow_attempt = attempts[0]
+    assert slow_attempt.cancelled
+    pool.abort.assert_called_once_with(slow_attempt)
+    # the next lookup starts on the other mirror
+    assert group("dist", pool=pool) == ("1.0", "1.1")
+    assert len(attempts) == 3
+
+
+def test_mirror_group_fails_over(mocker):
+    def worker(name, index=None, **kwargs):
+        if index == "http://broken/":
+            raise luddite.LudditeError("broken")
+        return ("1.0",)
+
+    mocker.patch("luddite.IndexProbe", return_value=worker)
+    group = luddite.MirrorGroup(["http://broken/", "http://ok/"], delay=60)
+    assert group("dist") == ("1.0",)
+    group.mirrors = ["http://broken/"]
+    with pytest.raises(luddite.LudditeError, match="broken"):
+        group("dist")
+
+
+def test_mirror_group_hedge_delay():
+    group = luddite.MirrorGroup(["http://a/", "http://b/"], percentile=90, delay=1.0)
+    assert group.hedge_delay() == 1.0
+    for ms in range(100):
+        group._record(ms / 1000.0)
+    assert group.hedge_delay() == 0.09
+
+
+def test_extra_index_lines(tmpdir):
+    reqs = tmpdir.join("requirements.txt")
+    reqs.write("-i http://main/\n--extra-index-url http://internal/\n--extra-index-url=http://b/\n")
+    req_file = luddite.RequirementsFile(str(reqs))
+    assert req_file.index == "http://main/"
+    assert req_file.extra_indexes == ["http://internal/", "http://b/"]
+    assert req_file.lines[1].process(worker=None) == "noop"
+
+
+def _not_hosted():
+    return luddite.HTTPError("http://x/", 404, "Not Found", {}, None)
+
+
+def test_index_group_merges_versions(mocker, tmpdir):
+    hosted = {"http://pypi/": {"dist": ("1.0", "2.0")}, "http://internal/": {"dist": ("1.5",)}}
+    hosted["http://internal/"]["private"] = ("0.1",)
+    calls = []
+
+    def worker(name, index=None, **kwargs):
+        calls.append((name, index))
+        if index == "http://broken/":
+            raise luddite.LudditeError("broken")
+        if name not in hosted[index]:
+            raise _not_hosted()
+        return luddite.VersionIndex(hosted[index][name])
+
+    mocker.patch("luddite.IndexProbe", return_value=worker)
+    not_found = luddite.NotFoundCache(str(tmpdir.join("not-found.json")))
+    group = luddite.IndexGroup(["http://pypi/", "http://internal/"], not_found=not_found)
+    versions = group("dist")
+    assert versions == ("1.0", "1.5", "2.0")
+    assert versions.latest == "2.0"
+    assert group("private") == ("0.1",)
+    # pypi is known not to have it, so it isn't asked again
+    del calls[:]
+    assert group("private") == ("0.1",)
+    assert calls == [("private", "http://internal/")]
+    not_found.save()
+    assert luddite.NotFoundCache(not_found.path).is_missing("http://pypi/", "Private")
+    with pytest.raises(luddite.HTTPError):
+        group("nowhere")
+    group.indexes.append("http://broken/")
+    with pytest.raises(luddite.LudditeError, match="broken"):
+        group("dist")
+
+
+def test_extra_index_url(mocker, tmpdir, capsys):
+    reqs = tmpdir.join("requirements.txt")
+    reqs.write("--extra-index-url http://internal/\ndist1==1.5\nprivate==0.1\n")
+
+    def worker(name, index=None, **kwargs):
+        if index == "http://internal/":
+            return ("0.1",) if name == "private" else ("1.5",)
+        if name == "private":
+            raise _not_hosted()
+        return ("1.0", "2.0")
+
+    mocker.patch("luddite.IndexProbe", return_value=worker)
+    lud = luddite.Luddite(str(reqs), index="http://myindex/", extra_indexes=["http://internal/"])
+    assert lud.extra_indexes == ["http://internal/"]
+    lud.run()
+    out = capsys.readouterr().out
+    assert "extra index: http://internal/" in out
+    assert "dist1 1.5 (index has 2.0)" in out
+    assert "private is up to date @ 0.1" in out
+
+
+def test_changelog_pypi(mocker, tmpdir):
+    path = str(tmpdir.join("serials.json"))
+    xmlrpc = mocker.patch("luddite._xmlrpc", return_value=100)
+    changelog = luddite.ChangeLog(path)
+    # nothing known yet, it's up to the age of the cached responses
+    assert changelog.is_current("https://pypi.org/pypi/", "dist1") is None
+    xmlrpc.assert_called_once_with("https://pypi.org/pypi", "changelog_last_serial", timeout=10)
+    changelog.looked_up("https://pypi.org/pypi/", "Dist1")
+    changelog.looked_up("https://pypi.org/pypi/", "dist2")
+    changelog.save()
+
+    xmlrpc.return_value = [["Dist2", "1.1", 1600000000, "new release", 105]]
+    changelog = luddite.ChangeLog(path)
+    assert changelog.is_current("https://pypi.org/pypi/", "dist1") is True
+    assert changelog.is_current("https://pypi.org/pypi/", "dist2") is False
+    assert changelog.is_current("https://pypi.org/pypi/", "dist3") is None
+    xmlrpc.assert_called_with("https://pypi.org/pypi", "changelog_since_serial", [100], timeout=10)
+    assert xmlrpc.call_count == 2
+    changelog.looked_up("https://pypi.org/pypi/", "dist2")
+    changelog.save()
+    with open(path) as f:
+        state = json.load(f)
+    assert state == {
+        "https://pypi.org/pypi/": {"serial": 105, "projects": {"dist1": 105, "dist2": 105}}
+    }
+
+    xmlrpc.side_effect = luddite.socket.error("nope")
+    changelog = luddite.ChangeLog(path)
+    assert changelog.is_current("https://pypi.org/pypi/", "dist1") is None
+    # a failed sync doesn't lose the serials
+    changelog.save()
+    with open(path) as f:
+        assert json.load(f) == state
+
+
+def test_changelog_devpi(mocker, tmpdir):
+    path = str(tmpdir.join("serials.json"))
+    response = mocker.Mock(headers={"X-Devpi-Serial": "7"})
+    mocker.patch("luddite.urlopen", return_value=response)
+    for current in None, True:
+        changelog = luddite.ChangeLog(path)
+        assert changelog.is_current("http://devpi/root/pypi/", "dist1", "devpi") is current
+        changelog.looked_up("http://devpi/root/pypi/", "dist1")
+        changelog.save()
+    response.headers["X-Devpi-Serial"] = "8"
+    changelog = luddite.ChangeLog(path)
+    assert changelog.is_current("http://devpi/root/pypi/", "dist1", "devpi") is None
+
+
+def test_changelog_only_vouches_for_what_the_index_said(mocker, tmpdir):
+    index = "http://devpi/root/pypi/"
+    response = mocker.Mock(headers={"X-Devpi-Serial": "7"})
+    mocker.patch("luddite.urlopen", return_value=response)
+    pool = mocker.Mock()
+    headers = mocker.MagicMock(
+        **{"get_content_charset.return_value": "utf-8", "get.return_value": None}
+    )
+
+    def answer(body):
+        response = luddite.PooledResponse(index + "dist1", 200, headers, body)
+        pool.urlopen.return_value = response
+
+    def lookup(max_age):
+        changelog = luddite.ChangeLog(str(tmpdir.join("serials.json")))
+        cache = luddite.ResponseCache(str(tmpdir.join("http")), max_age=max_age)
+        versions = luddite.get_versions_devpi(
+            "dist1", index, cache=cache, pool=pool, changelog=changelog
+        )
+        changelog.save()
+        return versions
+
+    answer(b'{"result": {"1.0": {}}}')
+    assert lookup(max_age=60) == ("1.0",)
+    # a release moves the serial, the cached response is still young enough to be used
+    response.headers["X-Devpi-Serial"] = "8"
+    answer(b'{"result": {"1.0": {}, "1.1": {}}}')
+    assert lookup(max_age=60) == ("1.0",)
+    assert pool.urlopen.call_count == 1
+    # the serial stays put, but the cached response wasn't current as of it
+    assert lookup(max_age=0) == ("1.0", "1.1")
+    assert pool.urlopen.call_count == 2
+
+
+def test_json_get_fresh_overrides_age(mocker, tmpdir):
+    cache = luddite.ResponseCache(str(tmpdir), max_age=0)
+    cache.set("https://myindex/dist1/json", b'{"releases": {}}')
+    pool = mocker.Mock()
+    data = luddite.json_get("https://myindex/dist1/json", cache=cache, pool=pool, fresh=True)
+    assert data == {"releases": {}}
+    assert not pool.urlopen.called
+
+
+PIPFILE_LOCK = """{
+    "_meta": {
+        "hash": {"sha256": "abc"},
+        "sources": [{"name": "pypi", "url": "https://pypi.org/simple", "verify_ssl": true}]
+    },
+    "default": {
+        "dist1": {
+            "hashes": ["sha256:abc"],
+            "version": "==1.1"
+        },
+        "mylib": {"editable": true, "path": "."}
+    },
+    "develop": {
+        "dist1": {"hashes": ["sha256:abc"], "markers": "python_version >= '3.7'", "version": "==1.1"},
+        "dist2": {"version": "==1.4"}
+    }
+}
+"""
+
+POETRY_LOCK = """[[package]]
+name = "dist1"
+version = "1.1"
+description = "a [[package]] lookalike"
+optional = false
+python-versions = ">=3.7"
+files = [
+    {file = "dist1-1.1-py3-none-any.whl", hash = "sha256:abc"},
+]
+
+[package.dependencies]
+dist2 = ">=1.0"
+
+[[package]]
+name = "mylib"
+version = "0.1"
+
+[package.source]
+type = "git"
+url = "https://github.com/me/mylib.git"
+
+[[package]]
+name = "dist2"
+version = "1.4"
+category = "dev"
+
+[metadata]
+lock-version = "2.0"
+"""
+
+UV_LOCK = """version = 1
+
+[[package]]
+name = "dist1"
+version = "1.1"
+source = { registry = "https://pypi.org/simple" }
+dependencies = [
+    { name = "dist2" },
+]
+wheels = [
+    { url = "https://files/dist1-1.1-py3-none-any.whl", hash = "sha256:abc" },
+]
+
+[[package]]
+name = "myapp"
+version = "0.1.0"
+source = { editable = "." }
+"""
+
+POETRY2_LOCK = """[[package]]
+name = "dist1"
+version = "1.1"
+optional = false
+python-versions = ">=3.9"
+groups = ["main", "dev"]
+
+[[package]]
+name = "dist2"
+version = "1.4"
+groups = ['dev']
+
+[metadata]
+lock-version = "2.1"
+"""
+
+PYLOCK = """lock-version = "1.0"
+created-by = "someone"
+
+[[packages]]
+name = 'dist2'
+version = '1.4'
+index = "https://pypi.org/simple"
+
+[[packages.wheels]]
+url = "https://files/dist2-1.4-py3-none-any.whl"
+
+[[packages]]
+name = "mylib"
+version = "0.1"
+
+[packages.vcs]
+type = "git"
+"""
+
+
+@pytest.mark.parametrize(
+    "fname, content, expected",
+    [
+        (
+            "Pipfile.lock",
+            PIPFILE_LOCK,
+            [
+                (9, "default", "dist1", "1.1"),
+                (14, "develop", "dist1", "1.1"),
+                (15, "develop", "dist2", "1.4"),
+            ],
+        ),
+        ("poetry.lock", POETRY_LOCK, [(1, None, "dist1", "1.1"), (22, "dev", "dist2", "1.4")]),
+        ("poetry.lock", POETRY2_LOCK, [(1, "main, dev", "dist1", "1.1"), (8, "dev", "dist2", "1.4")]),
+        ("uv.lock", UV_LOCK, [(3, None, "dist1", "1.1")]),
+        ("pylock.toml", PYLOCK, [(4, None, "dist2", "1.4")]),
+    ],
+)
+def test_lock_readers(fname, content, expected):
+    reader = luddite.lock_reader(fname)
+    assert list(reader(io.StringIO(content))) == expected
+
+
+def test_lock_file(mocker, tmpdir, capsys):
+    lock = tmpdir.join("Pipfile.lock")
+    lock.write(PIPFILE_LOCK)
+    assert luddite.lock_reader("requirements.txt") is None
+    assert luddite.lock_reader("pylock.dev.toml") is luddite.read_pylock
+    mocker.patch("luddite.guess_index_type", return_value="pypi")
+    worker = mocker.Mock(return_value=("1.1", "1.4"))
+    lud = luddite.Luddite(str(lock), index="http://myindex/")
+    lud.get_versions = worker
+    lud.run()
+    assert isinstance(lud.req_file, luddite.LockFile)
+    assert sorted(c[0][0] for c in worker.call_args_list) == ["dist1", "dist2"]
+    out = capsys.readouterr().out
+    assert "dist1==1.1  # default  ✖ dist1 1.1 (index has 1.4)" in out
+    assert "dist1==1.1  # develop  ✖ dist1 1.1 (index has 1.4)" in out
+    assert "dist2==1.4  # develop  ✔ dist2 is up to date @ 1.4" in out
+
+
+def test_lock_file_without_sections(mocker, tmpdir):
+    lock = tmpdir.join("uv.lock")
+    lock.write(UV_LOCK)
+    mocker.patch("luddite.guess_index_type", return_value="pypi")
+    lud = luddite.Luddite(str(lock), index="http://myindex/")
+    assert [line.text for line in lud.req_file.lines] == ["dist1==1.1"]
+
+
+def test_check_iterable(mocker):
+    read = []
+
+    def requirements():
+        for text in ["# pinned\n", "dist1==1.1\n", "-i http://other/\n", "dist1==1.4", "free\n"]:
+            read.append(text)
+            yield text
+
+    worker = mocker.Mock(return_value=("1.1", "1.4"))
+    results = luddite.check(requirements(), index="http://myindex/", worker_for=lambda i: worker)
+    first = next(results)
+    assert first.status == "noop"
+    assert len(read) == 1
+    rest = list(results)
+    assert [(r.line_number, r.name, r.status) for r in rest] == [
+        (2, "dist1", "fail"),
+        (3, None, "noop"),
+        (4, "dist1", "pass"),
+        (5, "free", "free"),
+    ]
+    assert [c[1]["index"] for c in worker.call_args_list] == ["http://myindex/", "http://other/"]
+    assert rest[0].message() == "✖ dist1 1.1 (index has 1.4)"
+    assert rest[0].as_dict()["latest"] == "1.4"
+    assert not hasattr(rest[0], "__dict__")
+
+
+def test_check_window_and_memo(mocker):
+    read = []
+
+    def requirements():
+        for i in range(10):
+            read.append(i)
+            yield "dist{}==1.0".format(i % 3)
+
+    worker = mocker.Mock(return_value=("1.0",))
+    results = luddite.check(
+        requirements(), index="http://myindex/", window=2, memo_size=3, worker_for=lambda i: worker
+    )
+    for n, result in enumerate(results, 1):
+        assert result.status == "pass"
+        assert len(read) <= n + 2
+    assert worker.call_count == 3
+    # projects which fell out of the memo are looked up again
+    del read[:]
+    results = luddite.check(
+        requirements(), index="http://myindex/", memo_size=2, worker_for=lambda i: worker
+    )
+    assert len(list(results)) == 10
+    assert worker.call_count == 13
+
+
+def test_main_stdin(mocker, capsys):
+    mocker.patch("sys.stdin", io.StringIO("dist1==1.1\nwhat the feck\n"))
+    worker = mocker.Mock(return_value=("1.1", "1.4"))
+    mocker.patch("luddite.IndexProbe", return_value=worker)
+    luddite.main(["-", "-i", "http://myindex/", "--format", "ndjson"])
+    records = [json.loads(line) for line in capsys.readouterr().out.splitlines()]
+    assert [(r["name"], r["status"]) for r in records] == [("dist1", "fail"), (None, "skip")]
+    mocker.patch("sys.stdin", io.StringIO("dist1==1.4\n"))
+    luddite.main(["-", "-i", "http://myindex/"])
+    assert capsys.readouterr().out == "dist1==1.4  ✔ dist1 is up to date @ 1.4\n"
+
+
+@pytest.mark.parametrize(
+    "options, error",
+    [
+        (["--engine", "asyncio"], "--engine asyncio"),
+        (["--env", "venv"], "--env"),
+        (["--mirror", "http://mirror/", "--deadline", "1"], "--mirror, --deadline"),
+        (["--watch"], "--watch"),
+    ],
+)
+def test_main_stdin_unsupported_options(mocker, capsys, options, error):
+    check = mocker.patch("luddite.check")
+    with pytest.raises(SystemExit):
+        luddite.main(["-"] + options)
+    assert "{} can't be used when reading from stdin".format(error) in capsys.readouterr().err
+    assert not check.called
+
+
+def test_asyncio_engine_rejects_stream(mocker, tmpdir, capsys):
+    mocker.patch("luddite.Luddite")
+    with pytest.raises(SystemExit):
+        luddite.main(["--engine", "asyncio", "--stream", str(tmpdir.join("requirements.txt"))])
+    assert "--stream can't be used with --engine asyncio" in capsys.readouterr().err
+    assert not luddite.Luddite.called
+
+
+@pytest.mark.skipif(sys.version_info < (3,), reason="Python 3 only")
+def test_run_async_rejects_stream(mocker, tmpdir):
+    reqs = tmpdir.join("requirements.txt")
+    reqs.write("dist1==1.1\n")
+    mocker.patch("luddite.guess_index_type", return_value="pypi")
+    lud = luddite.Luddite(str(reqs), index="http://myindex/", stream=True)
+    with pytest.raises(luddite.LudditeError):
+        lud.run_async()